@@ -0,0 +1,247 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem, AcquisitionError, load_backend
+
+
+class AlazarMultiBoardSystem:
+    """
+    主从系统 (同一 systemId 的多块 ATS9373 共用主板卡的时钟和触发) 的同步逐点采集。
+    与 ATS9373_NPT_MasterSlave 例程相同: 每块板卡各自 beforeAsyncRead / 提交 Buffer, 只由主板卡 (boardId 1) startCapture。
+
+    每块板卡由一个 AlazarNPTSystem 管理 (prepare 参数、平均、Arena、Deadline 和 DMA 统计都照旧),
+    每个点由线程池并行服务各板卡的 DMA 环形队列, 再合并成一个结果:
+      每个点的数据形状为 (records 或 1, recordLength), recordLength 是各板卡交织 record 首尾相接的总长度,
+      channel_info 记录每个通道所在的板卡、位置和步长, split_channels 取出各通道的视图。
+    任何一块板卡出错时所有板卡一起重新装载 DMA、由主板卡重新启动, 再重采这个点 (单独重启一块板卡会与其他板卡错开)。
+    get_one_acquisition 的调用方式和结果格式与 AlazarNPTSystem 相同, 但不能直接替换: 只支持逐点采集 (平均 / 原始, Arena),
+    没有后台 DMA 线程、板载 FFT、footer 分像素、深度窗和稳健统计 (prepare 时拒绝)。
+    PAM_Main 的 BOARD_IDS 是使用本类的专门路径, 会先检查这些开关。
+    """
+
+    def __init__(self, systemId=1, board_ids=None, backend=None):
+        """
+        :param board_ids: 参与采集的 boardId 列表 (第一个必须是主板卡 1), 默认为 System 中的全部板卡
+        :param backend: 同 AlazarNPTSystem, 传入 Alazar_imaging.SimulatedATS9373 可用模拟板卡 (先 set_system_boards)
+        """
+        backend = load_backend(backend)
+        if board_ids is None:
+            board_ids = list(range(1, backend.boardsInSystemBySystemID(systemId) + 1))
+        if not board_ids or board_ids[0] != 1:
+            raise ValueError("第一块板卡必须是主板卡 (boardId 1)")
+        self.systems = [AlazarNPTSystem(systemId, b, backend) for b in board_ids]
+        self.master = self.systems[0]
+        self.board_ids = list(board_ids)
+        self.ats = self.master.ats
+        # 每块板卡一个常驻线程, 点与点之间不重新创建
+        self._pool = ThreadPoolExecutor(max_workers=len(self.systems), thread_name_prefix="alazar-board")
+        self.max_point_retries = 2
+        self.max_failed_points = 3
+        self.result_arena = None
+        self.acq_stats = None
+        self.record_stats = None # 不支持稳健统计, 与 AlazarNPTSystem 的属性保持一致
+        self.gateStart = 0       # 不支持深度窗, 保存的第一个采样点就是触发时刻
+        print(f"✅ [DAQ] 主从系统 {systemId}: {len(self.systems)} 块板卡 {self.board_ids}")
+
+    def configure_boards(self, aux_in=False):
+        for system in self.systems:
+            system.configure_board(aux_in=aux_in)
+
+    @property
+    def samplesPerSec(self):
+        return self.master.samplesPerSec
+
+    def plan_buffer_geometry(self, prf_hz, samples_per_record, records_per_point, channel_count=1, **kwargs):
+        """
+        同 AlazarNPTSystem.plan_buffer_geometry, 每块板卡用同一套几何;
+        主机要同时服务全部板卡, 余量和 DMA 内存按总通道数 (channel_count x 板卡数) 估算
+        """
+        return self.master.plan_buffer_geometry(prf_hz, samples_per_record, records_per_point,
+                                                channel_count=channel_count * len(self.systems), **kwargs)
+
+    def prepare_acquisition(self, num_points, acq_channel=None, use_arena=False, Average_Enable=False,
+                            **kwargs):
+        """
+        逐块板卡调用 AlazarNPTSystem.prepare_acquisition (其余参数相同, 每块板卡都用同一套 record / Buffer 几何)。
+        :param acq_channel: 通道掩码, 对所有板卡相同 (默认 CHANNEL_A); 或每块板卡一个掩码的列表
+        :param use_arena: 一次性分配合并后的结果数组 (点数, record数 或 1, 总 recordLength),
+                          各板卡直接写入自己的那几列, 合并不需要额外拷贝
+        """
+        unsupported = [name for name in ("enable_footers", "depth_gate", "robust_stats") if kwargs.get(name)]
+        if unsupported:
+            raise ValueError(f"主从多板卡不支持 {unsupported}")
+        masks = acq_channel if isinstance(acq_channel, (list, tuple)) else [acq_channel] * len(self.systems)
+        if len(masks) != len(self.systems):
+            raise ValueError(f"acq_channel 需要 {len(self.systems)} 个通道掩码, 实际 {len(masks)} 个")
+        for system, mask in zip(self.systems, masks):
+            system.prepare_acquisition(num_points, acq_channel=mask, use_arena=False,
+                                       Average_Enable=Average_Enable, **kwargs)
+
+        # 合并后的 record: 各板卡的交织 record 按板卡顺序首尾相接
+        names = "ABCDEFGH"
+        self.channel_info = []
+        self.board_slices = []
+        offset = 0
+        for board_id, system in zip(self.board_ids, self.systems):
+            self.board_slices.append(slice(offset, offset + system.recordLength))
+            for i, channel in enumerate(system.channelList):
+                self.channel_info.append({"name": f"{board_id}{names[self.ats.channels.index(channel)]}",
+                                          "board": board_id, "channel": channel,
+                                          "offset": offset + i, "stride": system.channelCount})
+            offset += system.recordLength
+        self.recordLength = offset
+        self.channelCount = len(self.channel_info)
+        self.recordsPerPoint = self.master.recordsPerPoint
+        self.samplesPerRecord = self.master.samplesPerRecord
+        self.bytesPerBuffer = sum(system.bytesPerBuffer for system in self.systems)
+
+        self.result_arena = None
+        self.arena_idx = 0
+        if use_arena:
+            self._allocate_result_arena(num_points, Average_Enable)
+        self._reset_acq_stats()
+
+    def _allocate_result_arena(self, num_points, Average_Enable):
+        """合并后的 Arena; 每块板卡的 result_arena 是其中几列的视图, 原有的 Arena 写入路径不变"""
+        if Average_Enable:
+            records = 1
+            dtype = np.result_type(*[system.acc_dtype for system in self.systems])
+        else:
+            records = self.master.buffersPerPoint * self.master.recordsPerBuffer
+            dtype = self.master.buffers[0].buffer.dtype
+        self.result_arena = np.zeros((num_points, records, self.recordLength), dtype=dtype)
+        for system, cols in zip(self.systems, self.board_slices):
+            system.result_arena = self.result_arena[:, :, cols]
+            system.arena_idx = 0
+            system.arena_average = Average_Enable
+        print(f"✅ [DAQ] 合并结果 Arena 已分配: {self.result_arena.shape}, {self.result_arena.nbytes / 1024**3:.2f} GB")
+
+    def get_arena_result(self):
+        return self.result_arena[:self.arena_idx]
+
+    def stack_point(self, point_bufs):
+        """all_data 中一个点的 Buffer 列表 -> (record 数, 合并 recordLength) 矩阵, 见 AlazarNPTSystem.stack_point"""
+        return np.vstack(point_bufs).reshape(-1, self.recordLength)
+
+    def gate_records(self, data):
+        """不支持深度窗, 原样返回 (与 AlazarNPTSystem 没有设置深度窗时相同)"""
+        return data
+
+    def split_channels(self, data):
+        """
+        把最后一维为合并 record (recordLength) 的数组拆成各通道的视图 (不复制), 顺序与 channel_info 一致。
+        """
+        data = np.asarray(data)
+        return [data[..., info["offset"]::info["stride"]][..., :self.samplesPerRecord] for info in self.channel_info]
+
+    def enable_live_map(self, scan_w, scan_h, envelope=None):
+        """实时 MAP 只用主板卡的第一个通道 (光声信号), 见 AlazarNPTSystem.enable_live_map"""
+        self.master.enable_live_map(scan_w, scan_h, envelope)
+
+    @property
+    def live_map(self):
+        return self.master.live_map
+
+    def start_capture(self):
+        """各板卡已在 prepare 时装载好 DMA, 只启动主板卡 (从板卡随主板卡同时开始)"""
+        self.master.board.startCapture()
+        for system in self.systems:
+            system.is_capturing = True
+
+    def get_one_acquisition(self, all_data, pos_mapping, curr_pos_str, timeout_ms, Average_Enable=False):
+        """
+        所有板卡并行采集一个点, 合并后存入 all_data: [ (records 或 1, recordLength) ]。
+        Arena 模式下存的是合并 Arena 的视图; 否则为各板卡结果的拼接。
+        """
+        point = len(all_data)
+        steps = [system._begin_point(timeout_ms, Average_Enable) for system in self.systems]
+        ok = self._acquire_with_recovery([acquire for acquire, _ in steps], point)
+        parts = [finish(ok) for _, finish in steps]
+        if self.result_arena is not None:
+            merged = self.result_arena[self.arena_idx]
+            self.arena_idx += 1
+        else:
+            merged = np.concatenate([np.reshape(part, (-1, system.recordLength))
+                                     for part, system in zip(parts, self.systems)], axis=1)
+        all_data.append([merged])
+        self.master._map_point(parts[0] if ok else [], Average_Enable)
+        self.master._store_pos(pos_mapping, len(all_data) - 1, curr_pos_str)
+
+    # =====================================================
+    #  同步的异常恢复
+    # =====================================================
+
+    def _reset_acq_stats(self):
+        """points / retried_points / failed_points / rearms 按整个系统计 (一次 rearm 重新装载全部板卡)"""
+        self.acq_stats = {"points": 0, "retried_points": 0, "failed_points": [], "rearms": 0}
+        self._consecutive_failures = 0
+
+    def get_acquisition_stats(self):
+        """
+        各板卡的 Buffer / record / 错误计数之和, 再加上系统级的点数和重试统计;
+        boards 为每块板卡自己的 get_acquisition_stats, 可以看出是哪块板卡出的问题。
+        """
+        boards = [system.get_acquisition_stats() for system in self.systems]
+        stats = {key: sum(b[key] for b in boards)
+                 for key in ("buffers", "records", "discarded_records", "timeouts", "overflows", "errors",
+                             "footer_gaps", "lost_records", "lag_warnings")}
+        stats.update(self.acq_stats)
+        stats["failed_points"] = list(self.acq_stats["failed_points"])
+        stats["records_expected"] = sum(b["records_expected"] for b in boards)
+        stats["trigger_rate_hz"] = boards[0]["trigger_rate_hz"] # 各板卡共用主板卡的触发
+        stats["boards"] = boards
+        return stats
+
+    def _acquire_all(self, acquires):
+        """各板卡在线程池里同时等待自己的 Buffer; 返回每块板卡的 AcquisitionError (成功为 None)"""
+        def run(acquire):
+            try:
+                acquire()
+            except AcquisitionError as e:
+                return e
+            return None
+        return list(self._pool.map(run, acquires))
+
+    def rearm_all(self):
+        """全部板卡 abort -> beforeAsyncRead -> 重新提交 Buffer, 最后只启动主板卡, 各板卡的 record 重新对齐"""
+        for system in self.systems:
+            system.rearm_dma(start=False)
+        self.master.board.startCapture()
+        self.acq_stats["rearms"] += 1
+
+    def _acquire_with_recovery(self, acquires, point):
+        """与 AlazarNPTSystem._acquire_with_recovery 相同的规则, 只是任何一块板卡失败都整体重采"""
+        for attempt in range(self.max_point_retries + 1):
+            kept_before = [system._kept_records() for system in self.systems]
+            errors = self._acquire_all(acquires)
+            failed = [(board_id, e) for board_id, e in zip(self.board_ids, errors) if e is not None]
+            if not failed:
+                for system in self.systems:
+                    system.acq_stats["points"] += 1
+                self.acq_stats["points"] += 1
+                self._consecutive_failures = 0
+                return True
+            for system, before in zip(self.systems, kept_before):
+                system.acq_stats["discarded_records"] += system._kept_records() - before
+            board_id, error = failed[0]
+            print(f"⚠️ [DAQ] 第 {point} 个点采集失败 (板卡 {[b for b, _ in failed]}, {error.kind}, "
+                  f"第 {attempt + 1} 次): {error}")
+            if attempt == 0:
+                self.acq_stats["retried_points"] += 1
+            self.rearm_all()
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.max_failed_points:
+            raise error
+        self.acq_stats["failed_points"].append(point)
+        print(f"❌ [DAQ] 第 {point} 个点重试 {self.max_point_retries} 次仍失败, 填 0 后继续")
+        return False
+
+    def stop_capture(self):
+        for system in self.systems:
+            system.stop_capture()
+
+    def close(self):
+        """停止线程池, 释放各板卡 Buffer 池的页锁定内存"""
+        self._pool.shutdown(wait=True)
+        for system in self.systems:
+            system.close()
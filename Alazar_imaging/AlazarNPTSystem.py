@@ -1,43 +1,138 @@
 # Alazar_NPT_Handler.py
+import collections
 import ctypes
 import numpy as np
 import os
 import sys
+import threading
 import time
 import traceback
 # 假设 atsapi 就在 Library 路径下，或者你可以直接 pip install atsapi
 # sys.path.append(os.path.join(os.path.dirname(__file__), '../..', 'Library'))
-import atsapi as ats
+try:
+    import atsapi as ats
+    _ats_error = None
+except (ImportError, OSError) as e:
+    # 没有安装驱动 (libATSApi.so / ATSApi.dll) 时模块仍可导入, 但必须显式传入 backend (见 load_backend)
+    ats, _ats_error = None, e
+
+from Alazar_imaging.RecordStatistics import RecordStatistics
+from Alazar_imaging.DMABufferPool import DMABufferPool
+from Alazar_imaging.Alazar_imaging_tools import assign_pixels_by_aux, assign_pixels_by_timestamp, \
+    spectral_features, spectral_feature_names, find_signal_window, snake_pixel_position, aline_features
+
+# 与 ats.NPTFooter (ctypes 结构体, 8 字节对齐) 内存布局一致的 numpy 类型
+NPT_FOOTER_DTYPE = np.dtype([("trigger_timestamp", np.uint64),
+                             ("record_number", np.uint32),
+                             ("frame_count", np.uint32),
+                             ("aux_in_state", np.uint32)], align=True)
+
+
+class AcquisitionError(RuntimeError):
+    """
+    一个 DMA Buffer 没有正常完成。kind 为:
+      "timeout"  -> 超时内没有凑满 Buffer (触发中断或还没到位)
+      "overflow" -> 主机来不及归还 Buffer, 板载 FIFO 溢出, 板卡已停止采集, 必须重新装载 DMA
+      "error"    -> 其他驱动错误
+    """
+
+    def __init__(self, kind, message):
+        super().__init__(message)
+        self.kind = kind
+
+
+def load_backend(backend=None):
+    """
+    返回板卡接口模块: 给定 backend 时原样返回, 否则为 atsapi。
+    没有驱动时不会自动换成模拟板卡 (以免在采集电脑上悄悄采到假数据), 而是抛出 ImportError;
+    模拟需显式传入 backend=Alazar_imaging.SimulatedATS9373。
+    """
+    if backend is not None:
+        return backend
+    if ats is None:
+        raise ImportError(f"无法加载 atsapi ({_ats_error}); 没有采集卡时请传入 "
+                          f"backend=Alazar_imaging.SimulatedATS9373") from _ats_error
+    return ats
+
+
+def classify_dma_error(e):
+    """按 atsapi 异常消息中的错误名归类 (与 AcquisitionError.kind 对应)"""
+    text = str(e)
+    if "ApiWaitTimeout" in text:
+        return "timeout"
+    if "Overflow" in text or "Overrun" in text:
+        return "overflow"
+    return "error"
 
 class AlazarNPTSystem:
-    def __init__(self, systemId=1, boardId=1):
-        self.board = ats.Board(systemId=systemId, boardId=boardId)
+    # ATS9373 NPT 的 DMA 约束 (见 ATS-SDK 手册的 record 长度要求)
+    SAMPLE_ALIGNMENT = 128            # samples_per_record 必须是 128 的整数倍
+    MIN_SAMPLES_PER_RECORD = 256
+    TRIGGER_DELAY_ALIGNMENT = 16      # setTriggerDelay 的采样点数必须是 16 的整数倍
+    MAX_BUFFER_BYTES = 64 * 1024**2   # 单个 DMA Buffer 上限, 再大驱动分配容易失败
+    MIN_BUFFER_COUNT = 4
+    MAX_BUFFER_RATE_HZ = 10000.       # 主机每秒能可靠服务的 Buffer 数 (每个 Buffer 有固定的 Python 调用开销)
+    MAX_DMA_BYTES_PER_S = 6.8e9       # ATS9373 PCIe Gen3 x8 的持续传输上限
+    MAX_HOST_BYTES_PER_S = 2e9        # 主机按平均模式归约的持续吞吐量 (保守值, 可用 buffer_geometry_sweep 实测后调整)
+    MIN_HEADROOM = 1.5                # 主机处理能力至少为实际需要的这么多倍, 否则规划视为不安全
+    MIN_LAG_WAIT_S = 5e-3             # 距离预计完成时间不到这么久时不再拆成两段等待, 也是预计完成时间的最小余量 (见 _wait_next_buffer)
+    TRIGGER_RATE_WINDOW = 32          # 触发率按最近这么多个 Buffer 的完成时刻估计 (见 _measure_trigger_rate)
+    NPT_FOOTER_BYTES = 16             # 时域 NPT footer 覆盖每条 record 末尾的 128 bit
+
+    def __init__(self, systemId=1, boardId=1, backend=None):
+        """
+        :param backend: 提供 Board / DMABuffer / NPTFooter 的模块, 默认为 atsapi;
+                        传入 Alazar_imaging.SimulatedATS9373 可在没有采集卡的机器上运行
+        """
+        self.ats = load_backend(backend)
+        self.board = self.ats.Board(systemId=systemId, boardId=boardId)
         self.buffers = []
         self.buffer_list_handle = [] # 保持对Buffer对象的引用防止被GC
+        # 页锁定内存由池持有, 多次扫描复用 (见 _lease_buffers), 不再每次 prepare 重新分配
+        self.buffer_pool = DMABufferPool(self.ats, self.board.handle)
+        self._buffer_lease = None
         self.samplesPerSec = 2000000000.0
         self.is_capturing = False
+        self.stream_thread = None
+        self.hw_average = False
+        self.fft_mode = False
+        self.adma_mode = "npt"
+        self.gate = None
+        self.record_stats = None
+        self.live_map = None
+        self.acq_stats = None
+        self.max_point_retries = 2      # 一个点失败后重新装载 DMA 重试的次数, 仍失败则该点填 0 并继续扫描
+        self.max_failed_points = 3      # 连续这么多个点都失败 (例如激光没开) 时不再继续, 抛出 AcquisitionError
+        self.max_stream_rearms = 16     # 后台 DMA 线程最多自动重新装载的次数
+        self.deadline_margin = 2.       # 每个点的等待期限至少为按触发率推算的采集时间的这么多倍
+        self.lag_factor = 1.5           # Buffer 超过预计完成时间的这么多倍仍未完成时提前警告
+        self.nominal_prf_hz = None      # prepare 时给定的激光重复频率
+        self.trigger_rate_hz = None     # 采集过程中实测的触发率
         
-    def configure_board(self):
+    def configure_board(self, aux_in=False):
+        """
+        :param aux_in: True 时把 AUX I/O 设为输入 (接位移台的 TTL), 其电平会记录在 NPT footer 的 aux_in_state 里
+        """
         # 时钟设置 (4GS/s)
-        self.board.setCaptureClock(ats.INTERNAL_CLOCK, ats.SAMPLE_RATE_2000MSPS, ats.CLOCK_EDGE_RISING, 0)
+        self.board.setCaptureClock(self.ats.INTERNAL_CLOCK, self.ats.SAMPLE_RATE_2000MSPS, self.ats.CLOCK_EDGE_RISING, 0)
         
         # 通道设置
-        self.board.inputControlEx(ats.CHANNEL_A, ats.DC_COUPLING, ats.INPUT_RANGE_PM_400_MV, ats.IMPEDANCE_50_OHM)
-        self.board.inputControlEx(ats.CHANNEL_B, ats.DC_COUPLING, ats.INPUT_RANGE_PM_400_MV, ats.IMPEDANCE_50_OHM)
+        self.board.inputControlEx(self.ats.CHANNEL_A, self.ats.DC_COUPLING, self.ats.INPUT_RANGE_PM_400_MV, self.ats.IMPEDANCE_50_OHM)
+        self.board.inputControlEx(self.ats.CHANNEL_B, self.ats.DC_COUPLING, self.ats.INPUT_RANGE_PM_400_MV, self.ats.IMPEDANCE_50_OHM)
         
         # 触发设置 (使用 Channel A 作为触发源? 还是外部 TTL?)
         # 你的描述是：激光使用内部频率(80K)进行发射,该80K的脉冲也引到trigger
         # 这意味着采集卡应该设置为【外部触发】(External Trigger)
-        self.board.setExternalTrigger(ats.DC_COUPLING, ats.ETR_2V5)
+        self.board.setExternalTrigger(self.ats.DC_COUPLING, self.ats.ETR_2V5)
         
-        self.board.setTriggerOperation(ats.TRIG_ENGINE_OP_J,
-                                       ats.TRIG_ENGINE_J,
-                                       ats.TRIG_EXTERNAL, # 外部触发
-                                       ats.TRIGGER_SLOPE_POSITIVE,
+        self.board.setTriggerOperation(self.ats.TRIG_ENGINE_OP_J,
+                                       self.ats.TRIG_ENGINE_J,
+                                       self.ats.TRIG_EXTERNAL, # 外部触发
+                                       self.ats.TRIGGER_SLOPE_POSITIVE,
                                        150,
-                                       ats.TRIG_ENGINE_K,
-                                       ats.TRIG_DISABLE,
-                                       ats.TRIGGER_SLOPE_POSITIVE,
+                                       self.ats.TRIG_ENGINE_K,
+                                       self.ats.TRIG_DISABLE,
+                                       self.ats.TRIGGER_SLOPE_POSITIVE,
                                        128)
         
         # 设置触发延迟和超时
@@ -45,107 +140,1335 @@ class AlazarNPTSystem:
         self.board.setTriggerTimeOut(0) # 无限等待触发
         
         # 如果激光器自己发光并给板卡触发，则无需此步，或设为 AUX_OUT_TRIGGER
-        self.board.configureAuxIO(ats.AUX_OUT_TRIGGER, 0)
+        if aux_in:
+            self.board.configureAuxIO(self.ats.AUX_IN_AUXILIARY, 0)
+        else:
+            self.board.configureAuxIO(self.ats.AUX_OUT_TRIGGER, 0)
         print("✅ [DAQ] 板卡配置完成")
 
-    def prepare_acquisition(self,num_points:int,acq_channel=ats.CHANNEL_A, samples_per_record=4096,
-                             records_per_buffer=16,buffer_count=4, records_per_point=1024, preTriggerSamples=0):
+    def plan_buffer_geometry(self, prf_hz, samples_per_record, records_per_point, channel_count=1,
+                             available_ram_bytes=None, target_buffer_rate_hz=1000., max_stall_ms=100.,
+                             ram_fraction=0.25, host_bytes_per_s=None, min_headroom=None):
+        """
+        根据激光重复频率等参数规划 records_per_buffer 和 buffer_count, 在 prepare_acquisition 之前调用。
+          - 余量 (headroom) = Buffer 周期 / 主机处理一个 Buffer 的时间, 处理时间按固定开销 (1 / MAX_BUFFER_RATE_HZ)
+            + 字节数 / host_bytes_per_s 估算; 余量低于 min_headroom 的规划迟早溢出, 不会返回
+          - records_per_buffer 取 records_per_point 的约数 (每个点正好由整数个 Buffer 组成, 不丢 record),
+            在余量足够的候选中使 Buffer 完成频率 (prf / records_per_buffer) 最接近 target_buffer_rate_hz
+          - buffer_count 至少能覆盖主机 max_stall_ms 的卡顿 (串口查询、GC 等), 且总内存不超过
+            available_ram_bytes * ram_fraction (DMA Buffer 是锁页内存)
+        无法满足时抛出 ValueError, 不会去配置板卡。
+        :param available_ram_bytes: 可用物理内存字节数, None 表示不检查内存
+        :param host_bytes_per_s: 主机的持续处理吞吐量 (字节/秒), None 时为 MAX_HOST_BYTES_PER_S
+        :param min_headroom: 最小余量, None 时为 MIN_HEADROOM
+        :return: dict (records_per_buffer, buffer_count, buffers_per_point, bytes_per_buffer,
+                       buffer_rate_hz, buffer_period_ms, dma_ram_bytes, stall_cover_ms, headroom)
+        """
+        errors = []
+        if prf_hz <= 0:
+            errors.append(f"PRF 必须为正数: {prf_hz}")
+        if records_per_point < 1:
+            errors.append(f"records_per_point 必须 >= 1: {records_per_point}")
+        if samples_per_record < self.MIN_SAMPLES_PER_RECORD or samples_per_record % self.SAMPLE_ALIGNMENT:
+            errors.append(f"samples_per_record={samples_per_record} 必须 >= {self.MIN_SAMPLES_PER_RECORD} "
+                          f"且为 {self.SAMPLE_ALIGNMENT} 的整数倍")
+        if errors:
+            raise ValueError("; ".join(errors))
+
+        host_bytes_per_s = self.MAX_HOST_BYTES_PER_S if host_bytes_per_s is None else host_bytes_per_s
+        min_headroom = self.MIN_HEADROOM if min_headroom is None else min_headroom
+        _, bitsPerSample = self.board.getChannelInfo()
+        bytes_per_record = (bitsPerSample.value + 7) // 8 * samples_per_record * channel_count
+        data_rate = prf_hz * bytes_per_record
+        if data_rate > self.MAX_DMA_BYTES_PER_S:
+            raise ValueError(f"数据率 {data_rate / 1e9:.2f} GB/s 超过 PCIe 上限 "
+                             f"{self.MAX_DMA_BYTES_PER_S / 1e9:.1f} GB/s")
+        if data_rate * min_headroom > host_bytes_per_s:
+            raise ValueError(f"数据率 {data_rate / 1e9:.2f} GB/s, 主机处理能力 {host_bytes_per_s / 1e9:.2f} GB/s, "
+                             f"余量 {host_bytes_per_s / data_rate:.2f}x 低于 {min_headroom:g}x, "
+                             f"请降低 PRF / 采样点数 / 通道数 (或按实测结果调大 host_bytes_per_s)")
+
+        def headroom(r):
+            service_s = 1. / self.MAX_BUFFER_RATE_HZ + r * bytes_per_record / host_bytes_per_s
+            return r / prf_hz / service_s
+
+        # 候选: records_per_point 的全部约数中, 单个 Buffer 不超过上限的
+        candidates = [r for r in range(1, records_per_point + 1)
+                      if records_per_point % r == 0 and r * bytes_per_record <= self.MAX_BUFFER_BYTES]
+        if not candidates:
+            raise ValueError(f"单条 record {bytes_per_record} 字节, 无法装入 {self.MAX_BUFFER_BYTES} 字节的 Buffer")
+        safe = [r for r in candidates if headroom(r) >= min_headroom]
+        if not safe:
+            r = max(candidates)
+            raise ValueError(f"最大可用 records_per_buffer={r} 时 Buffer 频率 {prf_hz / r:.0f} Hz, "
+                             f"余量只有 {headroom(r):.2f}x (低于 {min_headroom:g}x), 请增大 records_per_point "
+                             f"或使用可以整除的值")
+        records_per_buffer = min(safe, key=lambda r: abs(np.log(prf_hz / r / target_buffer_rate_hz)))
+        buffer_rate_hz = prf_hz / records_per_buffer
+
+        bytes_per_buffer = records_per_buffer * bytes_per_record
+        buffer_period_ms = 1000. / buffer_rate_hz
+        # +1: 正在被主机处理的那个 Buffer 不能接收数据
+        buffer_count = max(self.MIN_BUFFER_COUNT, int(np.ceil(max_stall_ms / buffer_period_ms)) + 1)
+        dma_ram_bytes = buffer_count * bytes_per_buffer
+        if available_ram_bytes is not None:
+            budget = available_ram_bytes * ram_fraction
+            if dma_ram_bytes > budget:
+                raise ValueError(f"{buffer_count} 个 Buffer 共需 {dma_ram_bytes / 1024**2:.1f} MB, "
+                                 f"超过 DMA 内存预算 {budget / 1024**2:.1f} MB, 请减小 max_stall_ms 或 samples_per_record")
+
+        return {
+            "records_per_buffer": records_per_buffer,
+            "buffer_count": buffer_count,
+            "buffers_per_point": records_per_point // records_per_buffer,
+            "bytes_per_buffer": bytes_per_buffer,
+            "buffer_rate_hz": buffer_rate_hz,
+            "buffer_period_ms": buffer_period_ms,
+            "dma_ram_bytes": dma_ram_bytes,
+            "stall_cover_ms": (buffer_count - 1) * buffer_period_ms,
+            "headroom": headroom(records_per_buffer),
+        }
+
+    def plan_depth_gate(self, start_sample, stop_sample):
+        """
+        把深度窗 [start_sample, stop_sample) (相对触发的采样点序号) 换算成板卡设置:
+        触发延迟 (向下对齐到 TRIGGER_DELAY_ALIGNMENT) + 记录长度 (向上对齐到 SAMPLE_ALIGNMENT, 不小于 MIN_SAMPLES_PER_RECORD),
+        对齐多出来的采样点在主机端切掉 (见 gate_records)。
+        :return: dict (trigger_delay, samples_per_record, offset, length)
+        """
+        if not 0 <= start_sample < stop_sample:
+            raise ValueError(f"深度窗 [{start_sample}, {stop_sample}) 无效 (NPT 模式不支持预触发, 起点不能为负)")
+        delay = start_sample // self.TRIGGER_DELAY_ALIGNMENT * self.TRIGGER_DELAY_ALIGNMENT
+        needed = stop_sample - delay
+        samples = max(-(-needed // self.SAMPLE_ALIGNMENT) * self.SAMPLE_ALIGNMENT, self.MIN_SAMPLES_PER_RECORD)
+        return {"trigger_delay": delay, "samples_per_record": samples,
+                "offset": start_sample - delay, "length": stop_sample - start_sample}
+
+    def calibrate_depth_gate(self, samples_per_record=4096, records=256, acq_channel=None,
+                             threshold_sigma=6., margin_samples=64, timeout_ms=1000):
+        """
+        预览采集: 不加深度窗采 records 条 record 求平均, 用 find_signal_window 找出第一个通道中超过噪声的范围,
+        返回可以直接传给 prepare_acquisition(depth_gate=...) 的 (start_sample, stop_sample)。
+        需要激光正在出光 (有触发), 调用后需重新 prepare_acquisition。
+        """
+        self.prepare_acquisition(num_points=1, acq_channel=acq_channel, samples_per_record=samples_per_record,
+                                 records_per_buffer=16, buffer_count=4, records_per_point=records,
+                                 Average_Enable=True)
+        all_data, pos_mapping = [], []
+        self.start_capture()
+        try:
+            self.get_one_acquisition(all_data, pos_mapping, "", timeout_ms, Average_Enable=True)
+        finally:
+            self.stop_capture()
+        aline = all_data[0][0]
+        if not aline.any():
+            raise TimeoutError("深度窗标定没有采到数据, 请检查激光和触发")
+        window = find_signal_window(self.split_channels(aline)[0] / records, threshold_sigma, margin_samples)
+        if window is None:
+            raise RuntimeError(f"深度窗标定: 平均后的 A-line 中没有超过 {threshold_sigma} 倍噪声的信号")
+        start, stop = window
+        gate = self.plan_depth_gate(start, stop)
+        print(f"✅ [DAQ] 深度窗: 采样点 [{start}, {stop}) -> 触发延迟 {gate['trigger_delay']}, "
+              f"记录长度 {gate['samples_per_record']} (原 {samples_per_record}, 减少 {samples_per_record / gate['samples_per_record']:.1f}x)")
+        return window
+
+    def gate_records(self, data):
+        """
+        对最后一维为交织 record 的数组 (例如 Arena、累加器、stack_point 的结果) 切出深度窗内的采样点,
+        没有设置深度窗时原样返回。单通道时返回视图, 多通道时需要重新交织会复制。
+        展平的 Buffer (list 模式的 all_data) 要先用 stack_point 按 record 排好。
+        """
+        if self.gate is None:
+            return data
+        data = np.asarray(data)
+        interleaved = data.reshape(data.shape[:-1] + (self.samplesPerRecord, self.channelCount))
+        return interleaved[..., self.gate, :].reshape(data.shape[:-1] + (-1,))
+
+    def stack_point(self, point_bufs):
+        """
+        all_data 中一个点的 Buffer 列表 -> (record 数, recordLength) 矩阵。
+        逐点 / 后台线程的 list 模式每个 Buffer 是展平的一维数组, 先按 record 排好才能用 gate_records / split_channels
+        """
+        return np.vstack(point_bufs).reshape(-1, self.recordLength)
+
+    def prepare_acquisition(self,num_points:int,acq_channel=None, samples_per_record=4096,
+                             records_per_buffer=16,buffer_count=4, records_per_point=1024, preTriggerSamples=0,
+                             use_arena=False, Average_Enable=False, infinite_acquisition=False,
+                             enable_footers=False, hardware_average=False, depth_gate=None,
+                             robust_stats=False, trim_fraction=0.125, prf_hz=None, adma_mode="npt"):
         """
         分配 DMA 内存
+        :param acq_channel: 通道掩码, 例如 ats.CHANNEL_A | ats.CHANNEL_B (光声 + 光电二极管/参考通道), 默认 CHANNEL_A。
+                            多通道时 Buffer 内按 S0A, S0B, S1A, S1B ... 交织, 每条 record 占 samples_per_record * 通道数 个采样,
+                            平均 / Arena / 环形队列都直接按交织格式处理, 需要单通道数据时用 split_channels 取视图
+        :param use_arena: 是否一次性预分配整个扫描的结果数组 (见 _allocate_result_arena)
+        :param Average_Enable: 仅用于决定 Arena 的形状和类型, 需与 get_one_acquisition 的参数一致
+        :param infinite_acquisition: 不限制总 record 数 (后台 DMA 线程在位移台移动时也持续采集, 必须打开)
+        :param enable_footers: 打开 NPT record footer (触发时间戳 / record 序号 / AUX 输入电平),
+                               后台 DMA 线程会逐 Buffer 批量提取到 ring_footers。
+                               footer 写在每条 record 的末尾, 这几个采样点不参与累加和统计 (累加结果中为 0),
+                               深度窗 (没有设置时为整条 record) 也会把它们切掉, 见 signalLength
+        :param hardware_average: 优先在板卡 FPGA 上把每个点的 records_per_point 条 record 累加成 1 条
+                                 (configureRecordAverage), PCIe 传输和主机计算都减少 records_per_point 倍。
+                                 固件不支持或条件不满足时自动退回主机累加, 两种方式的结果形状和数值含义相同。
+                                 只适用于逐点采集 (get_one_acquisition / get_stream_acquisition)。
+                                 每个点会丢弃到位时正在平均的 Buffer, 总 record 数不再固定, 因此总是按无限采集装载 DMA
+        :param depth_gate: (start_sample, stop_sample) 只采集相对触发的这段时间窗 (可用 calibrate_depth_gate 标定)。
+                           板卡用触发延迟 + 缩短的记录长度只传回窗口附近的数据 (samples_per_record 参数被忽略),
+                           DMA / 累加都按对齐后的长度进行, 保存前用 gate_records 切出精确的窗口
+        :param robust_stats: 平均模式下同时计算逐像素的稳健统计 (截尾均值 A-line / SNR / 离群 record 数, 见 RecordStatistics),
+                             需要逐条 record, 因此不能与 FPGA 平均同时使用
+        :param trim_fraction: 截尾均值每端去掉的比例 (0.5 为近似中位数)
+        :param prf_hz: 激光重复频率, 用来推算每个点的预计采集时间 (见 _point_deadline); None 时只用实测的触发率
+        :param adma_mode: DMA 引擎
+                          "npt" -> 每个触发一条 record (默认)。每条 record 之后板卡要重新准备触发,
+                                   record 长度接近触发周期时会漏掉触发
+                          "ts"  -> Triggered Streaming: 第一个触发之后不间断地采集
+                          "cs"  -> Continuous Streaming: startCapture 后立即不间断地采集, 不等触发
+                          "ts" / "cs" 下连续波形按 samples_per_record 切成首尾相接的 "record", Buffer 的排布与 NPT 相同,
+                          只能逐 record 原样保存 (Arena / 后台线程可用)。切片与激光脉冲没有固定的相位关系
+                          ("cs" 不等触发, "ts" 只有第一段对齐, 之后随触发周期与切片长度之差漂移),
+                          因此不支持平均 (Average_Enable / FPGA 平均)、稳健统计、实时 MAP、footer 和深度窗
         """
+        if acq_channel is None:
+            acq_channel = self.ats.CHANNEL_A
+        mode_flags = {"npt": self.ats.ADMA_NPT, "ts": self.ats.ADMA_TRIGGERED_STREAMING,
+                      "cs": self.ats.ADMA_CONTINUOUS_MODE}
+        if adma_mode not in mode_flags:
+            raise ValueError(f"未知的 adma_mode: {adma_mode} (可选 {list(mode_flags)})")
+        if adma_mode != "npt" and (enable_footers or depth_gate is not None):
+            raise ValueError(f'adma_mode="{adma_mode}" 是连续波形, 没有 record footer, 也不能按 record 设深度窗')
+        if adma_mode != "npt" and (Average_Enable or robust_stats):
+            raise ValueError(f'adma_mode="{adma_mode}" 的切片与激光脉冲不对齐, 不能做平均 / 稳健统计, 请用 Average_Enable=False')
+        self.adma_mode = adma_mode
+        if depth_gate is not None:
+            gate = self.plan_depth_gate(*depth_gate)
+            samples_per_record = gate["samples_per_record"]
+            self.triggerDelay = gate["trigger_delay"]
+            self.gate = slice(gate["offset"], gate["offset"] + gate["length"])
+        else:
+            self.triggerDelay = 0
+            self.gate = None
+        self.gateStart = self.triggerDelay + (self.gate.start if self.gate else 0) # 保存的第一个采样点相对触发的序号
+        self.board.setTriggerDelay(self.triggerDelay)
+        self.hw_average = hardware_average and self._enable_record_average(
+            acq_channel, samples_per_record, records_per_point, Average_Enable, enable_footers, robust_stats)
+        if self.hw_average:
+            # FPGA 每个点只输出 1 条 32 bit 求和的 record, 一个 Buffer 正好是一个点
+            records_per_buffer = 1
+        elif records_per_point % records_per_buffer:
+            # 原来用整除得到 buffersPerPoint, 多出的 record 会被悄悄丢掉
+            raise ValueError(f"records_per_point={records_per_point} 不是 records_per_buffer={records_per_buffer} "
+                             f"的整数倍, 可用 plan_buffer_geometry 自动选择")
         self.samplesPerRecord = samples_per_record
         self.recordsPerBuffer = records_per_buffer
         self.bufferCount = buffer_count
         self.recordsPerPoint = records_per_point
         self.preTriggerSamples = preTriggerSamples
-        self.buffersPerPoint=int(records_per_point//records_per_buffer)
+        self.buffersPerPoint = 1 if self.hw_average else int(records_per_point//records_per_buffer)
         
+        # 通道掩码与通道数 (与 ATS9373_NPT 示例相同的计数方法)
+        self.channels = acq_channel
+        self.channelList = [c for c in self.ats.channels if c & acq_channel == c]
+        self.channelCount = len(self.channelList)
+        # 每条 record 在 Buffer 中占用的采样数 (全部通道交织在一起)
+        self.recordLength = self.samplesPerRecord * self.channelCount
+
         # 计算大小
         _, bitsPerSample = self.board.getChannelInfo()
-        bytesPerSample = (bitsPerSample.value + 7) // 8
-        self.bytesPerBuffer = bytesPerSample * self.samplesPerRecord * self.recordsPerBuffer
+        codeBytes = (bitsPerSample.value + 7) // 8
+        # footer 覆盖的采样按整个交织采样 (全部通道) 向上取整, 之前的 signalLength 个才是信号
+        footer_frames = -(-self.NPT_FOOTER_BYTES // (codeBytes * self.channelCount)) if enable_footers else 0
+        self.signalLength = self.recordLength - footer_frames * self.channelCount
+        if footer_frames:
+            signal_stop = self.samplesPerRecord - footer_frames
+            if self.gate is None:
+                self.gate = slice(0, signal_stop)
+            elif self.gate.stop > signal_stop:
+                print(f"⚠️ [DAQ] 深度窗末尾 {self.gate.stop - signal_stop} 个采样点被 footer 覆盖, 已切掉")
+                self.gate = slice(self.gate.start, signal_stop)
+        # FPGA 平均时传回的是 32 bit 求和
+        bytesPerSample = 4 if self.hw_average else codeBytes
+        self.bytesPerBuffer = bytesPerSample * self.recordLength * self.recordsPerBuffer
         
-        # 通道掩码 (只采 A 通道示例)
-        self.channels = acq_channel
-        
-        # 分配 Buffer
-        sample_type = ctypes.c_uint8 if bytesPerSample == 1 else ctypes.c_uint16
-        self.buffers = []
-        for i in range(buffer_count):
-            self.buffers.append(ats.DMABuffer(self.board.handle, sample_type, self.bytesPerBuffer))
+        # 分配 Buffer (从池里借出)
+        sample_type = {1: ctypes.c_uint8, 2: ctypes.c_uint16, 4: ctypes.c_uint32}[bytesPerSample]
+        self._lease_buffers(buffer_count, {1: np.uint8, 2: np.uint16, 4: np.uint32}[bytesPerSample])
             
         # 提交 Buffer 给驱动
-        self.board.setRecordSize(self.preTriggerSamples, self.samplesPerRecord)
+        if adma_mode == "npt":
+            self.board.setRecordSize(self.preTriggerSamples, self.samplesPerRecord)
         
         # 无限采集模式设置 (recordsPerAcquisition 设置为 infinite 0x7FFFFFFF)
         # 也可以设置为足够大的数
-        self.board.beforeAsyncRead(self.channels,
+        # FPGA 平均每个点要丢弃移动中的 Buffer (见 _discard_moving_buffers), 有限的总数会在最后几个点前采完
+        infinite_acquisition = infinite_acquisition or self.hw_average
+        recordsPerAcquisition = 0x7FFFFFFF if infinite_acquisition else self.recordsPerBuffer * self.buffersPerPoint * num_points
+        adma_flags = self.ats.ADMA_EXTERNAL_STARTCAPTURE | mode_flags[adma_mode] | self.ats.ADMA_FIFO_ONLY_STREAMING
+        if self.channelCount > 1:
+            adma_flags |= self.ats.ADMA_INTERLEAVE_SAMPLES # 明确要求按采样点交织 (S0A, S0B, ...)
+        self.bytesPerRecord = bytesPerSample * self.recordLength
+        self.footers_enabled = enable_footers
+        if enable_footers:
+            adma_flags |= self.ats.ADMA_ENABLE_RECORD_FOOTERS
+            # 预分配 footer 数组, 每个 Buffer 复用 (numpy 视图与 ctypes 数组共享内存)
+            self.footers_ctypes = (self.ats.NPTFooter * self.recordsPerBuffer)()
+            self.footers = np.frombuffer(self.footers_ctypes, dtype=NPT_FOOTER_DTYPE)
+        if adma_mode == "npt":
+            self._adma_args = (self.channels, self.samplesPerRecord, self.recordsPerBuffer, adma_flags) # 供 rearm_dma 使用
+        else:
+            # TS / CS: 驱动只认每个 Buffer 的采样点数, recordsPerBuffer 必须为 1, recordsPerAcquisition 被忽略
+            self._adma_args = (self.channels, self.samplesPerRecord * self.recordsPerBuffer, 1, adma_flags)
+            recordsPerAcquisition = 0x7FFFFFFF
+        channels, samples, records_per_buffer, _ = self._adma_args
+        self.board.beforeAsyncRead(channels,
                                    0,
-                                   self.samplesPerRecord,
-                                   self.recordsPerBuffer,
-                                   self.recordsPerPoint * num_points, 
-                                   ats.ADMA_EXTERNAL_STARTCAPTURE | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
+                                   samples,
+                                   records_per_buffer,
+                                   recordsPerAcquisition, 
+                                   adma_flags)
 
         for buf in self.buffers:
             self.board.postAsyncBuffer(buf.addr, buf.size_bytes)
 
         self.buffer_idx = 0 # 循环索引    
+        self._reset_acq_stats(prf_hz)
+
+        # 平均模式的流式累加器
+        self._init_accumulator(codeBytes)
+
+        self.record_stats = RecordStatistics(num_points, self.recordLength, trim_fraction, signal_length=self.signalLength,
+                                             channel_count=self.channelCount) if robust_stats else None
+
+        # 预分配结果内存 (可选)
+        self.result_arena = None
+        self.arena_idx = 0
+        if use_arena:
+            self._allocate_result_arena(num_points, sample_type, Average_Enable)
+
+    def _lease_buffers(self, buffer_count, dtype):
+        """归还上一次扫描的 Buffer, 再从池里借出 buffer_count 个 bytesPerBuffer 大小的 Buffer (同样大小的扫描不会重新分配)"""
+        self.release_buffers()
+        self._buffer_lease = self.buffer_pool.lease(buffer_count, self.bytesPerBuffer, dtype)
+        self.buffers = self._buffer_lease.buffers
+
+    def release_buffers(self):
+        """把 DMA Buffer 还给池 (板卡必须已经 abort, 不会再往里写), 页锁定内存留给下一次扫描"""
+        if self._buffer_lease is not None:
+            self._buffer_lease.release()
+            self._buffer_lease = None
+        self.buffers = []
+
+    def close(self):
+        """停止采集并释放池中全部页锁定内存 (程序结束或不再使用这块板卡时调用)"""
+        if self.is_capturing:
+            self.stop_capture()
+        self.release_buffers()
+        self.buffer_pool.close()
+
+    def _enable_record_average(self, acq_channel, samples_per_record, records_per_point, Average_Enable, enable_footers,
+                               robust_stats=False):
+        """尝试打开 FPGA record 平均, 条件不满足或固件不支持时返回 False (退回主机累加)"""
+        if not Average_Enable:
+            reason = "需要 Average_Enable=True"
+        elif enable_footers:
+            reason = "FPGA 平均后没有逐 record 的 footer"
+        elif robust_stats:
+            reason = "稳健统计需要逐条 record"
+        elif acq_channel not in self.ats.channels:
+            reason = "只支持单通道"
+        elif 0xFFFF * records_per_point >= 2**32:
+            reason = f"{records_per_point} 条 record 的 32 bit 求和可能溢出"
+        else:
+            try:
+                self.board.configureRecordAverage(self.ats.CRA_MODE_ENABLE_FPGA_AVE, samples_per_record,
+                                                  records_per_point, self.ats.CRA_OPTION_UNSIGNED)
+                print(f"✅ [DAQ] 已启用 FPGA record 平均 ({records_per_point} 条/点)")
+                return True
+            except Exception as e:
+                reason = f"板卡不支持: {e}"
+        print(f"⚠️ [DAQ] FPGA 平均不可用 ({reason}), 改用主机累加")
+        return False
+
+    def _init_accumulator(self, bytesPerSample):
+        """
+        为平均模式分配常驻的单点累加器 (只有 recordLength 大小)。
+        多通道时累加器同样是交织的, 按 record 求和时各通道互不干扰, 相当于每个通道各自做流式平均。
+        每个点累加 recordsPerPoint 条 record (FPGA 平均时由板卡完成, 主机只需累加 1 条),
+        若最坏情况 (全部满码) 会超过 uint32 上限, 则自动改用 uint64。
+        """
+        max_code = (1 << (8 * bytesPerSample)) - 1
+        records_summed = self.recordsPerPoint
+        self.acc_dtype = np.uint32 if max_code * records_summed < 2**32 else np.uint64
+        self.accumulator = np.zeros(self.recordLength, dtype=self.acc_dtype)
+        self._acc_partial = np.zeros(self.recordLength, dtype=self.acc_dtype) # 单个 Buffer 的归约结果
+
+    def _allocate_result_arena(self, num_points, sample_type, Average_Enable):
+        """
+        一次性申请整个扫描的连续结果数组 (点数, record数 或 1, 采样点数)。
+        DMA Buffer 完成后直接拷贝到对应的槽位, 省掉每个 Buffer 的 np.copy、
+        嵌套列表以及扫描结束时 np.vstack 的整块复制 (原来 "内存爆炸" 的来源)。
+        """
+        if Average_Enable:
+            # 平均模式: 每个点只保留一条求和 A-line (与累加器同类型)
+            shape = (num_points, 1, self.recordLength)
+            dtype = self.acc_dtype
+        else:
+            shape = (num_points, self.buffersPerPoint * self.recordsPerBuffer, self.recordLength)
+            dtype = np.uint8 if sample_type == ctypes.c_uint8 else np.uint16
+
+        self.arena_average = Average_Enable
+        # np.zeros 依赖操作系统按页懒分配, 真正写入时才占用物理内存
+        self.result_arena = np.zeros(shape, dtype=dtype)
+        print(f"✅ [DAQ] 结果 Arena 已分配: {shape}, {self.result_arena.nbytes / 1024**3:.2f} GB")
+
+    def get_arena_result(self):
+        """返回已采集部分的 Arena 视图 (不复制), 维度 (已采点数, record数 或 1, 采样点数)"""
+        return self.result_arena[:self.arena_idx]
+
+    def split_channels(self, data):
+        """
+        把最后一维为交织 record (recordLength) 的数组拆成各通道的视图 (不复制, 步长为通道数)。
+        适用于 DMA Buffer、Arena、环形队列、累加器等任何按 record 排列的数据。
+        :return: 与 self.channelList 顺序一致的列表, 每个元素的最后一维为 samplesPerRecord
+        """
+        data = np.asarray(data)
+        # 采样点数由数组推算, 切过深度窗 (gate_records) 的数据同样适用
+        interleaved = data.reshape(data.shape[:-1] + (-1, self.channelCount))
+        return [interleaved[..., c] for c in range(self.channelCount)]
         
 
+    # =====================================================
+    #  板载 FFT 模式 (ADMA_DSP)
+    # =====================================================
+
+    def prepare_fft_acquisition(self, num_points:int, acq_channel=None, samples_per_record=2048,
+                                records_per_buffer=16, buffer_count=4, records_per_point=256,
+                                output_format=None, window_type=None,
+                                background=None, bands_hz=(), enable_footers=True, infinite_acquisition=False,
+                                prf_hz=None):
+        """
+        让板卡 FPGA 对每条 record 做加窗 FFT, DMA 只传回功率谱 (fftLength/2 个频点), 主机不再接触原始波形。
+        每个点把 records_per_point 条频谱累加成平均谱, 再压缩成少量特征 (总功率 / 峰值频率 / 谱质心 / 频带功率),
+        见 get_fft_acquisition。
+        :param acq_channel: 板载 FFT 只支持单通道, 默认 CHANNEL_A
+        :param output_format: ats.FFT_OUTPUT_FORMAT_*, 默认 FLOAT_AMP2, 只支持幅度平方 (AMP2) 和对数 (LOG) 格式。
+                              对数格式下平均的是 dB 值, 频带功率等特征不再是线性功率, 只适合看峰位
+        :param window_type: ats.DSP_WINDOW_*, 默认 HANNING, 补零部分 (fftLength - samples_per_record) 的窗为 0
+        :param background: 背景 record (samples_per_record 个码值, 例如无激光时的平均 A-line), 在 FFT 前由 FPGA 扣除
+        :param bands_hz: [(f_lo, f_hi), ...] 需要积分的频带, 例如换能器的通带
+        :param enable_footers: 打开 NPT footer, 用 record_number 检查是否丢失 record (计入 acq_stats["lost_records"])
+        :param prf_hz: 激光重复频率 (同 prepare_acquisition)
+        """
+        ats = self.ats
+        acq_channel = ats.CHANNEL_A if acq_channel is None else acq_channel
+        output_format = ats.FFT_OUTPUT_FORMAT_FLOAT_AMP2 if output_format is None else output_format
+        window_type = ats.DSP_WINDOW_HANNING if window_type is None else window_type
+        log_formats = (ats.FFT_OUTPUT_FORMAT_U8_LOG, ats.FFT_OUTPUT_FORMAT_U16_LOG, ats.FFT_OUTPUT_FORMAT_FLOAT_LOG)
+        dtypes = {ats.FFT_OUTPUT_FORMAT_U8_LOG: np.uint8, ats.FFT_OUTPUT_FORMAT_U8_AMP2: np.uint8,
+                  ats.FFT_OUTPUT_FORMAT_U16_LOG: np.uint16, ats.FFT_OUTPUT_FORMAT_U16_AMP2: np.uint16,
+                  ats.FFT_OUTPUT_FORMAT_U32: np.uint32,
+                  ats.FFT_OUTPUT_FORMAT_FLOAT_LOG: np.float32, ats.FFT_OUTPUT_FORMAT_FLOAT_AMP2: np.float32}
+        if output_format not in dtypes:
+            raise ValueError(f"不支持的 FFT 输出格式 0x{output_format:X} (只支持 AMP2 / LOG)")
+        if acq_channel not in self.ats.channels:
+            raise ValueError("板载 FFT 只支持单通道")
+        if records_per_point % records_per_buffer:
+            raise ValueError(f"records_per_point={records_per_point} 不是 records_per_buffer={records_per_buffer} 的整数倍")
+
+        self.adma_mode = "npt"
+        self.fft_module = self.board.dspGetModules()[0]
+        module_id, _, _, max_length = self.fft_module.dspGetInfo()
+        if module_id != self.ats.DSP_MODULE_FFT:
+            raise RuntimeError("板卡的 DSP 模块不是 FFT, 请确认已安装板载 FFT 固件")
+        fft_length = 1
+        while fft_length < samples_per_record:
+            fft_length *= 2
+        if fft_length > max_length:
+            raise ValueError(f"FFT 长度 {fft_length} 超过板载 FFT 上限 {max_length}")
+
+        self.channels = acq_channel
+        self.channelList = [acq_channel]
+        self.channelCount = 1
+        self.samplesPerRecord = samples_per_record
+        self.recordLength = samples_per_record
+        self.recordsPerBuffer = records_per_buffer
+        self.bufferCount = buffer_count
+        self.recordsPerPoint = records_per_point
+        self.buffersPerPoint = records_per_point // records_per_buffer
+        self.fftLength = fft_length
+        self.fft_bins = fft_length // 2
+        self.fft_dtype = np.dtype(dtypes[output_format])
+        self.fft_log_output = output_format in log_formats
+        self.fft_freqs_hz = np.arange(self.fft_bins) * self.samplesPerSec / fft_length
+
+        # 窗函数 (后面补零到 FFT 长度) 与背景扣除
+        self.fft_window = self.ats.dspGenerateWindowFunction(window_type, samples_per_record,
+                                                             fft_length - samples_per_record)
+        self.fft_module.fftSetWindowFunction(fft_length, self.fft_window.ctypes.data_as(ctypes.POINTER(ctypes.c_float)), None)
+        self.fft_background = np.zeros(samples_per_record, dtype=np.int16)
+        if background is not None:
+            self.fft_background[:] = np.rint(background)
+        self.fft_module.fftBackgroundSubtractionSetRecordS16(
+            self.fft_background.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)), samples_per_record)
+        self.fft_module.fftBackgroundSubtractionSetEnabled(background is not None)
+
+        self.board.setRecordSize(0, samples_per_record)
+        footer = self.ats.FFT_FOOTER_NPT if enable_footers else self.ats.FFT_FOOTER_NONE
+        # 每条输出 record 的字节数 (频谱 + footer), 由驱动给出
+        self.bytesPerRecord = self.fft_module.fftSetup(acq_channel, samples_per_record, fft_length,
+                                                       output_format, footer, 0)
+        self.bytesPerBuffer = self.bytesPerRecord * records_per_buffer
+
+        # Buffer 按字节分配, 频谱通过带步长的视图读取 (跳过每条 record 末尾的 footer)
+        self._lease_buffers(buffer_count, np.uint8)
+        self.footers_enabled = enable_footers
+        if enable_footers:
+            self.footers_ctypes = (self.ats.NPTFooter * records_per_buffer)()
+            self.footers = np.frombuffer(self.footers_ctypes, dtype=NPT_FOOTER_DTYPE)
+        recordsPerAcquisition = 0x7FFFFFFF if infinite_acquisition else records_per_buffer * self.buffersPerPoint * num_points
+        self._adma_args = (acq_channel, self.bytesPerRecord, records_per_buffer,
+                           self.ats.ADMA_EXTERNAL_STARTCAPTURE | self.ats.ADMA_NPT | self.ats.ADMA_DSP)
+        self.board.beforeAsyncRead(acq_channel, 0, self.bytesPerRecord, records_per_buffer, recordsPerAcquisition,
+                                   self._adma_args[3])
+        for buf in self.buffers:
+            self.board.postAsyncBuffer(buf.addr, buf.size_bytes)
+        self.buffer_idx = 0
+        self.fft_mode = True
+        self._reset_acq_stats(prf_hz)
+
+        # 单点频谱累加器 + 整个扫描的平均谱 / 特征 (频谱只有 fftLength/2 个点, 直接预分配)
+        self.fft_accumulator = np.zeros(self.fft_bins, dtype=np.float64)
+        self._fft_partial = np.zeros(self.fft_bins, dtype=np.float64)
+        self.fft_bands_hz = list(bands_hz)
+        self.feature_names = spectral_feature_names(self.fft_bands_hz)
+        self.fft_spectra = np.zeros((num_points, self.fft_bins), dtype=np.float32)
+        self.fft_features = np.zeros((num_points, len(self.feature_names)), dtype=np.float64)
+        self.fft_idx = 0
+        print(f"✅ [DAQ] 板载 FFT: {samples_per_record} -> {fft_length} 点, {self.fft_bins} 个频点, "
+              f"{self.bytesPerRecord} 字节/record (原始数据 {2 * samples_per_record} 字节)")
+
+    def _spectra_view(self, buffer):
+        """一个 DMA Buffer 中全部 record 的频谱视图 (recordsPerBuffer, fft_bins), 不复制"""
+        return np.ndarray((self.recordsPerBuffer, self.fft_bins), dtype=self.fft_dtype, buffer=buffer.buffer,
+                          strides=(self.bytesPerRecord, self.fft_dtype.itemsize))
+
+    def get_fft_acquisition(self, all_data, pos_mapping, curr_pos_str, timeout_ms):
+        """
+        采集一个点: 把 buffersPerPoint 个 Buffer 的频谱逐个累加, 得到平均谱 (fft_spectra 的一行) 和特征 (fft_features 的一行)。
+        all_data 中只保存平均谱的视图, 与其他采集函数一样 len(all_data) 就是已采点数。
+        """
+        if self.fft_idx >= self.fft_spectra.shape[0]:
+            raise RuntimeError(f"FFT 结果已满 ({self.fft_spectra.shape[0]} 个点), 请检查 num_points")
+        spectrum = self.fft_spectra[self.fft_idx]
+        ok = self._acquire_with_recovery(lambda: self._accumulate_fft_point(spectrum, timeout_ms), len(all_data))
+        if ok:
+            self.fft_features[self.fft_idx] = spectral_features(spectrum, self.fft_freqs_hz, self.fft_bands_hz)
+        else:
+            spectrum.fill(0)
+        self.fft_idx += 1
+        all_data.append([spectrum])
+        self._store_pos(pos_mapping, len(all_data) - 1, curr_pos_str)
+
+    def _accumulate_fft_point(self, spectrum, timeout_ms):
+        """把一个点的 buffersPerPoint 个 Buffer 的频谱累加并求平均, 写入 spectrum"""
+        acc = self.fft_accumulator
+        acc.fill(0)
+        deadline = self._point_deadline(timeout_ms)
+        for k in range(self.buffersPerPoint):
+            buffer = self._wait_next_buffer(deadline, k)
+            np.add.reduce(self._spectra_view(buffer), axis=0, dtype=np.float64, out=self._fft_partial)
+            if self.footers_enabled:
+                self.ats.extractFFTNPTFooters(buffer.addr, self.bytesPerRecord, self.bytesPerBuffer,
+                                              self.footers_ctypes, self.recordsPerBuffer)
+                self._check_record_numbers(self.footers)
+            self._repost_buffer(buffer)
+            np.add(acc, self._fft_partial, out=acc)
+        np.divide(acc, self.recordsPerPoint, out=spectrum, casting="unsafe")
+
+    def get_fft_result(self):
+        """返回已采集部分的 (平均谱, 特征) 视图, 维度 (点数, fft_bins) 和 (点数, len(feature_names))"""
+        return self.fft_spectra[:self.fft_idx], self.fft_features[:self.fft_idx]
+
     def start_capture(self):
         self.board.startCapture()
         self.is_capturing = True
 
+    @staticmethod
+    def _store_pos(pos_mapping, point, curr_pos):
+        """
+        记录第 point 个点的位置。pos_mapping 为预分配的 (点数, 3) int 数组时直接写入第 point 行 (curr_pos 为 (x, y, z)),
+        为列表时照旧 append (curr_pos 可以是 "X,Y,Z" 字符串)。
+        """
+        if isinstance(pos_mapping, np.ndarray):
+            pos_mapping[point] = curr_pos
+        else:
+            pos_mapping.append(curr_pos)
+
     def get_one_acquisition(self, all_data, pos_mapping, curr_pos_str, timeout_ms, Average_Enable=False):
+        acquire, finish = self._begin_point(timeout_ms, Average_Enable)
+        ok = self._acquire_with_recovery(acquire, len(all_data))
+        all_data.append(finish(ok))
+        # 失败的点不更新实时 MAP (保持 NaN)
+        self._map_point(all_data[-1] if ok else [], Average_Enable)
+        self._store_pos(pos_mapping, len(all_data) - 1, curr_pos_str)
+
+    def _begin_point(self, timeout_ms, Average_Enable):
+        """
+        准备一个点的逐点采集, 返回 (acquire, finish):
+          acquire()    采集一次, 失败时抛出 AcquisitionError (可重复调用, 每次都从头写)
+          finish(ok)   返回这个点存入 all_data 的 Buffer 列表; ok=False 时先填 0, 保持每个点的形状一致
+        重试 / 重新装载 DMA 由调用者负责 (单板卡为 _acquire_with_recovery, 多板卡见 AlazarMultiBoardSystem)
+        FPGA 平均时每次采集前先丢弃到位之前完成的和到位时正在平均的 Buffer (见 _discard_moving_buffers)。
+        """
+        acquire, finish = self._point_steps(timeout_ms, Average_Enable)
+        if not self.hw_average:
+            return acquire, finish
+        def acquire_settled():
+            self._discard_moving_buffers(timeout_ms)
+            acquire()
+        return acquire_settled, finish
+
+    def _discard_moving_buffers(self, timeout_ms):
+        """
+        FPGA 平均的逐点采集: 一个 Buffer 就是一整个点, 位移台移动期间板卡照常在平均。
+        到位之前已经完成的 Buffer 立即取出丢弃, 到位时正在平均的那个 Buffer (大部分 record 是移动中采的)
+        等它完成后也丢弃, 与 get_stream_acquisition 从 stream_head + 1 开始相同 (每个点多等一个点的采集时间)。
+        丢弃的 record 同时计入 records 和 discarded_records。失败时抛出 AcquisitionError。
+        """
+        records = self.recordsPerBuffer * self.recordsPerPoint
+        for _ in range(self.bufferCount):
+            buffer = self.buffers[self.buffer_idx % self.bufferCount]
+            try:
+                self._wait_until(buffer, time.perf_counter()) # 只取已经完成的, 最多等 1 ms
+            except Exception as e:
+                kind = classify_dma_error(e)
+                if kind == "timeout":
+                    break # 这一个就是到位时正在平均的
+                self.acq_stats[kind + "s"] += 1
+                raise AcquisitionError(kind, f"Buffer #{self.buffer_idx}: {e}") from e
+            self.acq_stats["buffers"] += 1
+            self.acq_stats["records"] += records
+            self.acq_stats["discarded_records"] += records
+            self._rate_buffers += 1 # 触发率按序号计 record 数, 丢弃的 Buffer 也算
+            self._repost_buffer(buffer)
+        buffer = self._wait_next_buffer(self._point_deadline(timeout_ms))
+        self.acq_stats["discarded_records"] += records
+        self._repost_buffer(buffer)
+
+    def _point_steps(self, timeout_ms, Average_Enable):
+        """_begin_point 的 (acquire, finish), 不含 FPGA 平均的丢弃"""
+        self._check_average_mode(Average_Enable)
+        if self.result_arena is not None:
+            return self._arena_point(timeout_ms, Average_Enable)
+        if Average_Enable:
+            # 流式累加: 每个 Buffer 完成后立即归约进累加器并归还给板卡,
+            # 单点内存从 records×samples 降到 samples
+            def finish(ok):
+                if not ok:
+                    self.accumulator.fill(0)
+                    self._skip_stats_point()
+                # 存入结果，不进行类型转换，留给最后处理
+                return [self.accumulator.copy()]
+            return (lambda: self._accumulate_point(self.accumulator, timeout_ms)), finish
+
         pixel_data_buffers = []
-        sub_timeout = int(timeout_ms / self.buffersPerPoint)
-        
-        for _ in range(self.buffersPerPoint):
-            data = self._fetch_next_buffer(sub_timeout)
-            if data is not None:
-                pixel_data_buffers.append(data)
-        
-        if Average_Enable and len(pixel_data_buffers) > 0:
-            # --- 高性能简化操作 ---，1. 直接拼接原始 Buffer (不做 reshape)
-            combined_raw = np.concatenate(pixel_data_buffers)
-            
-            # 2. 仅进行整数求和 (dtype 使用 uint32 防止溢出)，这比 np.mean 快得多，因为不涉及浮点运算和除法
-            summed_data = np.sum(combined_raw.reshape(-1, self.samplesPerRecord), 
-                                 axis=0, dtype=np.uint32)
-            
-            # 3. 存入结果，不进行类型转换，留给最后处理
-            all_data.append([summed_data])
+        def fetch_point():
+            deadline = self._point_deadline(timeout_ms)
+            pixel_data_buffers[:] = [self._fetch_next_buffer(deadline, k) for k in range(self.buffersPerPoint)]
+        def finish(ok):
+            if not ok:
+                return [np.zeros_like(self.buffers[0].buffer) for _ in range(self.buffersPerPoint)]
+            return pixel_data_buffers
+        return fetch_point, finish
+
+    def _check_average_mode(self, Average_Enable):
+        """TS / CS 的切片与激光脉冲不对齐, 平均没有意义 (见 prepare_acquisition 的 adma_mode)"""
+        if Average_Enable and self.adma_mode != "npt":
+            raise ValueError(f'adma_mode="{self.adma_mode}" 不能做平均, 请用 Average_Enable=False')
+
+    def _skip_stats_point(self):
+        """失败的点也要推进 record_stats 的像素序号 (每次尝试只 start_point, 没有 finish_point), 否则之后的统计整体错位"""
+        if self.record_stats is not None:
+            self.record_stats.skip_point()
+
+    # =====================================================
+    #  DMA 异常统计与恢复
+    # =====================================================
+
+    def _reset_acq_stats(self, prf_hz=None):
+        """
+        acq_stats: 本次采集的 DMA 计数, 用 get_acquisition_stats 读取
+          points               逐点采集成功的点数
+          buffers / records    正常完成的 Buffer 数和其中的 record 数 (FPGA 平均时按触发数计)
+          discarded_records    已经收到、随后被丢弃的 record 数 (失败的采集尝试, 以及 FPGA 平均逐点采集时移动中的 Buffer)
+          timeouts / overflows / errors  等待 Buffer 失败的次数 (按 AcquisitionError.kind 分类)
+          rearms               重新装载 DMA 的次数
+          footer_gaps / lost_records     footer 的 record_number 不连续的次数和缺失的 record 数 (打开 footer 时)
+          retried_points       失败后重试过的点数
+          failed_points        重试仍失败、已填 0 的点的序号
+          stream_breaks        后台线程重新装载 DMA 时的 Buffer 序号 (序号两侧的数据在时间上不连续)
+          lag_warnings         Buffer 超过预计完成时间仍未完成的点数 (触发变慢或丢失的早期迹象)
+        """
+        self.acq_stats = {"points": 0, "buffers": 0, "records": 0, "discarded_records": 0, "timeouts": 0, "overflows": 0, "errors": 0, "rearms": 0,
+                          "footer_gaps": 0, "lost_records": 0, "retried_points": 0,
+                          "failed_points": [], "stream_breaks": [], "lag_warnings": 0}
+        self._next_record = 0
+        self.nominal_prf_hz = prf_hz
+        self.trigger_rate_hz = None
+        self._point_start = time.perf_counter()
+        self._rate_window = collections.deque(maxlen=self.TRIGGER_RATE_WINDOW)
+        self._rate_buffers = 0
+        self._consecutive_failures = 0
+
+    def get_acquisition_stats(self):
+        """
+        返回 acq_stats 的副本, 并附上 records_expected = points x records_per_point 和实测的 trigger_rate_hz。
+        逐点采集时应有 records - discarded_records == records_expected, 不相等说明有 Buffer 被漏计或重复使用;
+        后台线程模式下 records 还包括位移台移动期间的 record, 只会更多。
+        """
+        stats = dict(self.acq_stats)
+        stats["records_expected"] = stats["points"] * self.recordsPerPoint
+        stats["trigger_rate_hz"] = self.trigger_rate_hz
+        stats["failed_points"] = list(stats["failed_points"])
+        stats["stream_breaks"] = list(stats["stream_breaks"])
+        return stats
+
+    def _kept_records(self):
+        """已收到且没有被丢弃的 record 数"""
+        return self.acq_stats["records"] - self.acq_stats["discarded_records"]
+
+    def _check_record_numbers(self, footers):
+        """用 footer 的 record_number 检查与上一个 Buffer 是否连续 (板卡 FIFO 溢出前丢掉的 record 会留下缺口)"""
+        first = int(footers["record_number"][0])
+        if first > self._next_record:
+            self.acq_stats["footer_gaps"] += 1
+            self.acq_stats["lost_records"] += first - self._next_record
+        self._next_record = int(footers["record_number"][-1]) + 1
+
+    def rearm_dma(self, start=True):
+        """
+        板卡出错后重新装载 DMA: abortAsyncRead (FFT 模式为 dspAbortCapture) -> beforeAsyncRead (与 prepare 时相同的参数,
+        record 总数改为无限, 已经采了多少无从得知) -> 重新提交全部 Buffer -> startCapture。
+        Buffer、FPGA 平均和 FFT 的配置都保持不变, record_number / 时间戳从 0 重新计数。
+        :param start: False 时不调用 startCapture (主从系统由主板卡统一启动)
+        """
+        if self.fft_mode:
+            self.board.dspAbortCapture()
         else:
-            all_data.append(pixel_data_buffers)
-            
-        pos_mapping.append(curr_pos_str)
+            self.board.abortAsyncRead()
+        channels, samples_per_record, records_per_buffer, flags = self._adma_args
+        self.board.beforeAsyncRead(channels, 0, samples_per_record, records_per_buffer, 0x7FFFFFFF, flags)
+        for buf in self.buffers:
+            self.board.postAsyncBuffer(buf.addr, buf.size_bytes)
+        self.buffer_idx = 0
+        self._next_record = 0
+        self._rate_window.clear() # 重新装载前后的采集在时间上不连续
+        if start:
+            self.board.startCapture()
+        self.acq_stats["rearms"] += 1
 
-        
+    def _acquire_with_recovery(self, acquire, point, recover=None):
+        """
+        执行一个点的采集 acquire(), 出现 AcquisitionError 时重新装载 DMA (或调用 recover) 并从这个点的开头重采,
+        最多重试 max_point_retries 次。仍然失败时把点记入 failed_points 并返回 False (由调用者填 0),
+        扫描继续, 后面的像素不会错位; 连续 max_failed_points 个点失败时抛出最后一个错误。
+        :return: 是否成功
+        """
+        for attempt in range(self.max_point_retries + 1):
+            kept_before = self._kept_records()
+            try:
+                acquire()
+                self.acq_stats["points"] += 1
+                self._consecutive_failures = 0
+                return True
+            except AcquisitionError as e:
+                error = e
+                # 这次尝试收到、还没有计入丢弃的 record (FPGA 平均到位前丢弃的已经计过)
+                self.acq_stats["discarded_records"] += self._kept_records() - kept_before
+                print(f"⚠️ [DAQ] 第 {point} 个点采集失败 ({e.kind}, 第 {attempt + 1} 次): {e}")
+                if attempt == 0:
+                    self.acq_stats["retried_points"] += 1
+                # 溢出后板卡已停止; 超时时可能卡在半个 Buffer 上, 同样从干净的状态重新开始
+                (recover or self.rearm_dma)()
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.max_failed_points:
+            raise error
+        self.acq_stats["failed_points"].append(point)
+        print(f"❌ [DAQ] 第 {point} 个点重试 {self.max_point_retries} 次仍失败, 填 0 后继续")
+        return False
+
+    # =====================================================
+    #  实时 MAP 图像
+    # =====================================================
+
+    def enable_live_map(self, scan_w, scan_h, envelope=None):
+        """
+        在采集过程中逐点计算 MAP 特征并填入二维图像 (在 prepare_acquisition 之后调用),
+        扫描结束时 live_map 里就是完整分辨率的图像, 不需要再遍历全部 A-line。
+        像素按 get_expected_trajectory 的蛇形顺序编号, 第 k 个采集的点填到 snake_pixel_position(k) 处。
+          live_map["map"]         去直流后的最大 |信号| (码值, 与 PAM_Reconstruction.m 相同)
+          live_map["peak_time_s"] 峰值相对触发的时间 (已计入深度窗的触发延迟)
+          live_map["energy"]      去直流后的平方和
+        多通道时只用第一个通道 (光声信号), 有深度窗时只看窗内的采样点。
+        :param envelope: HilbertEnvelope 实例, 给定时 map / peak_time_s 改用 (带通滤波后的) 最大包络值及其位置
+        """
+        if self.adma_mode != "npt":
+            raise ValueError(f'adma_mode="{self.adma_mode}" 的切片与激光脉冲不对齐, 不能计算实时 MAP')
+        self.map_envelope = envelope
+        self.live_map = {name: np.full((scan_h, scan_w), np.nan, dtype=np.float32)
+                         for name in ("map", "peak_time_s", "energy")}
+        self.map_shape = (scan_h, scan_w)
+        self.map_idx = 0
+
+    def map_pixels(self, alines, first_pixel=None):
+        """
+        批量把 (N, recordLength) 的平均 A-line (交织格式, 未切深度窗) 计算成特征, 写入像素 first_pixel 起的 N 个位置。
+        飞行扫描 / AUX 分像素等整批得到结果的模式直接调用它; first_pixel 默认接在上次之后。
+        """
+        if self.live_map is None:
+            return
+        if first_pixel is None:
+            first_pixel = self.map_idx
+        alines = np.asarray(alines).reshape(-1, self.recordLength)
+        scan_h, scan_w = self.map_shape
+        n = min(alines.shape[0], scan_h * scan_w - first_pixel)
+        if n <= 0:
+            return
+        signal = self.split_channels(self.gate_records(alines[:n]))[0]
+        max_abs, peak_idx, energy = aline_features(signal)
+        if self.map_envelope is not None:
+            max_abs, peak_idx = self.map_envelope.peak(signal)
+        row, col = snake_pixel_position(np.arange(first_pixel, first_pixel + n), scan_w)
+        self.live_map["map"][row, col] = max_abs
+        self.live_map["peak_time_s"][row, col] = (self.gateStart + peak_idx) / self.samplesPerSec
+        self.live_map["energy"][row, col] = energy
+        self.map_idx = first_pixel + n
+
+    def _map_point(self, point_bufs, Average_Enable):
+        """逐点采集完成后更新实时 MAP: 平均模式下除以 record 数, 原始模式下先对 record 求平均"""
+        if self.live_map is None:
+            return
+        total = np.zeros(self.recordLength, dtype=np.float64)
+        rows = 0
+        for buf in point_bufs:
+            records = np.reshape(buf, (-1, self.recordLength))
+            total += np.add.reduce(records, axis=0, dtype=np.float64)
+            rows += records.shape[0]
+        if rows:
+            self.map_pixels(total / (self.recordsPerPoint if Average_Enable else rows))
+        else:
+            self.map_idx += 1
+
+    def _arena_point(self, timeout_ms, Average_Enable):
+        """Arena 模式的 (acquire, finish): 每个 Buffer 直接写入 result_arena[arena_idx] 对应的槽位"""
+        if self.arena_idx >= self.result_arena.shape[0]:
+            raise RuntimeError(f"Arena 已满 ({self.result_arena.shape[0]} 个点), 请检查 num_points")
+        if Average_Enable != self.arena_average:
+            raise ValueError("Average_Enable 与 prepare_acquisition 时分配的 Arena 不一致")
+
+        slot = self.result_arena[self.arena_idx]
+
+        def acquire():
+            if Average_Enable:
+                # 直接以 Arena 槽位作为累加器, 不再生成新的数组
+                self._accumulate_point(slot[0], timeout_ms)
+            else:
+                # (records, samples) -> 按 Buffer 切成 buffersPerPoint 段, 每段都是视图
+                # (多板卡合并的 Arena 里槽位只是一列, 所以不展平)
+                deadline = self._point_deadline(timeout_ms)
+                slot_buffers = slot.reshape(self.buffersPerPoint, self.recordsPerBuffer, -1)
+                for b in range(self.buffersPerPoint):
+                    self._fetch_next_buffer(deadline, b, out=slot_buffers[b])
+
+        def finish(ok):
+            if not ok:
+                slot.fill(0) # 重试仍失败: 清掉写了一半的数据
+                if Average_Enable:
+                    self._skip_stats_point()
+            self.arena_idx += 1
+            # 只存视图, 保持 len(all_data) 的含义不变
+            return [slot]
+        return acquire, finish
     
-    def _fetch_next_buffer(self, timeout_ms):
-        try:
+    # =====================================================
+    #  后台 DMA 线程 + 有界环形队列
+    # =====================================================
+
+    def start_stream_worker(self, ring_buffers=256, poll_ms=50):
+        """
+        启动后台 DMA 服务线程 (需在 start_capture 之后调用)。
+        线程不停地等待/拷贝/归还 Buffer, 位移台串口查询卡住时也不会让板卡溢出,
+        因此 buffer_count 可以保持很小。每个 Buffer 按完成顺序带有单调递增的
+        序号和完成时间 (time.perf_counter), 主循环只需要把序号区间映射到像素。
+        :param ring_buffers: 环形队列能容纳的 Buffer 个数, 主循环落后超过这个数量时旧数据会被覆盖
+        :param poll_ms: 单次等待的超时, 用于及时响应停止信号
+        """
+        dtype = self.buffers[0].buffer.dtype
+        self.ring = np.zeros((ring_buffers, self.recordsPerBuffer, self.recordLength), dtype=dtype)
+        self.ring_index = np.full(ring_buffers, -1, dtype=np.int64) # 每个槽位当前存的是第几个 Buffer
+        self.ring_time = np.zeros(ring_buffers, dtype=np.float64)    # 对应 Buffer 的完成时间
+        if self.footers_enabled:
+            self.ring_footers = np.zeros((ring_buffers, self.recordsPerBuffer), dtype=NPT_FOOTER_DTYPE)
+        self.stream_head = 0          # 已完成的 Buffer 总数 (下一个写入的序号)
+        self.stream_error = None
+        self._stream_cond = threading.Condition()
+        self._stream_stop = threading.Event()
+        self._stream_poll_ms = poll_ms
+        self.stream_thread = threading.Thread(target=self._stream_worker, args=(poll_ms,), daemon=True)
+        self.stream_thread.start()
+
+    def _recover_stream(self):
+        """
+        后台线程模式下一个点失败后的恢复 (DMA 归后台线程服务, 主线程不能在它等待时重新装载):
+        线程还在运行时 (溢出它会自己重新装载, 超时只是没有触发) 不需要做什么, 重试从当前的 stream_head 开始;
+        线程已因错误退出时重新装载 DMA, 在原来的环形队列上重启线程, 序号继续递增, 断点记在 stream_breaks 里。
+        """
+        if self.stream_error is None:
+            return
+        self.stream_thread.join()
+        self.acq_stats["stream_breaks"].append(self.stream_head)
+        self.rearm_dma()
+        self.stream_error = None
+        self.stream_thread = threading.Thread(target=self._stream_worker, args=(self._stream_poll_ms,), daemon=True)
+        self.stream_thread.start()
+
+    def stop_stream_worker(self):
+        if self.stream_thread is not None:
+            self._stream_stop.set()
+            self.stream_thread.join()
+            self.stream_thread = None
+
+    def _stream_worker(self, poll_ms):
+        ring_size = self.ring.shape[0]
+        t_call = None # 开始等待当前 Buffer 的时刻 (跨越多次 poll)
+        while not self._stream_stop.is_set():
             buffer = self.buffers[self.buffer_idx % self.bufferCount]
-            
-            # 这里的 timeout 决定了主循环的卡顿程度, 如果激光是 80kHz, 1个buffer存10个record, 理论只需 0.125ms, 所以 timeout_ms=10 足够了
+            if t_call is None:
+                t_call = time.perf_counter()
+            try:
+                self.board.waitAsyncBufferComplete(buffer.addr, timeout_ms=poll_ms)
+            except Exception as e:
+                kind = classify_dma_error(e)
+                if kind == "timeout":
+                    continue # 还没有触发, 继续等 (同一个 Buffer 可以重复等待), 不计入 timeouts
+                self.acq_stats[kind + "s"] += 1
+                if self.acq_stats["rearms"] < self.max_stream_rearms:
+                    # 溢出前已经完成的 Buffer 都已取走, 丢失的只是 FIFO 里的数据: 重新装载后接着采,
+                    # 序号继续递增, 断点记在 stream_breaks 里
+                    print(f"⚠️ [DAQ] DMA 线程在 Buffer #{self.stream_head} 处出错 ({kind}): {e}, 重新装载 DMA")
+                    self.acq_stats["stream_breaks"].append(self.stream_head)
+                    try:
+                        self.rearm_dma()
+                        t_call = None
+                        continue
+                    except Exception as rearm_error:
+                        e = rearm_error
+                self.stream_error = e
+                with self._stream_cond:
+                    self._stream_cond.notify_all()
+                print(traceback.format_exc())
+                return
+
+            seq = self.stream_head
+            slot = seq % ring_size
+            np.copyto(self.ring[slot], buffer.buffer.reshape(self.recordsPerBuffer, self.recordLength))
+            if self.footers_enabled:
+                np.copyto(self.ring_footers[slot], self._extract_footers(buffer))
+                self._check_record_numbers(self.ring_footers[slot])
+            self.acq_stats["buffers"] += 1
+            self.acq_stats["records"] += self.recordsPerBuffer * (self.recordsPerPoint if self.hw_average else 1)
+            self._measure_trigger_rate(t_call, self._buffer_period_s())
+            t_call = None
+            t_done = time.perf_counter()
+            self._repost_buffer(buffer)
+
+            with self._stream_cond:
+                self.ring_index[slot] = seq
+                self.ring_time[slot] = t_done
+                self.stream_head = seq + 1
+                self._stream_cond.notify_all()
+
+    def _wait_stream(self, end_buffer, timeout_ms, point_buffers=None):
+        """
+        阻塞直到序号 < end_buffer 的 Buffer 全部完成。
+        :param point_buffers: 给定时等待的是一整个点 (共 point_buffers 个 Buffer), 期限按 _point_timeout_s 计
+                              (随后台线程实测的触发率更新)
+        """
+        start = time.perf_counter()
+        with self._stream_cond:
+            while self.stream_head < end_buffer:
+                if self.stream_error is not None:
+                    raise RuntimeError(f"DMA 线程已停止: {self.stream_error}")
+                timeout_s = self._point_timeout_s(timeout_ms, point_buffers) if point_buffers else timeout_ms / 1000.
+                remaining = start + timeout_s - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError(f"等待 Buffer #{end_buffer - 1} 超时 (已完成 {self.stream_head})")
+                self._stream_cond.wait(remaining)
+
+    def _check_stream_range(self, start_buffer):
+        if start_buffer < self.stream_head - self.ring.shape[0]:
+            raise RuntimeError(f"环形队列溢出: Buffer #{start_buffer} 已被覆盖, 请增大 ring_buffers")
+
+    def get_stream_acquisition(self, all_data, pos_mapping, curr_pos_str, start_buffer, timeout_ms, Average_Enable=False):
+        """
+        后台线程模式下的 get_one_acquisition: 把序号 [start_buffer, start_buffer + buffersPerPoint)
+        的 Buffer 归为当前像素。start_buffer 一般取位移台到位时的 self.stream_head。
+        FPGA 平均时一个 Buffer 就是一整个点, 到位时正在累加的那个 Buffer (序号 start_buffer) 大部分 record
+        是位移台移动中采的, 丢弃它从下一个 Buffer 开始 (每个点多等一个点的采集时间)。
+        超时、DMA 线程出错或环形队列溢出时与 get_one_acquisition 相同: 由 _acquire_with_recovery 从当前 stream_head 重采
+        (线程已退出时先重启, 见 _recover_stream), 仍失败的点填 0 并记入 failed_points。
+        """
+        self._check_average_mode(Average_Enable)
+        if self.result_arena is not None:
+            if self.arena_idx >= self.result_arena.shape[0]:
+                raise RuntimeError(f"Arena 已满 ({self.result_arena.shape[0]} 个点), 请检查 num_points")
+            slot = self.result_arena[self.arena_idx]
+        else:
+            slot = None
+        ring_size = self.ring.shape[0]
+        stats = self.record_stats if Average_Enable else None
+        result = [] # list 模式的原始 Buffer (平均 / Arena 模式的结果在 accumulator / slot 里)
+        next_start = start_buffer
+
+        def acquire():
+            nonlocal next_start
+            # 重试时失败之前的 Buffer 可能跨越断点或已被覆盖, 从当前位置重新开始
+            start = self.stream_head if next_start is None else next_start
+            next_start = None
+            if self.hw_average:
+                start += 1
+            end = start + self.buffersPerPoint
+            self._wait_stream_point(start, end, timeout_ms)
+            if Average_Enable:
+                acc = slot[0] if slot is not None else self.accumulator
+                acc.fill(0)
+                if stats is not None:
+                    stats.start_point()
+                n = self.signalLength # 不累加 footer
+                for seq in range(start, end):
+                    np.add.reduce(self.ring[seq % ring_size][:, :n], axis=0, dtype=self.acc_dtype, out=self._acc_partial[:n])
+                    np.add(acc, self._acc_partial, out=acc)
+                    if stats is not None:
+                        stats.update(self.ring[seq % ring_size])
+            elif slot is not None:
+                slot_buffers = slot.reshape(self.buffersPerPoint, self.recordsPerBuffer, self.recordLength)
+                for b, seq in enumerate(range(start, end)):
+                    np.copyto(slot_buffers[b], self.ring[seq % ring_size])
+            else:
+                result[:] = [self.ring[seq % ring_size].reshape(-1).copy() for seq in range(start, end)]
+            # 读取期间 DMA 线程可能已经追上并覆盖了这些槽位, 读完再检查一次
+            self._check_stream_point(start)
+            if stats is not None:
+                stats.finish_point()
+
+        ok = self._acquire_with_recovery(acquire, len(all_data), recover=self._recover_stream)
+        if not ok:
+            # 重试仍失败: 填 0, 保持每个点的形状一致
+            if slot is not None:
+                slot.fill(0)
+            elif Average_Enable:
+                self.accumulator.fill(0)
+            else:
+                result[:] = [np.zeros(self.recordsPerBuffer * self.recordLength, dtype=self.ring.dtype)
+                             for _ in range(self.buffersPerPoint)]
+            if stats is not None:
+                self._skip_stats_point()
+        if slot is not None:
+            result[:] = [slot]
+            self.arena_idx += 1
+        elif Average_Enable:
+            result[:] = [self.accumulator.copy()]
+        all_data.append(result)
+        # 失败的点不更新实时 MAP (保持 NaN)
+        self._map_point(result if ok else [], Average_Enable)
+        self._store_pos(pos_mapping, len(all_data) - 1, curr_pos_str)
+
+    def _wait_stream_point(self, start_buffer, end_buffer, timeout_ms):
+        """
+        get_stream_acquisition 等待一个点的 Buffer: 超时、DMA 线程出错或环形队列溢出都转成 AcquisitionError,
+        由 _acquire_with_recovery 重试 (超时计入 timeouts; 线程自己遇到的驱动错误它已经计过)
+        """
+        try:
+            self._wait_stream(end_buffer, timeout_ms, point_buffers=self.buffersPerPoint + (1 if self.hw_average else 0))
+        except TimeoutError as e:
+            self.acq_stats["timeouts"] += 1
+            raise AcquisitionError("timeout", str(e)) from e
+        except RuntimeError as e:
+            raise AcquisitionError(classify_dma_error(self.stream_error), str(e)) from e
+        self._check_stream_point(start_buffer)
+
+    def _check_stream_point(self, start_buffer):
+        try:
+            self._check_stream_range(start_buffer)
+        except RuntimeError as e:
+            raise AcquisitionError("overflow", str(e)) from e
+
+    def _extract_footers(self, buffer):
+        """从一个完成的 Buffer 中批量提取全部 record 的 NPT footer (返回复用的 self.footers)"""
+        self.ats.extractTimeDomainNPTFooters(buffer.addr, self.bytesPerRecord, self.bytesPerBuffer,
+                                        self.footers_ctypes, self.recordsPerBuffer)
+        return self.footers
+
+    def collect_footer_binned(self, num_pixels, timeout_ms, bin_mode="aux", pixel_edges=None,
+                              start_buffer=None, progress_cb=None):
+        """
+        按 NPT footer 把后台线程采到的 record 直接分配到像素并累加, 不再依赖串口查询位置。
+        需要 enable_footers=True 且后台 DMA 线程已启动。
+        :param bin_mode: "aux"       -> 位移台 TTL (接 AUX 输入) 高电平期间的 record 属于同一像素, 每个上升沿像素 +1
+                         "timestamp" -> 按 pixel_edges (num_pixels+1 个, 与 trigger_timestamp 同单位) 划分时间窗
+        :param start_buffer: 从哪个 Buffer 序号开始读, 默认为当前 stream_head
+        :param progress_cb: 每完成若干像素时调用 progress_cb(新完成的像素数)
+        :return: (sums, counts) -> sums (num_pixels, recordLength) 为累加结果, counts 为每个像素实际用到的 record 数
+                 (若分配了 Arena, sums 就是 Arena 的视图)
+        """
+        if not self.footers_enabled:
+            raise RuntimeError("collect_footer_binned 需要 prepare_acquisition(enable_footers=True)")
+        if bin_mode == "timestamp":
+            if pixel_edges is None or len(pixel_edges) != num_pixels + 1:
+                raise ValueError("timestamp 模式需要 num_pixels+1 个 pixel_edges")
+            pixel_edges = np.asarray(pixel_edges, dtype=np.uint64)
+        elif bin_mode != "aux":
+            raise ValueError(f"未知的 bin_mode: {bin_mode}")
+
+        if self.result_arena is not None:
+            if self.result_arena.shape[0] < num_pixels:
+                raise RuntimeError(f"Arena 只有 {self.result_arena.shape[0]} 个点, 少于 {num_pixels} 个像素")
+            sums = self.result_arena[:num_pixels, 0, :]
+        else:
+            sums = np.zeros((num_pixels, self.recordLength), dtype=self.acc_dtype)
+        counts = np.zeros(num_pixels, dtype=np.int64)
+
+        ring_size = self.ring.shape[0]
+        seq = self.stream_head if start_buffer is None else start_buffer
+        aux_prev, edges_seen = False, 0
+        pixels_done = 0
+        while pixels_done < num_pixels:
+            # 没有新 Buffer 超过 timeout_ms 视为触发中断
+            self._wait_stream(seq + 1, timeout_ms)
+            self._check_stream_range(seq)
+            slot = seq % ring_size
+            footers = self.ring_footers[slot]
+            records = self.ring[slot]
+
+            if bin_mode == "aux":
+                pix, aux_prev, edges_seen = assign_pixels_by_aux(footers["aux_in_state"], aux_prev, edges_seen)
+                # 当前 TTL 仍为高电平的像素还没有采完
+                finished = edges_seen - 1 if aux_prev else edges_seen
+            else:
+                pix = assign_pixels_by_timestamp(footers["trigger_timestamp"], pixel_edges)
+                finished = int(np.searchsorted(pixel_edges[1:], footers["trigger_timestamp"][-1], side="right"))
+
+            self.accumulate_record_runs(records, pix, sums, counts)
+            self._check_stream_range(seq)
+            seq += 1
+            finished = min(finished, num_pixels)
+            if finished > pixels_done:
+                if progress_cb is not None:
+                    progress_cb(finished - pixels_done)
+                pixels_done = finished
+
+        if self.result_arena is not None:
+            self.arena_idx = max(self.arena_idx, num_pixels)
+        return sums, counts
+
+    def accumulate_record_runs(self, records, pix, sums, counts):
+        """
+        把一个 Buffer 的 records (recordsPerBuffer, recordLength) 按像素序号 pix 累加到 sums / counts。
+        record 按时间顺序排列, 同一像素的 record 是连续的一段, 按段归约; pix 越界 (如 -1) 的 record 丢弃。
+        """
+        n = self.signalLength # footer 覆盖的采样不累加
+        bounds = np.flatnonzero(np.diff(pix)) + 1
+        for a, b in zip(np.r_[0, bounds], np.r_[bounds, len(pix)]):
+            p = pix[a]
+            if p < 0 or p >= len(counts):
+                continue
+            np.add.reduce(records[a:b, :n], axis=0, dtype=self.acc_dtype, out=self._acc_partial[:n])
+            np.add(sums[p], self._acc_partial, out=sums[p])
+            counts[p] += b - a
+
+    def get_stream_buffer(self, seq):
+        """返回第 seq 个 Buffer 在环形队列中的 (recordsPerBuffer, recordLength) 视图 (不复制)"""
+        self._check_stream_range(seq)
+        if seq >= self.stream_head:
+            raise RuntimeError(f"Buffer #{seq} 尚未完成")
+        return self.ring[seq % self.ring.shape[0]]
+
+    def get_stream_times(self, start_buffer, count):
+        """返回序号区间内每个 Buffer 的完成时间 (perf_counter 秒)"""
+        seqs = np.arange(start_buffer, start_buffer + count)
+        slots = seqs % self.ring.shape[0]
+        if np.any(self.ring_index[slots] != seqs):
+            raise RuntimeError("请求的 Buffer 尚未完成或已被覆盖")
+        return self.ring_time[slots].copy()
+
+    def _accumulate_point(self, acc, timeout_ms):
+        """
+        把一个点的 buffersPerPoint 个 Buffer 逐个累加到 acc (recordLength,)。
+        整数求和比 np.mean 快得多, 因为不涉及浮点运算和除法。打开 footer 时只累加前 signalLength 个采样, 末尾保持 0。
+        """
+        acc.fill(0)
+        stats = self.record_stats
+        if stats is not None:
+            stats.start_point()
+        deadline = self._point_deadline(timeout_ms)
+        n = self.signalLength
+        for k in range(self.buffersPerPoint):
+            buffer = self._wait_next_buffer(deadline, k)
+            records = buffer.buffer.reshape(self.recordsPerBuffer, self.recordLength)
+            np.add.reduce(records[:, :n], axis=0, dtype=self.acc_dtype, out=self._acc_partial[:n])
+            if stats is not None:
+                stats.update(records)
+            if self.footers_enabled:
+                self._check_record_numbers(self._extract_footers(buffer))
+            # 归约完就可以立刻把 Buffer 还给板卡, 累加放到 repost 之后
+            self._repost_buffer(buffer)
+            np.add(acc, self._acc_partial, out=acc)
+        if stats is not None:
+            stats.finish_point()
+
+    def _buffer_period_s(self):
+        """按实测触发率 (还没有时用 prepare 给定的 PRF) 推算的一个 Buffer 的采集时间, 都没有时返回 None; TS / CS 按采样率计算"""
+        if self.adma_mode != "npt":
+            return self.recordsPerBuffer * self.samplesPerRecord / self.samplesPerSec # 连续采集只取决于采样率
+        rate = self.trigger_rate_hz or self.nominal_prf_hz
+        if not rate:
+            return None
+        return self.recordsPerBuffer * (self.recordsPerPoint if self.hw_average else 1) / rate
+
+    def _point_timeout_s(self, timeout_ms, buffers=None):
+        """
+        一个点的等待时间: timeout_ms 与 deadline_margin 倍预计采集时间 (buffers 个 Buffer, 默认 buffersPerPoint) 中较大的一个。
+        高平均次数时 timeout_ms (通常按曝光时间给) 可能比采满一个点所需的时间还短, 这时按触发率放宽;
+        正常的点在数据到齐时就返回, 放宽期限不会延长每个点的驻留时间。
+        """
+        timeout_s = timeout_ms / 1000.
+        period = self._buffer_period_s()
+        if period is not None:
+            timeout_s = max(timeout_s, self.deadline_margin * period * (buffers or self.buffersPerPoint))
+        return timeout_s
+
+    def _point_deadline(self, timeout_ms):
+        """
+        开始采集一个点: 记下起始时间, 返回整个点共用的绝对期限 (time.perf_counter 秒)。
+        还没有触发率时期限先按 timeout_ms 计, 点内测到触发率后由 _wait_next_buffer 重新推算 (只会延后)。
+        """
+        self._point_start = time.perf_counter()
+        self._point_timeout_ms = timeout_ms
+        self._lag_warned = False
+        return self._point_start + self._point_timeout_s(timeout_ms)
+
+    def _wait_until(self, buffer, until):
+        """等待 buffer 完成, 最晚到绝对时间 until (超时抛出驱动的 ApiWaitTimeout 异常)"""
+        timeout_ms = max(int(np.ceil((until - time.perf_counter()) * 1000.)), 1)
+        if self.fft_mode:
+            self.board.dspGetBuffer(buffer.addr, timeout_ms)
+        else:
             self.board.waitAsyncBufferComplete(buffer.addr, timeout_ms=timeout_ms)
-            # 经验：如果出现 ApiWaitTimeout 一定要检查 Trigger 本身是不是有问题
-            
-            # 1. 拷贝数据 (非常重要！因为 DMA 会复写这块内存)
-            # data_copy = np.array(buffer.buffer, copy=True)
-            # 为了速度，可以使用 copy
-            data_copy = np.copy(buffer.buffer)
-            
-            # 2. 重新提交 Buffer
-            self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
-            self.buffer_idx += 1
-            # print(self.buffer_idx)
+
+    def _wait_next_buffer(self, deadline, k=0):
+        """
+        等待环形队列中的下一个 Buffer (当前点的第 k 个) 完成并计数。
+        整个点共用一个绝对期限 deadline, 前面的 Buffer 慢了后面的可以把剩余时间用完 (原来按 Buffer 平分 timeout)。
+        预计完成时间 (点的起始时间 + lag_factor x (k+1) 个 Buffer 周期, 至少留 MIN_LAG_WAIT_S 的抖动余量) 过了还没完成时
+        先打印警告, 再继续等到 deadline。只有第一段等待真的超时才警告 (主机处理慢、Buffer 早已完成的不算落后)。
+        失败时记入 acq_stats 并抛出 AcquisitionError (由 _acquire_with_recovery 决定重新装载 DMA / 重试)
+        """
+        buffer = self.buffers[self.buffer_idx % self.bufferCount]
+        period = self._buffer_period_s()
+        if period is not None:
+            deadline = max(deadline, self._point_start + self._point_timeout_s(self._point_timeout_ms))
+        t_call = time.perf_counter()
+        warn_at = None
+        if period is not None and not self._lag_warned:
+            # 短 Buffer 周期下 lag_factor 倍只有零点几毫秒, 调度抖动就会超过, 因此加上 MIN_LAG_WAIT_S 的下限
+            warn_at = self._point_start + max(self.lag_factor * (k + 1) * period, (k + 1) * period + self.MIN_LAG_WAIT_S)
+        # 预计完成时间还远时分两段等待, 卡住的 Buffer 在 warn_at 就能报出来;
+        # 很近时不拆 (毫秒级的短超时本身就有开销), 也不警告
+        stages = [deadline]
+        if warn_at is not None and t_call + self.MIN_LAG_WAIT_S < warn_at < deadline:
+            stages.insert(0, warn_at)
+        try:
+            for i, until in enumerate(stages):
+                try:
+                    self._wait_until(buffer, until)
+                    break
+                except Exception as e:
+                    if i == len(stages) - 1 or classify_dma_error(e) != "timeout":
+                        raise
+                    self._warn_lag(warn_at, deadline)
         except Exception as e:
-            print(traceback.format_exc())
+            # 经验：如果出现 ApiWaitTimeout 一定要检查 Trigger 本身是不是有问题
+            kind = classify_dma_error(e)
+            self.acq_stats[kind + "s"] += 1
+            raise AcquisitionError(kind, f"Buffer #{self.buffer_idx}: {e}") from e
+        self._measure_trigger_rate(t_call, period)
+        self.acq_stats["buffers"] += 1
+        self.acq_stats["records"] += self.recordsPerBuffer * (self.recordsPerPoint if self.hw_average else 1)
+        return buffer
+
+    def _warn_lag(self, warn_at, deadline):
+        """每个点最多警告一次"""
+        self._lag_warned = True
+        self.acq_stats["lag_warnings"] += 1
+        rate = f"{self.trigger_rate_hz:.0f} Hz" if self.trigger_rate_hz else "未知"
+        print(f"⚠️ [DAQ] Buffer #{self.buffer_idx} 落后: 预计 {(warn_at - self._point_start) * 1000:.1f} ms 内完成, "
+              f"实测触发率 {rate}, 本点期限 {(deadline - self._point_start) * 1000:.0f} ms")
+
+    def _measure_trigger_rate(self, t_call, period):
+        """
+        用最近 TRIGGER_RATE_WINDOW 个 Buffer 估计触发率: 窗口首尾两次完成之间的 record 数 / 时间。
+        只有等待真正阻塞过 (数据是等来的, 不是早已在队列里) 时返回时刻才等于完成时刻, 因此只记录这些 Buffer;
+        中间没有阻塞的 Buffer 仍按序号计入 record 数 (板卡一直在采, 跨点也成立, 重新装载时清空窗口)。
+        相邻两个 Buffer 的间隔受线程调度影响很大, 跨多个 Buffer 的平均要稳定得多。
+        """
+        if self.adma_mode != "npt":
+            return # TS / CS 的 Buffer 由采样率决定, 与触发无关
+        t_done = time.perf_counter()
+        self._rate_buffers += 1
+        if t_done - t_call <= (0.25 * period if period is not None else 0.5e-3):
+            return
+        window = self._rate_window
+        window.append((t_done, self._rate_buffers))
+        if len(window) >= 2 and t_done > window[0][0]:
+            records = self.recordsPerBuffer * (self.recordsPerPoint if self.hw_average else 1)
+            self.trigger_rate_hz = records * (self._rate_buffers - window[0][1]) / (t_done - window[0][0])
 
+    def _repost_buffer(self, buffer):
+        """把处理完的 Buffer 重新提交给驱动, 并推进循环索引"""
+        self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+        self.buffer_idx += 1
+
+    def _fetch_next_buffer(self, deadline, k=0, out=None):
+        """
+        等待下一个 Buffer, 拷贝出数据后立即归还 (DMA 会复写这块内存)。
+        deadline / k 见 _wait_next_buffer。给定 out 时直接写入预分配内存 (Arena), 否则返回新的副本。失败时抛出 AcquisitionError。
+        """
+        buffer = self._wait_next_buffer(deadline, k)
+        if out is not None:
+            np.copyto(out, buffer.buffer.reshape(out.shape))
+            data_copy = out
+        else:
+            data_copy = np.copy(buffer.buffer)
+        if self.footers_enabled:
+            self._check_record_numbers(self._extract_footers(buffer))
+        self._repost_buffer(buffer)
         return data_copy
 
 
     def stop_capture(self):
         # print("🛑 [DAQ] 停止采集")
-        self.board.abortAsyncRead()
+        self.stop_stream_worker() # 先停线程, 防止它在 abort 之后继续等待/提交 Buffer
+        if self.fft_mode:
+            self.board.dspAbortCapture() # 同时清理 DSP 模块的状态
+            self.fft_mode = False
+        else:
+            self.board.abortAsyncRead()
+        if self.hw_average:
+            # 关闭 FPGA 平均, 以免影响之后不使用平均的采集
+            self.board.configureRecordAverage(self.ats.CRA_MODE_DISABLE, self.samplesPerRecord, 1,
+                                              self.ats.CRA_OPTION_UNSIGNED)
+            self.hw_average = False
+        # 板卡已停止, Buffer 马上还给池 (不等 GC), 下一次 prepare 直接复用
+        self.release_buffers()
         self.is_capturing = False
\ No newline at end of file
@@ -1,19 +1,135 @@
+import numpy as np
+
+def get_expected_trajectory_xy(SCAN_W, SCAN_H, STEP_UM, START_X, START_Y):
+    """
+    蛇形扫描每个像素的目标坐标, 返回 (SCAN_W*SCAN_H, 2) 的 int64 数组 (x, y), 顺序与 AutoScan 一致:
+    偶数行 (0, 2, 4...) X 增加；奇数行 (1, 3, 5...) X 减小。
+    """
+    row, col = snake_pixel_position(np.arange(SCAN_W * SCAN_H), SCAN_W)
+    return np.stack([START_X + col * STEP_UM, START_Y + row * STEP_UM], axis=1).astype(np.int64)
+
+
 def get_expected_trajectory(SCAN_W, SCAN_H, STEP_UM, START_X, START_Y):
-    
-    expected_trajectory_str = []
-    for j in range(SCAN_H):
-        curr_y = START_Y + j * STEP_UM
-        
-        # 偶数行 (0, 2, 4...) X 增加；奇数行 (1, 3, 5...) X 减小
-        if j % 2 == 0:
-            x_range = range(START_X, START_X + SCAN_W)
-        else:
-            x_range = range(START_X + SCAN_W - 1, START_X - 1, -1)
-        
-        for curr_x in x_range:
-            # 严格匹配位移台返回格式: "X,Y,0"
-            # 注意：这里要确保负号和空格与硬件返回完全一致
-            target_s = f"{curr_x},{curr_y},0"
-            expected_trajectory_str.append(target_s)
-    
-    return expected_trajectory_str
\ No newline at end of file
+    """与 get_expected_trajectory_xy 相同, 返回位移台回复格式的字符串 "X,Y,0" (旧代码 / 写盘用)"""
+    return [f"{x},{y},0" for x, y in get_expected_trajectory_xy(SCAN_W, SCAN_H, STEP_UM, START_X, START_Y)]
+
+
+def build_pixel_lookup(trajectory_xy):
+    """预先计算 坐标 (x, y) -> 像素序号 的哈希表, 扫描循环里按位置找像素是 O(1)"""
+    return {(int(x), int(y)): k for k, (x, y) in enumerate(trajectory_xy)}
+
+
+def lookup_pixel(pixel_lookup, x, y, tol_um=0):
+    """
+    位置 (x, y) 对应的像素序号, 不在任何像素 tol_um 以内时返回 -1。
+    tol_um > 0 时在 (2*tol_um+1)^2 个邻近坐标里找最近的像素 (tol_um 应小于步长的一半, 否则相邻像素会重叠)。
+    """
+    k = pixel_lookup.get((x, y), -1)
+    if k >= 0 or tol_um <= 0:
+        return k
+    best, best_d = -1, None
+    for dx in range(-tol_um, tol_um + 1):
+        for dy in range(-tol_um, tol_um + 1):
+            k = pixel_lookup.get((x + dx, y + dy), -1)
+            if k >= 0 and (best_d is None or dx * dx + dy * dy < best_d):
+                best, best_d = k, dx * dx + dy * dy
+    return best
+
+
+def assign_pixels_by_timestamp(timestamps, pixel_edges):
+    """
+    按触发时间戳把 record 分配到像素: 第 k 个像素的时间窗为 [pixel_edges[k], pixel_edges[k+1])。
+    返回每条 record 的像素序号, 落在所有时间窗之外的为 -1。
+    """
+    pix = np.searchsorted(pixel_edges, timestamps, side='right') - 1
+    pix[pix >= len(pixel_edges) - 1] = -1
+    return pix
+
+
+def assign_pixels_by_aux(aux_state, prev_high, edges_seen):
+    """
+    按 AUX 输入电平 (位移台曝光期间输出的 TTL) 把 record 分配到像素。
+    TTL 高电平期间的 record 属于同一像素, 每遇到一个上升沿像素序号 +1, 低电平 (移动中) 的 record 为 -1。
+    :param prev_high: 上一个 Buffer 最后一条 record 的电平, 用于跨 Buffer 判断上升沿
+    :param edges_seen: 之前已经出现的上升沿个数
+    :return: (像素序号数组, 本 Buffer 最后的电平, 更新后的上升沿个数)
+    """
+    high = np.asarray(aux_state) != 0
+    prev = np.empty_like(high)
+    prev[0] = prev_high
+    prev[1:] = high[:-1]
+    rising = high & ~prev
+    pix = edges_seen + np.cumsum(rising) - 1
+    pix[~high] = -1
+    return pix, bool(high[-1]), edges_seen + int(rising.sum())
+
+
+def snake_pixel_index(ix, row, SCAN_W):
+    """
+    把行内列号 ix (0 ~ SCAN_W-1, 按物理 X 从小到大) 转换为蛇形扫描顺序下的像素序号,
+    与 get_expected_trajectory 的顺序一致。越界的 ix 返回 -1。
+    """
+    ix = np.asarray(ix)
+    col = ix if row % 2 == 0 else SCAN_W - 1 - ix
+    pix = row * SCAN_W + col
+    return np.where((ix >= 0) & (ix < SCAN_W), pix, -1)
+
+
+def snake_pixel_position(pix, SCAN_W):
+    """snake_pixel_index 的逆变换: 蛇形扫描顺序的像素序号 -> (行号, 行内列号), 列号按物理 X 从小到大"""
+    pix = np.asarray(pix)
+    row = pix // SCAN_W
+    col = pix % SCAN_W
+    return row, np.where(row % 2 == 0, col, SCAN_W - 1 - col)
+
+
+def aline_features(alines):
+    """
+    批量计算 A-line 的 MAP 特征 (与 PAM_Reconstruction.m 的 calculate_pixel_value 相同: 去直流后取最大绝对值)。
+    :param alines: (N, samples) 平均后的 A-line
+    :return: (max_abs, peak_idx, energy), 均为 (N,); energy 为去直流后的平方和
+    """
+    x = np.asarray(alines, dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+    absx = np.abs(x)
+    peak_idx = absx.argmax(axis=1)
+    max_abs = np.take_along_axis(absx, peak_idx[:, None], axis=1)[:, 0]
+    energy = np.einsum("ij,ij->i", x, x)
+    return max_abs, peak_idx, energy
+
+
+def spectral_features(spectrum, freqs_hz, bands_hz=()):
+    """
+    把一个像素的平均功率谱压缩成少量标量特征, 用于 FFT 采集模式下的实时成像。
+    :param spectrum: (n_bins,) 功率谱 (|X|^2, 线性刻度)
+    :param freqs_hz: (n_bins,) 每个频点的频率
+    :param bands_hz: [(f_lo, f_hi), ...] 需要单独积分的频带
+    :return: [总功率, 峰值频率, 谱质心, 各频带功率...], 顺序与 spectral_feature_names 一致
+    """
+    total = float(spectrum.sum())
+    peak = float(freqs_hz[np.argmax(spectrum)])
+    centroid = float(np.dot(spectrum, freqs_hz) / total) if total > 0 else 0.
+    bands = [float(spectrum[(freqs_hz >= lo) & (freqs_hz < hi)].sum()) for lo, hi in bands_hz]
+    return [total, peak, centroid] + bands
+
+
+def spectral_feature_names(bands_hz=()):
+    """spectral_features 输出各列的名称"""
+    return ["total_power", "peak_freq_hz", "centroid_hz"] + \
+           [f"band_{lo / 1e6:g}_{hi / 1e6:g}MHz" for lo, hi in bands_hz]
+
+
+def find_signal_window(aline, threshold_sigma=6., margin_samples=64):
+    """
+    在平均后的 A-line 中找出信号所在的采样点范围, 用于标定深度窗。
+    基线取中位数, 噪声用 MAD 估计 (信号只占很窄的深度, 不影响估计), 偏离基线超过 threshold_sigma 倍噪声的点算作信号,
+    首尾各留 margin_samples 的余量。
+    :return: (start, stop) 半开区间, 没有信号时返回 None
+    """
+    x = np.asarray(aline, dtype=np.float64)
+    dev = np.abs(x - np.median(x))
+    sigma = 1.4826 * np.median(dev)
+    above = np.flatnonzero(dev > threshold_sigma * max(sigma, 1e-12))
+    if above.size == 0:
+        return None
+    return max(int(above[0]) - margin_samples, 0), min(int(above[-1]) + 1 + margin_samples, x.size)
@@ -0,0 +1,133 @@
+import ctypes
+import numpy as np
+
+
+class PooledDMABuffer:
+    """
+    与 ats.DMABuffer 接口相同 (addr / size_bytes / buffer), 底层是池里按 size class 分配的页锁定内存。
+    size_bytes 是本次请求的大小 (postAsyncBuffer 按它提交), buffer 是前 size_bytes 字节按所需类型的视图。
+    """
+
+    def __init__(self, dma, size_bytes, dtype):
+        self.dma = dma
+        self.addr = dma.addr
+        self.size_bytes = size_bytes
+        self.buffer = dma.buffer[:size_bytes].view(dtype)
+
+
+class DMABufferLease:
+    """
+    从 DMABufferPool 借出的一组 Buffer。release() 或离开 with 块时归还给池 (不释放页锁定内存),
+    归还后不能再使用这些 Buffer (下一次借出会复用同一块内存)。
+    """
+
+    def __init__(self, pool, buffers):
+        self.pool = pool
+        self.buffers = buffers
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._reclaim(self)
+
+    def __enter__(self):
+        return self.buffers
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class DMABufferPool:
+    """
+    板卡级的 DMA Buffer 池: 页锁定内存 (AlazarAllocBuffer) 按 size class 分配一次, 之后每次扫描都从池里借出、
+    扫描结束归还, 不再依赖 DMABuffer.__del__ 释放 (PAM_Main 扫描期间 gc.disable, 原来每次 prepare 都新分配,
+    旧 Buffer 何时释放不确定, 页锁定内存会碎片化, 每次扫描开始前还要等分配)。
+      - size class: 向上取整到 2 的幂的 1/8 步长 (最多浪费 12.5%), Buffer 大小略有变化的扫描也能复用
+      - 底层一律按字节 (c_uint8) 分配, 再按需要的类型取视图 (atsapi.DMABuffer 只支持 8 / 16 bit, FPGA 平均的 32 bit 求和同样适用)
+      - max_idle_bytes: 空闲 Buffer 的总量上限, 归还时超出的部分立即释放; None 为不限 (页锁定内存保持在最大一次扫描的用量)
+    """
+    MIN_CLASS_BYTES = 4096
+
+    def __init__(self, backend, handle, max_idle_bytes=None):
+        """
+        :param backend: 提供 DMABuffer 的模块 (atsapi 或 SimulatedATS9373)
+        :param handle: 板卡句柄 (board.handle), 内存属于这块板卡
+        """
+        self.ats = backend
+        self.handle = handle
+        self.max_idle_bytes = max_idle_bytes
+        self._idle = {}   # size class -> [DMABuffer]
+        self._leases = [] # 借出中的 DMABufferLease
+        self.stats = {"allocations": 0, "reuses": 0, "frees": 0}
+
+    @classmethod
+    def size_class(cls, size_bytes):
+        if size_bytes <= cls.MIN_CLASS_BYTES:
+            return cls.MIN_CLASS_BYTES
+        step = max(1 << (int(size_bytes - 1).bit_length() - 3), cls.MIN_CLASS_BYTES)
+        return -(-size_bytes // step) * step
+
+    def lease(self, count, size_bytes, dtype=np.uint16):
+        """
+        借出 count 个至少 size_bytes 字节的 Buffer (优先复用空闲的同 size class Buffer)。
+        :return: DMABufferLease, 可用于 with 语句 (with pool.lease(...) as buffers: ...)
+        """
+        dtype = np.dtype(dtype)
+        if size_bytes % dtype.itemsize:
+            raise ValueError(f"size_bytes={size_bytes} 不是 {dtype} 的整数倍")
+        cls = self.size_class(size_bytes)
+        idle = self._idle.setdefault(cls, [])
+        buffers = []
+        for _ in range(count):
+            if idle:
+                dma = idle.pop()
+                self.stats["reuses"] += 1
+            else:
+                dma = self.ats.DMABuffer(self.handle, ctypes.c_uint8, cls)
+                self.stats["allocations"] += 1
+            buffers.append(PooledDMABuffer(dma, size_bytes, dtype))
+        lease = DMABufferLease(self, buffers)
+        self._leases.append(lease)
+        return lease
+
+    def _reclaim(self, lease):
+        self._leases.remove(lease)
+        for buf in lease.buffers:
+            self._idle.setdefault(len(buf.dma.buffer), []).append(buf.dma)
+        lease.buffers = []
+        if self.max_idle_bytes is not None:
+            self.trim(self.max_idle_bytes)
+
+    def trim(self, keep_bytes=0):
+        """释放空闲 Buffer (先释放大的), 直到空闲总量不超过 keep_bytes; 借出中的 Buffer 不受影响"""
+        for cls in sorted(self._idle, reverse=True):
+            idle = self._idle[cls]
+            while idle and self.idle_bytes > keep_bytes:
+                idle.pop() # 最后一个引用, DMABuffer.__del__ 立即调用 AlazarFreeBuffer (引用计数, 与 gc 无关)
+                self.stats["frees"] += 1
+
+    @property
+    def idle_bytes(self):
+        return sum(cls * len(idle) for cls, idle in self._idle.items())
+
+    @property
+    def leased_bytes(self):
+        return sum(len(buf.dma.buffer) for lease in self._leases for buf in lease.buffers)
+
+    @property
+    def allocated_bytes(self):
+        """当前占用的页锁定内存总量 (空闲 + 借出)"""
+        return self.idle_bytes + self.leased_bytes
+
+    def close(self):
+        """归还所有借出的 Buffer 并释放全部内存 (关闭板卡前调用)"""
+        for lease in list(self._leases):
+            lease.release()
+        self.trim(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,121 @@
+import time
+import numpy as np
+
+from Alazar_imaging.Alazar_imaging_tools import snake_pixel_index
+
+
+class FlyScanController:
+    """
+    连续飞行扫描 (Fly-scan):
+    位移台按行匀速扫过整行, 采集卡由后台 DMA 线程连续采集并给每个 Buffer 打上完成时间,
+    主线程一边记录带时间戳的位置, 一边用位置日志插值出每条 record 的 X 坐标并分配到像素。
+    每个像素不再有 "停-稳-采" 的过程, 扫描时间由激光重复频率决定而不是由稳定时间决定。
+
+    需要:
+      - stage 处于串口模式 (prepare_scan_serial 或 connect_serial 之后); 若已 start_position_stream,
+        位置日志直接取后台线程带时间戳的位置历史 (不再由主循环逐次查询串口)
+      - daq 已 start_capture + start_stream_worker, 且 prepare_acquisition(Average_Enable=True, infinite_acquisition=True)
+    """
+
+    def __init__(self, stage, daq, prf_hz, tol_um=0):
+        """
+        :param prf_hz: 激光重复频率, 用于推算 Buffer 内每条 record 的时间
+        :param tol_um: 到位判定的容差 (与逐点扫描的 POS_TOLERANCE_UM 相同, 见 PriorUnifiedStage.is_at)
+        """
+        self.stage = stage
+        self.daq = daq
+        self.prf_hz = prf_hz
+        self.tol_um = tol_um
+
+    def _record_times(self, seq):
+        """Buffer 内第 k 条 record 的时间 = 完成时间 - (recordsPerBuffer-1-k) / PRF"""
+        t_done = self.daq.get_stream_times(seq, 1)[0]
+        rpb = self.daq.recordsPerBuffer
+        return t_done - (rpb - 1 - np.arange(rpb)) / self.prf_hz
+
+    def scan(self, SCAN_W, SCAN_H, STEP_UM, START_X, START_Y, speed_percent,
+             overscan_um=None, row_timeout_s=30., progress_cb=None):
+        """
+        执行蛇形飞行扫描, 像素顺序与 get_expected_trajectory 一致。
+        :param speed_percent: 扫描速度 (SMS 百分比)。每个像素得到的 record 数约为 PRF * STEP_UM / 速度
+        :param overscan_um: 每行两端多走的距离, 让加减速发生在视场之外 (默认 2 个步长)
+        :return: (sums, counts) -> sums (像素数, recordLength) 为累加的 A-line (若分配了 Arena 则是其视图),
+                 counts 为每个像素的 record 数
+        """
+        daq = self.daq
+        if overscan_um is None:
+            overscan_um = 2 * STEP_UM
+        num_pixels = SCAN_W * SCAN_H
+        if daq.result_arena is not None:
+            if daq.result_arena.shape[0] < num_pixels:
+                raise RuntimeError(f"Arena 只有 {daq.result_arena.shape[0]} 个点, 少于 {num_pixels} 个像素")
+            sums = daq.result_arena[:num_pixels, 0, :]
+            daq.arena_idx = max(daq.arena_idx, num_pixels)
+        else:
+            sums = np.zeros((num_pixels, daq.recordLength), dtype=daq.acc_dtype)
+        counts = np.zeros(num_pixels, dtype=np.int64)
+
+        x_lo = START_X - overscan_um
+        x_hi = START_X + (SCAN_W - 1) * STEP_UM + overscan_um
+        for row in range(SCAN_H):
+            y = START_Y + row * STEP_UM
+            x_from, x_to = (x_lo, x_hi) if row % 2 == 0 else (x_hi, x_lo)
+
+            # 1. 全速移动到行起点 (这段时间的数据直接丢弃)
+            self.stage.set_max_speed(100)
+            self.stage.move_to_serial(x_from, y)
+            self.stage.wait_arrive(x_from, y, self.tol_um, timeout_s=row_timeout_s)
+
+            # 2. 以扫描速度扫过整行, 同时记录位置日志
+            self.stage.set_max_speed(speed_percent)
+            seq = daq.stream_head
+            log_t, log_x = [], []
+            pos_seq = self.stage.pos_head
+            self.stage.move_to_serial(x_to, y)
+            t_end = time.perf_counter() + row_timeout_s
+            arrived = False
+            while not arrived:
+                if self.stage.position_streaming:
+                    # 后台线程的位置历史: 每个样本都带往返中点的时间戳
+                    samples, pos_seq = self.stage.get_position_history(pos_seq)
+                    t1 = time.perf_counter()
+                    if len(samples) == 0:
+                        time.sleep(2e-4)
+                    else:
+                        log_t.extend(samples[:, 3])
+                        log_x.extend(samples[:, 0])
+                        arrived = self.stage.is_at(samples[-1], x_to, y, self.tol_um)
+                else:
+                    t0 = time.perf_counter()
+                    pos = self.stage.get_pos()
+                    t1 = time.perf_counter()
+                    if pos is not None: # 空回复 (超时) 丢弃这一次
+                        log_t.append((t0 + t1) / 2) # 串口往返的中点作为采样时刻
+                        log_x.append(pos[0])
+                        arrived = self.stage.is_at(pos, x_to, y, self.tol_um)
+                if t1 > t_end:
+                    raise TimeoutError(f"第 {row} 行飞行扫描超时")
+                if not log_t:
+                    continue
+
+                # 3. 处理所有时间上已被位置日志覆盖的 Buffer (保证插值而不是外推)
+                seq = self._bin_available(seq, row, log_t, log_x, SCAN_W, STEP_UM, START_X, sums, counts)
+
+            if progress_cb is not None:
+                progress_cb(SCAN_W)
+
+        return sums, counts
+
+    def _bin_available(self, seq, row, log_t, log_x, SCAN_W, STEP_UM, START_X, sums, counts):
+        daq = self.daq
+        while seq < daq.stream_head:
+            records = daq.get_stream_buffer(seq)
+            t_rec = self._record_times(seq)
+            if t_rec[-1] > log_t[-1]:
+                break
+            x_rec = np.interp(t_rec, log_t, log_x)
+            ix = np.rint((x_rec - START_X) / STEP_UM).astype(np.int64)
+            pix = snake_pixel_index(ix, row, SCAN_W)
+            daq.accumulate_record_runs(records, pix, sums, counts)
+            seq += 1
+        return seq
@@ -0,0 +1,167 @@
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+import h5py
+
+
+class HDF5StreamWriter:
+    """
+    边扫描边写盘: 每个像素的 A-line (原始 record 或平均后的 1 条) 由后台线程追加到分块 HDF5 数据集,
+    文件格式为 MATLAB v7.3 MAT-file, PAM_Reconstruction.m 直接 load 即可。
+    内存占用只有队列 + 一个 chunk, 与扫描大小无关; 程序中途异常时已写入的像素也都留在磁盘上。
+
+    MATLAB 按列优先存储, 所以 HDF5 里的维度与 MATLAB 看到的相反:
+      raw_data: HDF5 (Samples, Records, N) -> MATLAB [N, Records, Samples]
+      pos_map:  HDF5 (3, N)                -> MATLAB [N, 3]
+    多通道采集时每个通道一个数据集 (例如 raw_data + raw_data_B), 输入为交织的 record, 写盘线程负责拆分。
+    """
+
+    USERBLOCK_SIZE = 512
+    CHUNK_BYTES = 4 * 1024**2    # 每个 chunk 约 4 MB, 同时也是后台线程一次写入的像素批量
+
+    def __init__(self, path, samples_per_record, records_per_point, dtype=np.uint16,
+                 structs=None, queue_size=64, compression=None, dataset_names=("raw_data",)):
+        """
+        :param records_per_point: 每个像素写入的 record 数 (平均模式为 1)
+        :param structs: 写成 MATLAB struct 的参数, 例如 {"scan_params": {"width": 10, ...}, "daq_params": {...}}
+        :param queue_size: 队列最多缓存多少个像素, 写盘跟不上时 append 会阻塞 (内存有上限)
+        :param compression: h5py 压缩方式, 例如 "gzip"; 默认不压缩以保证写盘速度
+        :param dataset_names: 每个通道的数据集名, 顺序与交织顺序 (AlazarNPTSystem.channelList) 一致
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.channel_count = len(dataset_names)
+        self.samples_per_record = samples_per_record
+        self.point_shape = (records_per_point, samples_per_record * self.channel_count)
+        bytes_per_point = records_per_point * samples_per_record * self.dtype.itemsize
+        self.chunk_points = max(1, self.CHUNK_BYTES // bytes_per_point)
+
+        self.file = h5py.File(path, "w", userblock_size=self.USERBLOCK_SIZE, libver="earliest")
+        for name in dataset_names:
+            ds = self.file.create_dataset(
+                name, shape=(samples_per_record, records_per_point, 0),
+                maxshape=(samples_per_record, records_per_point, None), dtype=self.dtype,
+                chunks=(samples_per_record, records_per_point, self.chunk_points), compression=compression)
+            ds.attrs["MATLAB_class"] = np.bytes_(self.dtype.name)
+        self.pos_map = self.file.create_dataset(
+            "pos_map", shape=(3, 0), maxshape=(3, None), dtype=np.float64,
+            chunks=(3, max(self.chunk_points, 1024)))
+        self.pos_map.attrs["MATLAB_class"] = np.bytes_("double")
+        for name, fields in (structs or {}).items():
+            self._write_struct(name, fields)
+        # 先写好 MATLAB 文件头再重新打开, 扫描中途崩溃留下的文件也能直接 load
+        self.file.close()
+        self._write_matlab_header()
+        self.file = h5py.File(path, "r+")
+        self.datasets = [self.file[name] for name in dataset_names]
+        self.pos_map = self.file["pos_map"]
+
+        self.points_written = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _write_struct(self, name, fields):
+        """标量参数写成 MATLAB struct (组 + 每个字段一个 1x1 double)"""
+        group = self.file.create_group(name)
+        group.attrs["MATLAB_class"] = np.bytes_("struct")
+        names = np.empty(len(fields), dtype=object)
+        names[:] = [np.array(list(k), dtype="S1") for k in fields]
+        group.attrs.create("MATLAB_fields", names, dtype=h5py.vlen_dtype(np.dtype("S1")))
+        for key, value in fields.items():
+            ds = group.create_dataset(key, data=np.full((1, 1), value, dtype=np.float64))
+            ds.attrs["MATLAB_class"] = np.bytes_("double")
+
+    def append(self, point_data, pos):
+        """
+        追加一个像素。point_data 会被 reshape 成 (records_per_point, samples * 通道数), 入队后不要再修改它。
+        :param pos: 位移台坐标, "X,Y,Z" 字符串或 3 个数
+        """
+        if self.error is not None:
+            raise RuntimeError(f"写盘线程已停止: {self.error}")
+        if isinstance(pos, str):
+            pos = [float(v) for v in pos.split(',')]
+        self._queue.put((np.asarray(point_data).reshape(self.point_shape), pos))
+
+    def _writer(self):
+        block = np.empty((self.chunk_points,) + self.point_shape, dtype=self.dtype)
+        block_pos = np.empty((self.chunk_points, 3), dtype=np.float64)
+        n = 0
+        done = False
+        while not done:
+            item = self._queue.get()
+            if item is None:
+                done = True
+            else:
+                block[n] = item[0] # 平均模式下这里顺便完成 float -> uint16 的转换
+                block_pos[n] = item[1]
+                n += 1
+            # 攒满一个 chunk 再写, 每次写入都正好对齐 chunk 边界
+            if n == self.chunk_points or (done and n > 0):
+                try:
+                    self._write_block(block[:n], block_pos[:n])
+                except Exception as e:
+                    self.error = e
+                    print(traceback.format_exc())
+                    self._drain()
+                    return
+                n = 0
+
+    def _write_block(self, block, block_pos):
+        n0 = self.points_written
+        n1 = n0 + block.shape[0]
+        # (n, records, samples, 通道) 的视图, 第 c 个通道就是步长为通道数的切片
+        channels = block.reshape(block.shape[:2] + (self.samples_per_record, self.channel_count))
+        for c, ds in enumerate(self.datasets):
+            ds.resize(n1, axis=2)
+            ds[:, :, n0:n1] = channels[..., c].transpose(2, 1, 0)
+        self.pos_map.resize(n1, axis=1)
+        self.pos_map[:, n0:n1] = block_pos.T
+        self.file.flush()
+        self.points_written = n1
+
+    def _drain(self):
+        """写盘出错后把队列清空, 避免 append 永远阻塞"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+    def close(self, arrays=None):
+        """
+        写完队列中剩余的像素并关闭文件, 返回写入的像素数
+        :param arrays: 扫描结束后才有的小数组 {名称: ndarray} (例如 SNR 图), 按 MATLAB 维度顺序一次写入
+        """
+        if self.file is None:
+            return self.points_written
+        self._queue.put(None)
+        self._thread.join()
+        for name, data in (arrays or {}).items():
+            self._write_array(name, np.asarray(data))
+        self.file.close()
+        self.file = None
+        return self.points_written
+
+    def _write_array(self, name, data):
+        # MATLAB 读到的维度与 HDF5 相反, 转置后写入即可保持 numpy 的维度顺序; 一维数组存为 N x 1 列向量
+        if data.ndim == 1:
+            data = data[:, None]
+        ds = self.file.create_dataset(name, data=data.T)
+        matlab_class = {"float64": "double", "float32": "single", "bool": "logical"}.get(data.dtype.name, data.dtype.name)
+        ds.attrs["MATLAB_class"] = np.bytes_(matlab_class)
+
+    def _write_matlab_header(self):
+        # MAT-file 头: 116 字节文本 + 8 字节子系统偏移 + 版本 0x0200 + 字节序 "IM", 其余填 0
+        text = time.strftime("MATLAB 7.3 MAT-file, Platform: PCWIN64, Created on: %a %b %d %H:%M:%S %Y HDF5 schema 1.00 .")
+        header = text.encode("ascii").ljust(116, b" ") + b"\x00" * 8 + b"\x00\x02" + b"IM"
+        with open(self.path, "r+b") as f:
+            f.write(header.ljust(self.USERBLOCK_SIZE, b"\x00"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,181 @@
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class PriorSerialTransport:
+    """
+    Prior ProScan 串口协议 (每条指令以 \\r 结尾, 每条回复一行) 的流水线传输层。
+    原来每条指令都是 "写 -> 阻塞等回复" 一个完整往返; 这里写入端不等回复, 多条指令可以一次写出,
+    后台读线程按先进先出的顺序把回复依次交给各条指令的 Future (控制器按收到的顺序逐条回复)。
+    N 条指令一次写出只付一次往返延迟 (USB 串口的延迟 + 控制器的响应时间), 而不是 N 次。
+
+    每条指令登记它期待的回复类型, 回复按类型分流, 不会错配:
+      - 移动指令 (G 等) 的 "R" 要等运动结束才来, 不能占着队列: 用 submit_move 提交, "R" 依次交给移动的 Future
+      - 停止指令 (I / K, STOP_COMMANDS) 也回复 "R", 排在普通指令的队列里; 控制器停止时先为每个被取消的移动回复 "R",
+        再回复停止指令本身 (与 PriorVirtualController 相同), 因此队首是停止指令时, 比它先提交的移动先拿到 "R"
+      - 其余指令的回复 (不是 "R") 按顺序交给普通指令; 没有移动或停止在等的 "R" 是多余的回复, 直接丢弃
+    某条回复丢失时后面的对应关系会整体错位: 等回复超时后调用 resync (query / wait_reply 会自动调用) 重新对齐。
+    """
+
+    STOP_COMMANDS = ("I", "K")
+    RESYNC_QUIET_S = 0.1 # resync 后丢弃这么久内迟到的回复, 期间不写出新指令
+
+    def __init__(self, ser):
+        """
+        :param ser: 已打开的 serial.Serial (需设置 timeout, 读线程靠它定期检查是否关闭)
+        """
+        self.ser = ser
+        self._write_lock = threading.Lock() # 写入和登记 Future 必须是同一个原子操作, 顺序才能对上
+        self._pending = collections.deque()  # 等待回复的 (指令, Future, 停止指令的序号 / 普通指令为 None)
+        self._moves = collections.deque()    # 等待 "R" 的 (序号, 移动 Future)
+        self._seq = 0                        # 写出的指令序号, 用来判断移动是否在某条停止指令之前提交
+        self._discard_until = 0.             # resync 后在这个时刻 (time.perf_counter) 之前收到的普通回复都丢弃
+        self._running = True
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._thread.start()
+
+    # =====================================================
+    #  提交指令
+    # =====================================================
+
+    def submit(self, cmd):
+        """写出一条指令, 立即返回 Future (结果为去掉空白的回复字符串)"""
+        return self.submit_many([cmd])[0]
+
+    def submit_many(self, cmds):
+        """把多条指令拼成一次写入 (背靠背发送), 返回与 cmds 一一对应的 Future 列表"""
+        futures = [Future() for _ in cmds]
+        data = "".join(cmd + "\r" for cmd in cmds).encode('ascii')
+        self._wait_resync()
+        with self._write_lock:
+            self._check_open()
+            for cmd, future in zip(cmds, futures):
+                self._seq += 1
+                is_stop = cmd.split(",")[0].strip().upper() in self.STOP_COMMANDS
+                self._pending.append((cmd, future, self._seq if is_stop else None))
+            self.ser.write(data)
+        return futures
+
+    def submit_move(self, cmd):
+        """写出移动指令, 返回在运动完成 (收到 "R") 时完成的 Future"""
+        future = Future()
+        self._wait_resync()
+        with self._write_lock:
+            self._check_open()
+            self._seq += 1
+            self._moves.append((self._seq, future))
+            self.ser.write((cmd + "\r").encode('ascii'))
+        return future
+
+    def query(self, cmd, timeout=1.):
+        """发送一条指令并等待回复 (一个往返)"""
+        return self.wait_reply(self.submit(cmd), timeout)
+
+    def query_many(self, cmds, timeout=1.):
+        """多条指令一次写出, 等全部回复 (总共一个往返), 返回回复列表"""
+        futures = self.submit_many(cmds)
+        return [self.wait_reply(f, timeout) for f in futures]
+
+    def wait_reply(self, future, timeout):
+        """等待 submit 返回的 Future; 超时说明回复丢了 (或还在路上), 先 resync 再抛出 TimeoutError"""
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            self.resync()
+            raise
+
+    def resync(self):
+        """
+        重新对齐回复队列: 所有还在等回复的普通 / 停止指令以 TimeoutError 结束,
+        RESYNC_QUIET_S 内迟到的普通回复直接丢弃 (期间新指令等到窗口结束再写出), 之后从空队列重新开始对应。
+        移动的 "R" 不受影响。
+        """
+        with self._write_lock:
+            futures = [f for _, f, _ in self._pending]
+            self._pending.clear()
+            self._discard_until = time.perf_counter() + self.RESYNC_QUIET_S
+        for future in futures:
+            if not future.done():
+                future.set_exception(TimeoutError("串口回复超时, 回复队列已重新对齐"))
+
+    def _wait_resync(self):
+        delay = self._discard_until - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aquery(self, cmd):
+        """asyncio 版本的 query: await transport.aquery("P")"""
+        return await asyncio.wrap_future(self.submit(cmd))
+
+    async def aquery_many(self, cmds):
+        return list(await asyncio.gather(*[asyncio.wrap_future(f) for f in self.submit_many(cmds)]))
+
+    @property
+    def pending_moves(self):
+        return len(self._moves)
+
+    @property
+    def closed(self):
+        """已 close() 或读线程因串口错误退出后为 True, 之后提交的指令都会抛 ConnectionError"""
+        return not self._running
+
+    def _check_open(self):
+        if not self._running:
+            raise ConnectionError("串口传输已关闭")
+
+    # =====================================================
+    #  后台读线程
+    # =====================================================
+
+    def _reader(self):
+        buf = b""
+        while self._running:
+            try:
+                chunk = self.ser.read_until(b'\r')
+            except Exception as e:
+                self._running = False
+                self._fail_all(ConnectionError(f"串口读取失败: {e}"))
+                return
+            buf += chunk
+            # read_until 超时时可能只读到半行, 留到下一次拼起来
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                self._dispatch(line.decode('ascii', errors='ignore').strip())
+
+    def _dispatch(self, resp):
+        with self._write_lock:
+            head = self._pending[0] if self._pending else None
+            if resp == "R":
+                stop_seq = head[2] if head is not None else None
+                if self._moves and (stop_seq is None or self._moves[0][0] < stop_seq):
+                    # 普通完成的移动, 或被队首的停止指令取消的移动
+                    _, future = self._moves.popleft()
+                elif stop_seq is not None:
+                    _, future, _ = self._pending.popleft()
+                else:
+                    return # 没有移动或停止指令在等的 "R", 是多余的回复, 丢弃 (不能交给普通指令)
+            elif time.perf_counter() < self._discard_until or head is None:
+                return # resync 之后迟到的回复, 或没有指令在等, 丢弃
+            else:
+                _, future, _ = self._pending.popleft()
+        if not future.done():
+            future.set_result(resp)
+
+    def _fail_all(self, exc):
+        with self._write_lock:
+            futures = [f for _, f, _ in self._pending] + [f for _, f in self._moves]
+            self._pending.clear()
+            self._moves.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+    def close(self):
+        """停止读线程, 未完成的 Future 以 ConnectionError 结束 (不关闭串口本身)"""
+        self._running = False
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._fail_all(ConnectionError("串口传输已关闭"))
@@ -1,46 +1,77 @@
-from ctypes import WinDLL, create_string_buffer
+from ctypes import create_string_buffer
+try:
+    from ctypes import WinDLL
+except ImportError: # 非 Windows: 没有 SDK, 只能用串口模式 (例如连接 PriorVirtualController)
+    WinDLL = None
 import os
 import serial
+import threading
 import time
 import sys
 import atexit
+import numpy as np
+
+from Alazar_imaging.PriorSerialTransport import PriorSerialTransport
 
 class PriorUnifiedStage:
-    def __init__(self, dll_path, com_port_number, baudrate=115200):
+    REPLY_TIMEOUT_S = 1. # 串口指令等待回复的上限
+    POS_RETRY_MAX_S = 0.5 # 位置线程查询失败时退避等待的上限
+    def __init__(self, dll_path=None, com_port_number="4", baudrate=115200, serial_session=True):
         """
         初始化 Prior 显微镜控制系统。
-        :param dll_path: PriorScientificSDK.dll 的绝对路径
-        :param com_port_number: 端口号字符串 (例如 "4" 代表 COM4)
+        :param dll_path: PriorScientificSDK.dll 的绝对路径; None 为纯串口模式 (不加载 SDK)
+        :param com_port_number: 端口号字符串 (例如 "4" 代表 COM4), 或完整的串口路径 (例如 "/dev/pts/5")
         :param baudrate: 串口波特率 (默认 115200)
+        :param serial_session: True (默认) 初始化后直接打开串口并一直保持, 移动 / 读写位置 / 停止 / 状态这些 SDK 指令
+                               都改用等价的串口 ASCII 指令 (见 _sdk_over_serial), 不再在 SDK 和串口之间来回切换
+                               (每次切换都要关闭重开 COM 口并等待 0.1s); 只有没有串口等价指令的 SDK 指令才会切到 SDK。
+                               False 为原来的行为 (默认 SDK 模式)
         """
         self.dll_path = dll_path
         self.port_sdk_str = str(com_port_number)           # SDK 格式: "4"
-        self.port_serial_str = f"COM{com_port_number}"     # Pyserial 格式: "COM4"
+        if self.port_sdk_str.isdigit():
+            self.port_serial_str = f"COM{com_port_number}" # Pyserial 格式: "COM4"
+        else:
+            self.port_serial_str = self.port_sdk_str       # 已经是完整路径
         self.baudrate = baudrate
         
         # 状态标志
         self.mode = 'OFFLINE'  # 'SDK', 'SERIAL', 'OFFLINE'
         self.ser = None        # 存储 serial 对象
+        self.transport = None  # 串口模式下的流水线传输层 (PriorSerialTransport), 所有串口指令都经过它
+        self._pos_thread = None
+        self._pos_running = False
+        self._pos_slot = None   # 最新位置 (x, y, z, t), 整个元组一次赋值, 读取不需要加锁
+        self._pos_history = None
+        self.pos_head = 0       # 已发布的位置样本总数 (历史环形队列的写指针)
         
-        # --- 1. 加载 SDK DLL ---
-        if os.path.exists(dll_path):
-            self.SDKPrior = WinDLL(dll_path)
-        else:
-            raise RuntimeError(f"DLL not found at: {dll_path}")
-            
-        self.SDKPrior.PriorScientificSDK_Initialise()
-        self.sessionID = self.SDKPrior.PriorScientificSDK_OpenNewSession()
-        
-        if self.sessionID < 0:
-            raise RuntimeError(f"Error getting sessionID: {self.sessionID}")
-            
+        self.SDKPrior = None
+        self.sessionID = None
         self.rx = create_string_buffer(5000) # 加大缓冲区防止溢出
+
+        # --- 1. 加载 SDK DLL ---
+        if dll_path is not None:
+            if WinDLL is None:
+                raise RuntimeError("PriorScientificSDK 只能在 Windows 上加载, 其他平台请用 dll_path=None (纯串口模式)")
+            if os.path.exists(dll_path):
+                self.SDKPrior = WinDLL(dll_path)
+            else:
+                raise RuntimeError(f"DLL not found at: {dll_path}")
+
+            self.SDKPrior.PriorScientificSDK_Initialise()
+            self.sessionID = self.SDKPrior.PriorScientificSDK_OpenNewSession()
+
+            if self.sessionID < 0:
+                raise RuntimeError(f"Error getting sessionID: {self.sessionID}")
         
         # --- 2. 注册安全急停 ---
         atexit.register(self.emergency_stop)
         
-        # --- 3. 初始连接 (默认进入 SDK 模式) ---
-        self.connect_sdk()
+        # --- 3. 初始连接 (串口会话, 或原来的 SDK 模式; 没有 SDK 时总是串口) ---
+        if serial_session or self.SDKPrior is None:
+            self.connect_serial()
+        else:
+            self.connect_sdk()
 
     # =====================================================
     #  核心机制：模式切换 (自动管理端口独占)
@@ -48,6 +79,9 @@ class PriorUnifiedStage:
     
     def connect_sdk(self):
         """切换到 SDK 控制模式"""
+        if self.SDKPrior is None:
+            return # 纯串口模式, 没有 SDK 可切换, 保持串口连接
+
         # 如果当前占着串口，先断开
         if self.mode == 'SERIAL':
             self.disconnect_serial()
@@ -78,13 +112,19 @@ class PriorUnifiedStage:
                 # print(f"🔌 [切换] 连接原生串口模式...")
                 self.ser = serial.Serial(self.port_serial_str, self.baudrate, timeout=0.05)
                 self.ser.flushInput()
-                self._serial_send_wait("COMP,0") # 确保标准模式
+                self.transport = PriorSerialTransport(self.ser)
+                # 确保标准模式。不等回复: 回复按顺序对应, 之后的第一条指令 (例如移动) 与它一起只付一个往返
+                self.transport.submit("COMP,0")
                 self.mode = 'SERIAL'
             except Exception as e:
                 print(f"❌ 串口连接失败: {e}")
                 self.connect_sdk() # 失败则回滚到 SDK
 
     def disconnect_serial(self):
+        self.stop_position_stream()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
         if self.ser and self.ser.is_open:
             self.ser.close()
         self.mode = 'OFFLINE'
@@ -95,15 +135,50 @@ class PriorUnifiedStage:
 
     def cmd_sdk_raw(self, msg):
         """(内部函数) 直接调用 DLL 发送指令"""
+        if self.SDKPrior is None:
+            raise RuntimeError("纯串口模式 (dll_path=None) 没有 SDK, 请使用串口指令")
         return self.SDKPrior.PriorScientificSDK_cmd(
             self.sessionID, create_string_buffer(msg.encode()), self.rx
         )
 
+    def _sdk_over_serial(self, msg):
+        """
+        (内部函数) 用串口 ASCII 指令执行 SDK 指令, 回复格式与 SDK 相同; 没有等价指令时返回 None。
+          controller.stage.position.get        -> P       "x,y"
+          controller.stage.position.set x y    -> PS,x,y  (重新定义当前位置)
+          controller.stage.goto-position x y   -> G,x,y   (立即返回, 不等到位)
+          controller.stage.busy.get            -> $       运动状态位 (0 为静止)
+          controller.z.position.get            -> PZ
+          controller.stop.smoothly / abruptly  -> I / K
+        :return: (错误码, 响应字符串), 串口无回复或回复错误码 (E,n) 时错误码为 -1
+        """
+        parts = msg.split()
+        name, args = parts[0], parts[1:]
+        if name == "controller.stage.goto-position":
+            return (0, "") if self.move_to_serial(int(args[0]), int(args[1])) is not None else (-1, "")
+        if name == "controller.stage.position.get":
+            pos = self.get_pos()
+            return (0, f"{pos[0]},{pos[1]}") if pos is not None else (-1, "")
+        ascii_cmd = {"controller.stage.position.set": "PS", "controller.stage.busy.get": "$",
+                     "controller.z.position.get": "PZ", "controller.stop.smoothly": "I",
+                     "controller.stop.abruptly": "K"}.get(name)
+        if ascii_cmd is None:
+            return None
+        resp = self._serial_send_wait(",".join([ascii_cmd] + args))
+        if not resp or resp.startswith("E"):
+            return -1, resp
+        return 0, ("" if ascii_cmd in ("PS", "I", "K") else resp) # 设置 / 停止类指令 SDK 没有响应字符串
+
     def cmd(self, msg):
         """
         [原函数复原] 发送指令并返回 (错误码, 响应字符串)
-        会自动检查并切换到 SDK 模式。
+        串口会话中有串口等价指令的 SDK 指令直接走串口 (同时更新 self.rx), 其余的自动切换到 SDK 模式。
         """
+        if self.mode == 'SERIAL' or self.SDKPrior is None:
+            result = self._sdk_over_serial(msg)
+            if result is not None:
+                self.rx.value = result[1].encode()
+                return result
         if self.mode != 'SDK': self.connect_sdk()
         ret = self.cmd_sdk_raw(msg)
         return ret, self.rx.value.decode()
@@ -112,8 +187,7 @@ class PriorUnifiedStage:
         """
         [原函数复原] 仅发送指令，不返回结果 (但会更新 self.rx)
         """
-        if self.mode != 'SDK': self.connect_sdk()
-        self.cmd_sdk_raw(msg)
+        self.cmd(msg)
         
     def get_ID(self):
         """[原函数复原] 获取 Session ID"""
@@ -121,22 +195,36 @@ class PriorUnifiedStage:
     
     def get_SDK_version(self): # 原名 get_SDK_vision，修正了拼写
         """[原函数复原] 获取 SDK 版本"""
+        if self.SDKPrior is None:
+            raise RuntimeError("纯串口模式 (dll_path=None) 没有 SDK")
         return self.SDKPrior.PriorScientificSDK_Version(self.rx)
 
     def get_position(self): 
-        """[原函数复原] 获取当前位置 (SDK方式)"""
-        if self.mode != 'SDK': self.connect_sdk()
-        self.cmd_sdk_raw("controller.stage.position.get")
-        return self.rx.value.decode()
+        """[原函数复原] 获取当前位置 "x,y" (串口会话中用 P, 不切换模式)"""
+        return self.cmd("controller.stage.position.get")[1]
     
     def set_position(self, position: list): 
-        """[原函数复原] 移动到指定位置 (SDK方式)"""
-        if self.mode != 'SDK': self.connect_sdk()
-        self.cmd_sdk_raw(f"controller.stage.goto-position {position[0]} {position[1]}")
-    
+        """[原函数复原] 移动到指定位置, 不等到位 (串口会话中用 G)"""
+        self.cmd_simple(f"controller.stage.goto-position {position[0]} {position[1]}")
+
+    def define_position(self, x, y):
+        """把当前位置重新定义为 (x, y) (不运动), 返回错误码"""
+        return self.cmd(f"controller.stage.position.set {x} {y}")[0]
+
+    def is_moving(self):
+        """XY 是否正在运动 (运动状态位不为 0)"""
+        ret, resp = self.cmd("controller.stage.busy.get")
+        return ret == 0 and resp.strip() not in ("", "0")
+
+    def stop(self):
+        """平稳停止运动并清空指令队列 (急停见 emergency_stop)"""
+        return self.cmd("controller.stop.smoothly")[0]
+
     def stage_deinitial(self):
-        """[原函数复原] 断开控制器连接"""
-        return self.disconnect_sdk()
+        """[原函数复原] 断开控制器连接 (SDK 和串口)"""
+        ret = self.disconnect_sdk()
+        self.disconnect_serial()
+        return ret
 
     # =====================================================
     #  Part B: 新增的高速扫描功能 (串口直连)
@@ -144,13 +232,26 @@ class PriorUnifiedStage:
 
     def _serial_send_wait(self, cmd_text):
         """(内部函数) 串口发送并等待回复"""
-        if not self.ser: return ""
+        return self._serial_send_many([cmd_text])[0]
+
+    def _serial_send_many(self, cmds):
+        """
+        (内部函数) 多条指令一次写出, 回复按顺序对应, 总共只等一个往返。
+        move_to_serial 的移动完成回复 "R" 由传输层单独处理, 不会被当成这些指令的回复。
+        超时 / 串口错误时对应的回复为 ""。
+        """
+        if not self.transport: return [""] * len(cmds)
         try:
-            # self.ser.flushInput()
-            self.ser.write((cmd_text + "\r").encode('ascii'))
-            return self.ser.read_until(b'\r').decode('ascii', errors='ignore').strip()
+            futures = self.transport.submit_many(cmds)
         except Exception:
-            return ""
+            return [""] * len(cmds)
+        resps = []
+        for future in futures:
+            try:
+                resps.append(self.transport.wait_reply(future, self.REPLY_TIMEOUT_S)) # 超时会重新对齐回复队列
+            except Exception:
+                resps.append("")
+        return resps
 
     def prepare_scan_serial(self, width_px, height_px, step_um, 
                             exposure_ms, settle_ms, ttl_pin=1):
@@ -161,33 +262,176 @@ class PriorUnifiedStage:
         self.connect_serial()
         # print(f"⚙️ [Stage] 配置扫描: {width_px}x{height_px}, 步长{step_um}um")
         
-        # 发送网格参数
-        self._serial_send_wait(f"N,{width_px-1},{height_px-1}")
-        self._serial_send_wait(f"X,{step_um},{step_um}")
-        
-        # 发送 AutoScan 参数
+        # 网格参数 + AutoScan 参数一次写出, 只等一个往返
         # AS, 曝光, 稳定, TTL脚, 高电平触发(H), 蛇形扫描(S)
         cfg_str = f"AS,{exposure_ms},{settle_ms},{ttl_pin},H,S"
-        resp = self._serial_send_wait(cfg_str)
-        if "E" in resp: print(f"⚠️ Stage配置警告: {resp}")
+        resps = self._serial_send_many([f"N,{width_px-1},{height_px-1}", f"X,{step_um},{step_um}", cfg_str])
+        for resp in resps:
+            if "E" in resp: print(f"⚠️ Stage配置警告: {resp}")
 
     def start_scan_motion(self):
         """发送启动指令 (AS,1)"""
         # print("🚀 [Stage] 启动物理运动 (AS,1)")
         self._serial_send_wait("AS,1")
 
+    @staticmethod
+    def parse_pos(resp):
+        """
+        把控制器的位置回复 "X,Y,Z" 解析为整数 (x, y, z); 允许空格和正负号 (例如 " -12, +5,0"),
+        空回复 (超时) 或错误码 (E,n) 返回 None。
+        """
+        try:
+            x, y, z = [int(v) for v in resp.split(',')]
+        except (ValueError, AttributeError):
+            return None
+        return x, y, z
+
+    def get_pos(self):
+        """
+        高速读取位置 (仅串口模式下可用), 返回整数 (x, y, z), 读取失败为 None。
+        后台位置线程运行时直接返回它发布的最新位置, 不访问串口。
+        """
+        if self._pos_running:
+            t_end = time.perf_counter() + 1.
+            while self._pos_slot is None: # 线程刚启动, 等第一个样本
+                if time.perf_counter() > t_end:
+                    raise TimeoutError("后台位置线程 1s 内没有读到位置, 请检查串口")
+                time.sleep(1e-4)
+            return self._pos_slot[:3]
+        return self.parse_pos(self._serial_send_wait("P"))
+
     def get_pos_fast(self):
         """
-        高速读取位置 (仅串口模式下可用)。
-        返回字符串 "X,Y,Z"
+        与 get_pos 相同, 返回字符串 "X,Y,Z" (读取失败为 "")。
+        新代码请用 get_pos / is_at, 不要按字符串比较位置 (空格、正负号、Z 的变化都会导致永远 "不相等")。
+        """
+        pos = self.get_pos()
+        return "" if pos is None else f"{pos[0]},{pos[1]},{pos[2]}"
+
+    @staticmethod
+    def is_at(pos, x, y, tol_um=0):
+        """pos (get_pos 的返回值) 的 XY 是否在 (x, y) 的 tol_um 以内 (各轴分别比较, 不看 Z)"""
+        return pos is not None and abs(pos[0] - x) <= tol_um and abs(pos[1] - y) <= tol_um
+
+    def wait_arrive(self, x, y, tol_um=0, settle_s=0., timeout_s=10.):
+        """
+        轮询位置直到 XY 到达 (x, y) 的 tol_um 以内; settle_s > 0 时等待 settle_s 后再确认一次, 仍在范围内才算停稳。
+        :return: 确认时的 (x, y, z)
+        :raises TimeoutError: timeout_s 内没有到达 (不会无限等待)
+        """
+        t_end = time.perf_counter() + timeout_s
+        while time.perf_counter() < t_end:
+            pos = self.get_pos()
+            if self.is_at(pos, x, y, tol_um):
+                if settle_s <= 0:
+                    return pos
+                time.sleep(settle_s)
+                pos = self.get_pos()
+                if self.is_at(pos, x, y, tol_um):
+                    return pos
+            time.sleep(max(settle_s / 2, 1e-3)) # settle_s=0 时也不空转
+        raise TimeoutError(f"位移台未能在 {timeout_s}s 内到达 ({x},{y}) ±{tol_um}um, 当前位置 {self.get_pos()}")
+
+    # =====================================================
+    #  后台位置线程 (串口模式)
+    # =====================================================
+
+    def start_position_stream(self, history=8192, poll_interval_s=0.):
+        """
+        启动后台线程, 以控制器能达到的最高频率不停地查询位置 (P), 每次查询结果发布为:
+          - latest_position(): 最新的 (x, y, z, t), 一个元组整体替换, 主线程读取时不加锁也不访问串口
+          - get_position_history(): 有界环形队列 (history 个样本), 飞行扫描可按时间戳插值
+        t 是查询往返的中点 (time.perf_counter, 与 DAQ 的 Buffer 完成时间同一时钟)。
+        运行期间其他串口指令 (移动 / 设置速度等) 照常可用, 它们与位置查询经同一个传输层按写入顺序得到回复。
+        查询失败 (超时 / 错误码) 时按指数退避等待 (上限 POS_RETRY_MAX_S); 传输层关闭后线程自行退出, position_streaming 变为 False。
+        :param poll_interval_s: 两次查询之间的额外间隔, 0 为全速
         """
-        return self._serial_send_wait("P")
+        if self.mode != 'SERIAL':
+            self.connect_serial()
+        if self._pos_running:
+            return
+        self._pos_history = np.zeros((history, 4), dtype=np.float64) # (x, y, z, t)
+        self.pos_head = 0
+        self._pos_slot = None
+        self._pos_running = True
+        self._pos_thread = threading.Thread(target=self._position_worker, args=(poll_interval_s,), daemon=True)
+        self._pos_thread.start()
+
+    @property
+    def position_streaming(self):
+        return self._pos_running
+
+    def stop_position_stream(self):
+        self._pos_running = False
+        if self._pos_thread is not None:
+            self._pos_thread.join()
+            self._pos_thread = None
+
+    def _position_worker(self, poll_interval_s):
+        history = self._pos_history
+        retry_s = max(poll_interval_s, 1e-3)
+        while self._pos_running:
+            transport = self.transport
+            if transport is None or transport.closed:
+                self._pos_running = False # 传输层已关闭 (断开或串口出错), 不再查询
+                break
+            t0 = time.perf_counter()
+            resp = self._serial_send_wait("P")
+            t1 = time.perf_counter()
+            pos = self.parse_pos(resp)
+            if pos is None:
+                # 空回复 (超时) 或错误码, 丢弃这一次; 指数退避, 断线时不会空转占满一个核
+                time.sleep(retry_s)
+                retry_s = min(retry_s * 2, max(poll_interval_s, self.POS_RETRY_MAX_S))
+                continue
+            retry_s = max(poll_interval_s, 1e-3)
+            sample = pos + ((t0 + t1) / 2,)
+            # 先写历史再推进 head, 读者只读 head 之前的样本
+            history[self.pos_head % len(history)] = sample
+            self.pos_head += 1
+            self._pos_slot = sample
+            if poll_interval_s > 0:
+                time.sleep(poll_interval_s)
+
+    def latest_position(self):
+        """后台位置线程发布的最新 (x, y, z, t), 还没有样本时为 None"""
+        return self._pos_slot
+
+    def get_position_history(self, since=0):
+        """
+        返回序号 [since, pos_head) 的位置样本 (n, 4) = (x, y, z, t) 的副本和下一次调用用的序号。
+        已被环形队列覆盖的旧样本自动跳过 (since 太旧时只返回还在队列里的部分)。
+        """
+        head = self.pos_head
+        history = self._pos_history
+        if history is None:
+            return np.zeros((0, 4)), head
+        since = max(since, head - len(history) + 1) # 留一个槽位: 写线程可能正在覆盖最旧的样本
+        idx = np.arange(since, head) % len(history)
+        return history[idx], head
+
+    def set_max_speed(self, percent):
+        """设置 XY 最大速度 (SMS, 1~100 表示最大速度的百分比), 飞行扫描时决定扫描速度"""
+        return self._serial_send_wait(f"SMS,{int(percent)}")
+
+    def move_to_serial(self, x, y):
+        """
+        发送绝对移动指令 (G,x,y) 后立即返回, 不等待移动完成。
+        控制器在移动完成时回复 "R", 返回的 Future 此时完成 (需要等到位时可 .result(timeout))。
+        """
+        if not self.transport: return None
+        return self.transport.submit_move(f"G,{x},{y}")
 
     def is_scan_running(self):
         """检查 AutoScan 是否还在运行 (返回 True/False)"""
         status = self._serial_send_wait("AS")
         return status != "0"
 
+    def get_status_and_pos(self):
+        """一个往返同时查询 AutoScan 状态和位置, 返回 (是否还在扫描, (x, y, z) 或 None)"""
+        status, pos = self._serial_send_many(["AS", "P"])
+        return status != "0", self.parse_pos(pos)
+
     # =====================================================
     #  Part C: 安全急停
     # =====================================================
@@ -198,7 +442,11 @@ class PriorUnifiedStage:
         """
         # 1. 如果在串口模式，发送 I 和 K
         try:
-            if self.mode == 'SERIAL' and self.ser:
+            if self.mode == 'SERIAL' and self.transport:
+                # 经传输层写出: I / K 登记为停止指令, 它们的 "R" 不会错配给移动或其他指令
+                self.transport.submit("I"); time.sleep(0.05)
+                self.transport.submit("K")
+            elif self.mode == 'SERIAL' and self.ser:
                 self.ser.write(b"I\r"); time.sleep(0.05)
                 self.ser.write(b"K\r")
         except:
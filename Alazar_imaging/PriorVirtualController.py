@@ -0,0 +1,334 @@
+'''
+不依赖硬件的 Prior ProScan 控制器, 挂在一个伪终端 (pty) 上 (Linux / macOS)。
+
+PriorUnifiedStage / PriorSerialTransport / Tool_code 里的串口脚本像打开真实串口一样打开 controller.port (例如 /dev/pts/5),
+用于在没有位移台的机器上调试串口协议、测量往返延迟和 AutoScan 的时序。
+
+- 控制器逐条处理指令, 每条回复一行 (\\r 结尾), 顺序与收到指令的顺序相同
+- 延迟模型: 单程链路延迟 latency_s (USB 串口的延迟计时器) + 每条指令的处理时间 process_s
+  + 按波特率计算的字节传输时间。一问一答每条指令都要付一次往返, 背靠背写出的多条指令只付一次
+- 运动模型: XY 同时运动, 按位移较大的轴计算梯形速度曲线 (加速度 accel_um_s2, 最高速度 speed_um_s * SMS%),
+  到位后再等 settle_s 才算完成。G 指令排在当前运动之后执行, 完成时回复 "R"
+- AS,1 按 N / X / AS 的参数做蛇形 AutoScan: 每个点 到位 -> 等待 (settle_s + AS 的等待 ms) -> TTL 高电平 (AS 的脉冲 ms) -> 下一个点,
+  TTL 边沿时刻记录在 ttl_edges() (time.perf_counter 时钟, 与 DAQ 的 Buffer 完成时间可直接比较)
+- 支持 COMP / P / PZ / PS / $ / G / N / X / AS / SMS / BAUD / ? / VERSION / I / K; 扫描进行中改 N / X / AS 参数回复 E,18 (与实机相同)
+- BAUD,b (96 / 19 / 38 / 57 / 115) 回复后切换波特率; 主机端串口的波特率与控制器不一致时只会收到乱码
+
+单独运行 (python -m Alazar_imaging.PriorVirtualController) 时打印端口并保持运行, 可供 Tool_code 的串口脚本连接。
+
+用法:
+    with PriorVirtualController() as controller:
+        ser = serial.Serial(controller.port, 115200, timeout=0.05)
+'''
+import bisect
+import heapq
+import math
+import os
+import select
+import termios
+import threading
+import time
+import tty
+
+
+class PriorVirtualController:
+    BAUD_CODES = {96: 9600, 19: 19200, 38: 38400, 57: 57600, 115: 115200}
+
+    def __init__(self, baudrate=115200, latency_s=1e-3, process_s=0.2e-3, speed_um_s=5000., accel_um_s2=1e5,
+                 settle_s=0., ttl_delay_s=0.):
+        '''
+        :param baudrate: 控制器当前的波特率 (主机端串口必须相同)
+        :param latency_s: 单程链路延迟 (主机 -> 控制器, 控制器 -> 主机 各一次)
+        :param process_s: 控制器处理一条指令的时间 (逐条处理)
+        :param speed_um_s: SMS,100 时的 XY 最高速度
+        :param accel_um_s2: XY 加速度 (加速和减速相同)
+        :param settle_s: 每次到位后的稳定时间 (G 的 "R" 和 AutoScan 的 TTL 都在稳定之后)
+        :param ttl_delay_s: AutoScan 等待结束到 TTL 上升沿的硬件延迟
+        '''
+        self.baudrate = baudrate
+        self.latency_s = latency_s
+        self.process_s = process_s
+        self.speed_um_s = speed_um_s
+        self.accel_um_s2 = accel_um_s2
+        self.settle_s = settle_s
+        self.ttl_delay_s = ttl_delay_s
+        self.speed_percent = 100
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        # 运动时间线: 按时间排列的 (开始, 结束, 起点, 终点) 直线段, 最后一段之后停在终点
+        self._segments = []
+        self._rest = (0, 0)
+        self.z = 0
+        self.grid = (0, 0)      # N: 网格的列数-1, 行数-1
+        self.step = (1, 1)      # X: 步长 (um)
+        self.autoscan = None    # AS 配置 (脉冲 ms, 等待 ms)
+        self._scan_end = 0.     # 当前 AutoScan 的结束时刻
+        self._ttl = []          # (上升沿, 下降沿), 时间递增
+
+        self._lock = threading.Lock() # 收发线程和 position() / ttl_edges() 的调用者共用运动状态
+        self._outbox = []       # (发送时刻, 序号, 字节, 是否为移动完成的 "R"), 按时间发送
+        self._seq = 0
+        self._busy_until = 0.
+        self.commands = 0       # 已处理的指令数
+        self._running = True
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    # ---------------- 运动模型 ----------------
+
+    def _speed(self):
+        return self.speed_um_s * self.speed_percent / 100.
+
+    def move_time(self, distance_um):
+        '''梯形速度曲线走完 distance_um 的时间 (不含稳定时间); 距离不够加到最高速度时为三角形曲线'''
+        v, a = self._speed(), self.accel_um_s2
+        if distance_um <= v * v / a:
+            return 2. * math.sqrt(distance_um / a)
+        return distance_um / v + v / a
+
+    def _travelled(self, distance_um, tau):
+        '''梯形速度曲线开始后 tau 秒走过的距离'''
+        v, a = self._speed(), self.accel_um_s2
+        total = self.move_time(distance_um)
+        if tau >= total:
+            return distance_um
+        t_acc = min(v / a, total / 2.)
+        if tau <= t_acc:
+            return 0.5 * a * tau * tau
+        if tau <= total - t_acc:
+            return 0.5 * a * t_acc * t_acc + a * t_acc * (tau - t_acc)
+        return distance_um - 0.5 * a * (total - tau) ** 2
+
+    def _end_time(self):
+        return self._segments[-1][1] if self._segments else 0.
+
+    def _end_position(self):
+        return self._segments[-1][3] if self._segments else self._rest
+
+    def _add_move(self, t0, p0, p1):
+        '''从 t0 开始 p0 -> p1 的一段运动, 返回到位 (含稳定) 的时刻'''
+        distance = max(abs(p1[0] - p0[0]), abs(p1[1] - p0[1]))
+        t1 = t0 + self.move_time(distance)
+        self._segments.append((t0, t1, p0, p1))
+        return t1 + self.settle_s
+
+    def position(self, t=None):
+        '''t 时刻的 (x, y) (整数 um)'''
+        if t is None:
+            t = time.perf_counter()
+        with self._lock:
+            return self._position(t)
+
+    def _position(self, t):
+        i = bisect.bisect_right(self._segments, t, key=lambda s: s[1])
+        if i == len(self._segments):
+            return self._end_position()
+        t0, t1, (x0, y0), (x1, y1) = self._segments[i]
+        if t <= t0:
+            return x0, y0
+        distance = max(abs(x1 - x0), abs(y1 - y0))
+        frac = self._travelled(distance, t - t0) / distance
+        return int(round(x0 + (x1 - x0) * frac)), int(round(y0 + (y1 - y0) * frac))
+
+    def _prune(self, t):
+        '''丢弃 t 之前已经结束的运动段 (长时间运行时时间线不无限增长)'''
+        i = bisect.bisect_right(self._segments, t, key=lambda s: s[1])
+        if i:
+            self._rest = self._segments[i - 1][3]
+            del self._segments[:i]
+
+    def _stop(self, t):
+        '''I / K: 停在 t 时刻的位置, 丢弃之后的运动和 TTL, 未完成的移动立即回复 "R"'''
+        self._rest = self._position(t)
+        self._segments = []
+        self._scan_end = min(self._scan_end, t)
+        self._ttl = [(rise, min(fall, t)) for rise, fall in self._ttl if rise <= t]
+        self._outbox = [(min(t_send, t + self.latency_s), seq, data, move) if move else (t_send, seq, data, move)
+                        for t_send, seq, data, move in self._outbox]
+        heapq.heapify(self._outbox)
+
+    def _start_scan(self, t):
+        '''AS,1: 从当前运动结束处开始蛇形扫描, 预先排好每个点的运动段和 TTL 边沿'''
+        pulse_ms, wait_ms = self.autoscan
+        cols, rows = self.grid[0] + 1, self.grid[1] + 1
+        t_point = max(t, self._end_time())
+        origin = self._end_position()
+        prev = origin
+        for k in range(cols * rows):
+            row, col = divmod(k, cols)
+            if row % 2:
+                col = cols - 1 - col
+            p = (origin[0] + col * self.step[0], origin[1] + row * self.step[1])
+            if k:
+                t_point = self._add_move(t_point, prev, p)
+            rise = t_point + wait_ms / 1000. + self.ttl_delay_s
+            fall = rise + pulse_ms / 1000.
+            self._ttl.append((rise, fall))
+            t_point = fall
+            prev = p
+        self._scan_end = t_point
+
+    def ttl_edges(self, since=0., until=None):
+        '''since <= 上升沿 <= until (默认为现在) 的 TTL 脉冲, 返回 [(上升沿, 下降沿)]'''
+        if until is None:
+            until = time.perf_counter()
+        with self._lock:
+            return [(rise, fall) for rise, fall in self._ttl if since <= rise <= until]
+
+    def scan_duration(self, cols, rows, pulse_ms, wait_ms, step_um):
+        '''按当前运动参数估算 AutoScan 的总时间 (不含链路延迟), 用于和实测比较'''
+        point_s = wait_ms / 1000. + self.ttl_delay_s + pulse_ms / 1000.
+        return cols * rows * point_s + (cols * rows - 1) * (self.move_time(step_um) + self.settle_s)
+
+    # ---------------- 指令 ----------------
+
+    def _execute(self, line, t):
+        '''处理一条指令, 返回 (回复, 额外的延迟回复 [(时刻, 文本)])'''
+        parts = line.strip().split(',')
+        cmd, args = parts[0].upper(), parts[1:]
+        self._prune(t - 1.)
+        scanning = t < self._scan_end
+        try:
+            if cmd == "P":
+                x, y = self._position(t)
+                return f"{x},{y},{self.z}", []
+            if cmd == "PZ":
+                return str(self.z), []
+            if cmd == "PS":
+                # 重新定义当前位置 (只改坐标系, 不运动): 时间线和停留点整体平移
+                x, y = self._position(t)
+                dx, dy = int(args[0]) - x, int(args[1]) - y
+                self._rest = (self._rest[0] + dx, self._rest[1] + dy)
+                self._segments = [(t0, t1, (p0[0] + dx, p0[1] + dy), (p1[0] + dx, p1[1] + dy))
+                                  for t0, t1, p0, p1 in self._segments]
+                return "0", []
+            if cmd == "$":
+                # 运动状态位: bit0 X, bit1 Y 正在运动 (AutoScan 每个点停留期间为 0)
+                moving = any(t0 <= t < t1 and p0 != p1 for t0, t1, p0, p1 in self._segments)
+                return ("3" if moving else "0"), []
+            if cmd == "G":
+                p1 = (int(args[0]), int(args[1]))
+                t0 = max(t, self._end_time()) # 排在当前运动 (或扫描) 之后
+                t_done = self._add_move(t0, self._end_position(), p1)
+                return None, [(t_done, "R")] # 到位时才回复
+            if cmd == "SMS":
+                if args:
+                    self.speed_percent = min(max(int(args[0]), 1), 100)
+                    return "0", []
+                return str(self.speed_percent), []
+            if cmd in ("N", "X") or (cmd == "AS" and args and args != ["1"]):
+                if scanning:
+                    return "E,18", []
+                if cmd == "N":
+                    self.grid = (int(args[0]), int(args[1]))
+                elif cmd == "X":
+                    self.step = (int(args[0]), int(args[1]))
+                else:
+                    self.autoscan = (float(args[0]), float(args[1]))
+                return "0", []
+            if cmd == "AS":
+                if not args:
+                    return ("1" if scanning else "0"), []
+                if self.autoscan is None or scanning:
+                    return "E,4" if self.autoscan is None else "E,18", []
+                self._start_scan(t)
+                return "0", []
+            if cmd in ("I", "K"):
+                self._stop(t)
+                return "R", []
+            if cmd == "BAUD":
+                baudrate = self.BAUD_CODES[int(args[0])]
+                return "0", [(t, ("BAUD", baudrate))]
+            if cmd == "COMP":
+                return "0", []
+            if cmd in ("?", "VERSION"):
+                return "PROSCAN VIRTUAL CONTROLLER", []
+        except (ValueError, IndexError, KeyError):
+            return "E,4", []
+        return "E,1", []
+
+    # ---------------- 收发线程 ----------------
+
+    def _byte_s(self, n):
+        return n * 10. / self.baudrate # 8N1: 每字节 10 bit
+
+    def _send(self, t_ready, text, move=False):
+        data = (text + "\r").encode('ascii')
+        heapq.heappush(self._outbox, (t_ready + self.latency_s + self._byte_s(len(data)), self._seq, data, move))
+        self._seq += 1
+
+    def _host_baud_matches(self):
+        '''主机端打开串口时设置的波特率 (pty 的 termios) 与控制器是否一致'''
+        expected = getattr(termios, f"B{self.baudrate}", None)
+        if expected is None:
+            return True
+        return termios.tcgetattr(self._slave)[4] == expected
+
+    def _handle(self, buf, t_recv):
+        while b'\r' in buf:
+            line, buf = buf.split(b'\r', 1)
+            if not self._host_baud_matches():
+                # 波特率不一致: 控制器收到的是乱码, 主机收到的也是乱码 (没有 \r, 解码后为空)
+                heapq.heappush(self._outbox, (t_recv + self.latency_s, self._seq, b"\xf8\x80" * (len(line) + 1), False))
+                self._seq += 1
+                continue
+            # 逐条处理: 上一条处理完才开始下一条
+            start = max(t_recv + self.latency_s + self._byte_s(len(line) + 1), self._busy_until)
+            self._busy_until = start + self.process_s
+            with self._lock:
+                reply, later = self._execute(line.decode('ascii', errors='ignore'), start)
+            self.commands += 1
+            if reply is not None:
+                self._send(self._busy_until, reply)
+            for t_event, event in later:
+                if isinstance(event, tuple): # BAUD: 回复以旧波特率发出后再切换
+                    self.baudrate = event[1]
+                else:
+                    self._send(t_event, event, move=True)
+        return buf
+
+    def _worker(self):
+        buf = b""
+        while self._running:
+            now = time.perf_counter()
+            with self._lock:
+                ready = []
+                while self._outbox and self._outbox[0][0] <= now:
+                    ready.append(heapq.heappop(self._outbox)[2])
+                timeout = min(self._outbox[0][0] - now, 0.05) if self._outbox else 0.05
+            for data in ready:
+                os.write(self._master, data)
+            readable, _, _ = select.select([self._master], [], [], max(timeout, 0.))
+            if not readable:
+                continue
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                return
+            buf = self._handle(buf + chunk, time.perf_counter())
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    with PriorVirtualController() as controller:
+        print(f"✅ 虚拟 Prior 控制器已启动: {controller.port} ({controller.baudrate} baud), Ctrl+C 退出")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(f"\n📊 共处理 {controller.commands} 条指令")
@@ -0,0 +1,191 @@
+import numpy as np
+
+
+def _median(v):
+    """沿第一维的中位数 (一维数组即为整体中位数)"""
+    v = np.sort(v, axis=0)
+    n = v.shape[0]
+    return 0.5 * (v[(n - 1) // 2] + v[n // 2])
+
+
+class RecordStatistics:
+    """
+    逐像素的稳健统计, 与平均模式一样每个 Buffer 到达后立即归约, 不保存原始 record:
+      - 均值 / 方差: 按 Buffer 计算后用 Welford (Chan 并行合并) 公式合并, 数值稳定
+      - 近似截尾均值: 每个 Buffer 内按 record 排序去掉两端 trim_fraction, 再对各 Buffer 的截尾均值取平均
+        (trim_fraction=0.5 时退化为 "Buffer 中位数的均值", 即近似中位数), 用来抑制激光能量抖动
+      - 离群 record 计数: 每条 record 的峰峰值与所在 Buffer 的中位峰峰值相差超过 outlier_mad 倍 MAD 的记为离群
+      - 最小 / 最大码值: 用来检查饱和 (接近 0 或满码)
+    多通道 record 按 S0A, S0B, S1A ... 交织, 峰峰值 / SNR / 离群 / 最小最大值都按通道分别计算。
+    每个像素结束时输出 (保存在预分配数组中, 下标为像素序号, C 为通道数):
+      robust_aline (N, recordLength) 截尾均值 A-line (交织格式), float32
+      snr_map (N, C)     平均 A-line 的 SNR = 峰值 / (单次噪声 / sqrt(record 数)), 噪声取各采样点标准差的中位数
+      outlier_counts (N, C)
+      code_min / code_max (N, C)  该像素全部 record 中的最小 / 最大码值
+    内存与平均模式相同量级: 单点的几个 recordLength 累加器 + 每个像素一条 A-line。
+    """
+
+    def __init__(self, num_points, record_length, trim_fraction=0.125, outlier_mad=5., signal_length=None,
+                 channel_count=1):
+        """
+        :param trim_fraction: 每个 Buffer 两端各去掉的 record 比例, 0 为普通均值, 0.5 为近似中位数
+        :param outlier_mad: 离群判定阈值 (MAD 倍数, MAD 已换算为标准差)
+        :param signal_length: 每条 record 前 signal_length 个采样参与统计 (NPT footer 覆盖了末尾), None 为整条;
+                              robust_aline 仍为 record_length 长, 末尾填 0
+        :param channel_count: record 中交织的通道数
+        """
+        if not 0 <= trim_fraction <= 0.5:
+            raise ValueError(f"trim_fraction={trim_fraction} 必须在 [0, 0.5] 之间")
+        self.record_length = record_length
+        self.signal_length = record_length if signal_length is None else signal_length
+        if self.signal_length % channel_count:
+            raise ValueError(f"signal_length={self.signal_length} 不是通道数 {channel_count} 的整数倍")
+        record_length = self.signal_length # 单点累加器只覆盖信号部分
+        self.channel_count = channel_count
+        self.trim_fraction = trim_fraction
+        self.outlier_mad = outlier_mad
+
+        # 单点累加器
+        self.count = 0
+        self.mean = np.zeros(record_length, dtype=np.float64)
+        self.m2 = np.zeros(record_length, dtype=np.float64)
+        self.trimmed_sum = np.zeros(record_length, dtype=np.float64)
+        self.min = np.zeros(channel_count, dtype=np.int64)
+        self.max = np.zeros(channel_count, dtype=np.int64)
+        self.batches = 0
+        self.outliers = np.zeros(channel_count, dtype=np.int64)
+        self._weights = {} # 每个 Buffer 的 record 数 -> 截尾权重
+        self._work = None
+
+        # 整个扫描的输出
+        self.point_idx = 0
+        self.robust_aline = np.zeros((num_points, self.record_length), dtype=np.float32)
+        self.snr_map = np.zeros((num_points, channel_count), dtype=np.float64)
+        self.outlier_counts = np.zeros((num_points, channel_count), dtype=np.int64)
+        self.variance_map = np.zeros((num_points, channel_count), dtype=np.float64) # 各采样点方差的中位数 (单次噪声功率)
+        self.code_min = np.zeros((num_points, channel_count), dtype=np.int64)
+        self.code_max = np.zeros((num_points, channel_count), dtype=np.int64)
+
+    def start_point(self):
+        self.count = 0
+        self.mean.fill(0)
+        self.m2.fill(0)
+        self.trimmed_sum.fill(0)
+        self.min.fill(np.iinfo(np.int64).max)
+        self.max.fill(np.iinfo(np.int64).min)
+        self.batches = 0
+        self.outliers.fill(0)
+
+    def _by_channel(self, a):
+        """(..., signal_length) 的交织数组 -> (..., 采样点, 通道) 视图"""
+        return a.reshape(a.shape[:-1] + (-1, self.channel_count))
+
+    def update(self, records):
+        """
+        归约一个 Buffer 的 record (recordsPerBuffer, recordLength), 所有运算都沿 record 维向量化。
+        每个 Buffer 只排序一次: 先转置成 (采样点, record) 的连续内存再按行排序 (比沿 axis=0 排序快一倍多)。
+        """
+        records = records[:, :self.signal_length]
+        n_b = records.shape[0]
+        batch, ordered, ordered_f = self._work_buffers(records.shape)
+        np.copyto(batch, records)
+        # 整数码值的和与平方和在 float64 中是精确的, 由此得到的 Buffer 内均值 / M2 没有舍入问题
+        s1 = batch.sum(axis=0)
+        mean_b = s1 / n_b
+        m2_b = np.einsum("ij,ij->j", batch, batch) - s1 * mean_b
+        n_a = self.count
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * (n_b / n)
+        self.m2 += m2_b + delta ** 2 * (n_a * n_b / n)
+        self.count = n
+
+        # Buffer 内截尾均值: 排序后与权重向量做矩阵-向量乘 (两端权重为 0),
+        # 去掉后不足 1 条时取中间的 1~2 条 (中位数)
+        np.copyto(ordered, records.T) # uint16 转置比 float64 快得多
+        ordered.sort(axis=1)
+        np.copyto(ordered_f, ordered)
+        self.trimmed_sum += ordered_f @ self._trim_weights(n_b)
+        self.batches += 1
+
+        # 逐 record、逐通道的峰峰值 (n_b, C), 顺便得到最小 / 最大码值
+        per_channel = self._by_channel(records)
+        rec_max = per_channel.max(axis=1)
+        rec_min = per_channel.min(axis=1)
+        np.maximum(self.max, rec_max.max(axis=0), out=self.max)
+        np.minimum(self.min, rec_min.min(axis=0), out=self.min)
+
+        # 离群检测 (16 个数的 np.median 开销比排序本身还大, 直接排序取中间)
+        ptp = rec_max.astype(np.float64) - rec_min
+        dev = np.abs(ptp - _median(ptp))
+        mad = 1.4826 * _median(dev)
+        self.outliers += np.count_nonzero((dev > self.outlier_mad * mad) & (mad > 0), axis=0)
+
+    def _work_buffers(self, shape):
+        """
+        常驻的工作数组 (一个 Buffer 的 float64 副本约 256 KB, 超过 malloc 的 mmap 阈值,
+        每次新分配都要重新缺页, 实测比计算本身还慢)
+        """
+        if self._work is None or self._work[0].shape != shape:
+            n_b, length = shape
+            self._work = (np.empty(shape, dtype=np.float64), np.empty((length, n_b), dtype=np.uint16),
+                          np.empty((length, n_b), dtype=np.float64))
+        return self._work
+
+    def _trim_weights(self, n_b):
+        weights = self._weights.get(n_b)
+        if weights is None:
+            k = int(n_b * self.trim_fraction)
+            lo, hi = (k, n_b - k) if n_b - 2 * k > 0 else ((n_b - 1) // 2, n_b // 2 + 1)
+            weights = np.zeros(n_b, dtype=np.float64)
+            weights[lo:hi] = 1. / (hi - lo)
+            self._weights[n_b] = weights
+        return weights
+
+    def finish_point(self):
+        """结束当前像素, 把结果写入输出数组并返回像素序号"""
+        i = self.point_idx
+        if i >= self.robust_aline.shape[0]:
+            raise RuntimeError(f"RecordStatistics 已满 ({self.robust_aline.shape[0]} 个点), 请检查 num_points")
+        if self.batches:
+            aline = self.trimmed_sum / self.batches
+            self.robust_aline[i, :self.signal_length] = aline
+            # 按通道: 噪声取各采样点方差的中位数, 峰值为去掉中位数 (直流) 后的最大幅值
+            noise_var = _median(self._by_channel(self.variance()))
+            mean = self._by_channel(self.mean)
+            peak = np.abs(mean - _median(mean)).max(axis=0)
+            self.variance_map[i] = noise_var
+            self.snr_map[i] = np.divide(peak, np.sqrt(noise_var / self.count), out=np.full_like(peak, np.inf),
+                                        where=noise_var > 0)
+            self.outlier_counts[i] = self.outliers
+            self.code_min[i] = self.min
+            self.code_max[i] = self.max
+        self.point_idx += 1
+        return i
+
+    def skip_point(self):
+        """
+        采集失败 (重试后填 0) 的像素: 不写统计结果, 只推进像素序号, 后面的像素不会错位。
+        robust_aline / outlier_counts / code_min / code_max 为 0 (与填 0 的数据一致), snr_map / variance_map 为 NaN
+        """
+        i = self.point_idx
+        if i >= self.robust_aline.shape[0]:
+            raise RuntimeError(f"RecordStatistics 已满 ({self.robust_aline.shape[0]} 个点), 请检查 num_points")
+        self.robust_aline[i] = 0
+        self.snr_map[i] = np.nan
+        self.variance_map[i] = np.nan
+        self.outlier_counts[i] = 0
+        self.code_min[i] = 0
+        self.code_max[i] = 0
+        self.point_idx += 1
+        return i
+
+    def variance(self):
+        """当前像素各采样点的样本方差"""
+        return self.m2 / max(self.count - 1, 1)
+
+    def get_result(self):
+        """返回已完成像素的 (robust_aline, snr_map, outlier_counts, code_min, code_max) 视图"""
+        n = self.point_idx
+        return (self.robust_aline[:n], self.snr_map[:n], self.outlier_counts[:n],
+                self.code_min[:n], self.code_max[:n])
@@ -0,0 +1,620 @@
+'''
+不依赖硬件的 ATS9373 模拟板卡。
+
+实现 AlazarNPTSystem 和 NPT 例程用到的 atsapi 子集 (Board / DMABuffer / NPTFooter /
+extractTimeDomainNPTFooters 以及相关常量, 数值与 atsapi 一致), 用于在没有采集卡、
+没有 libATSApi.so / ATSApi.dll 的普通 Linux 机器上调试和测量采集流程的吞吐量。
+
+- 后台线程按设定的 PRF 产生触发, 每凑满 recordsPerBuffer 条 record 就填满最早提交的 Buffer
+- Buffer 内容为合成的光声 A-line (双极性脉冲 + 噪声 + 激光能量抖动), 12 bit 码值放在 16 bit 的高位
+- 没有可用 Buffer 时 record 先堆在板载 FIFO 里, 超过 fifo_bytes 即溢出 (ApiBufferOverflow), 与真实板卡一样停止采集
+- NPT 每条 record 之后有重新准备触发的时间 (rearm_samples), record 太长时会漏掉触发;
+  TS (ADMA_TRIGGERED_STREAMING) / CS (ADMA_CONTINUOUS_MODE) 按采样率不间断地填满 Buffer
+- 板载 FFT (DspModule.fftSetup + ADMA_DSP): 输出合成 A-line 加窗、减背景后的功率谱, 可带 NPT footer
+- inject_fault 可注入一次性的 FIFO 溢出 / 触发中断, 用于测试异常恢复
+- 主从系统: set_system_boards 设定 boardsInSystemBySystemID 返回的板卡数, 主板卡 (boardId=1) 的 startCapture
+  同时启动同一 System 中已装载 DMA 的从板卡 (共用时钟和触发), 各板卡的噪声互不相同
+- 错误以 Exception 抛出, 消息格式与 atsapi.returnCodeCheck 相同 (包含 ApiWaitTimeout 等错误名)
+
+用法:
+    from Alazar_imaging import SimulatedATS9373
+    daq = AlazarNPTSystem(backend=SimulatedATS9373)
+    daq.board.set_simulation(prf_hz=80000)
+'''
+import collections
+import ctypes
+import threading
+import time
+import weakref
+import numpy as np
+
+# ---------------- 常量 (与 atsapi 保持一致) ----------------
+INTERNAL_CLOCK = 0x1
+SAMPLE_RATE_2000MSPS = 0x3F
+SAMPLE_RATE_4000MSPS = 0x80
+CLOCK_EDGE_RISING = 0
+
+CHANNEL_A = 1
+CHANNEL_B = 2
+channels = [CHANNEL_A, CHANNEL_B]
+
+DC_COUPLING = 2
+INPUT_RANGE_PM_400_MV = 0x7
+IMPEDANCE_50_OHM = 2
+ETR_2V5 = 3
+
+TRIG_ENGINE_J = 0
+TRIG_ENGINE_K = 1
+TRIG_ENGINE_OP_J = 0
+TRIG_EXTERNAL = 0x2
+TRIG_DISABLE = 0x3
+TRIGGER_SLOPE_POSITIVE = 1
+
+AUX_OUT_TRIGGER = 0
+AUX_IN_AUXILIARY = 13
+
+ADMA_TRADITIONAL_MODE = 0
+ADMA_NPT = 0x200
+ADMA_CONTINUOUS_MODE = 0x100
+ADMA_TRIGGERED_STREAMING = 0x400
+ADMA_EXTERNAL_STARTCAPTURE = 0x1
+ADMA_ENABLE_RECORD_HEADERS = 0x8
+ADMA_FIFO_ONLY_STREAMING = 0x800
+ADMA_INTERLEAVE_SAMPLES = 0x1000
+ADMA_DSP = 0x4000
+ADMA_ENABLE_RECORD_FOOTERS = 0x10000
+
+CRA_MODE_DISABLE = 0
+CRA_MODE_ENABLE_FPGA_AVE = 1
+CRA_OPTION_UNSIGNED = 0
+CRA_OPTION_SIGNED = 1
+
+DSP_WINDOW_NONE = 0
+DSP_WINDOW_HANNING = 1
+DSP_WINDOW_HAMMING = 2
+DSP_WINDOW_BLACKMAN = 3
+DSP_WINDOW_BLACKMAN_HARRIS = 4
+DSP_WINDOW_BARTLETT = 5
+
+DSP_MODULE_NONE = 0xFFFF
+DSP_MODULE_FFT = 0x10000
+
+FFT_OUTPUT_FORMAT_U32 = 0x0
+FFT_OUTPUT_FORMAT_U16_LOG = 0x1
+FFT_OUTPUT_FORMAT_U16_AMP2 = 0x101
+FFT_OUTPUT_FORMAT_U8_LOG = 0x2
+FFT_OUTPUT_FORMAT_U8_AMP2 = 0x102
+FFT_OUTPUT_FORMAT_FLOAT_AMP2 = 0xA
+FFT_OUTPUT_FORMAT_FLOAT_LOG = 0xB
+
+FFT_FOOTER_NONE = 0x0
+FFT_FOOTER_NPT = 0x1
+
+ATS9373 = 29
+GET_SERIAL_NUMBER = 0x10000024
+GET_PCIE_LINK_SPEED = 0x10000030
+GET_PCIE_LINK_WIDTH = 0x10000031
+
+SAMPLE_RATES_HZ = {SAMPLE_RATE_2000MSPS: 2e9, SAMPLE_RATE_4000MSPS: 4e9}
+
+
+class NPTFooter(ctypes.Structure):
+    _fields_ = [("trigger_timestamp", ctypes.c_uint64),
+                ("record_number", ctypes.c_uint32),
+                ("frame_count", ctypes.c_uint32),
+                ("aux_in_state", ctypes.c_uint32)]
+
+NPT_FOOTER_BYTES = 16 # 时域 footer 在 record 中占用的字节数
+
+_FOOTER_DTYPE = np.dtype([("trigger_timestamp", np.uint64),
+                          ("record_number", np.uint32),
+                          ("frame_count", np.uint32),
+                          ("aux_in_state", np.uint32)], align=True)
+
+
+def _api_error(func_name, error_name, *arguments):
+    '''与 atsapi.returnCodeCheck 相同格式的异常'''
+    return Exception("Error calling function %s with arguments %s : %s" %
+                     (func_name, str(arguments), str(error_name.encode())))
+
+
+# addr -> DMABuffer, 模拟驱动通过地址找到对应的内存 (弱引用: 不阻止 DMABuffer 被释放)
+_dma_buffers = weakref.WeakValueDictionary()
+
+# systemId -> 板卡数 (主从系统), 未设定的 System 只有 1 块板卡
+_system_boards = {}
+
+
+def set_system_boards(systemId, boardCount):
+    '''模拟一个由 boardCount 块板卡组成的主从系统 (boardId 1 为主板卡)'''
+    _system_boards[systemId] = boardCount
+
+
+def boardsInSystemBySystemID(systemId):
+    return _system_boards.get(systemId, 1)
+
+
+class DMABuffer:
+    '''与 atsapi.DMABuffer 接口相同, 内存由 numpy 分配 (按页对齐)'''
+
+    def __init__(self, handle, c_sample_type, size_bytes):
+        self.size_bytes = size_bytes
+        self.c_sample_type = c_sample_type
+        self.handle = handle
+        npSampleType = {
+            ctypes.c_uint8: np.uint8,
+            ctypes.c_uint16: np.uint16,
+            ctypes.c_uint32: np.uint32,
+            ctypes.c_int32: np.int32,
+            ctypes.c_float: np.float32
+        }.get(c_sample_type, 0)
+        if npSampleType == 0:
+            raise ValueError("Invalid DMABuffer Type")
+
+        # 多申请一页, 手动对齐到 4096 字节
+        raw = np.zeros(size_bytes + 4096, dtype=np.uint8)
+        offset = (-raw.ctypes.data) % 4096
+        self._raw = raw
+        self.buffer = raw[offset:offset + size_bytes].view(npSampleType)
+        self.addr = self.buffer.ctypes.data
+        self.footers = None # 开启 footer 时由模拟板卡写入
+        _dma_buffers[self.addr] = self
+
+
+def extractTimeDomainNPTFooters(buffer, recordSize_bytes, bufferSize_bytes,
+                                footersArray, numFootersToExtract):
+    dma = _dma_buffers.get(buffer)
+    if dma is None or dma.footers is None:
+        raise _api_error("AlazarExtractTimeDomainNPTFooters", "ApiInvalidBuffer", buffer)
+    n = min(numFootersToExtract, len(dma.footers))
+    ctypes.memmove(footersArray, dma.footers.ctypes.data, n * _FOOTER_DTYPE.itemsize)
+
+
+def extractFFTNPTFooters(buffer, recordSize_bytes, bufferSize_bytes,
+                         footersArray, numFootersToExtract):
+    # 模拟中 footer 另外存放, 与时域相同
+    extractTimeDomainNPTFooters(buffer, recordSize_bytes, bufferSize_bytes, footersArray, numFootersToExtract)
+
+
+def dspGenerateWindowFunction(windowType, windowLength_samples, paddingLength_samples):
+    '''生成窗函数并在末尾补零 (float32)'''
+    windows = {DSP_WINDOW_NONE: np.ones, DSP_WINDOW_HANNING: np.hanning, DSP_WINDOW_HAMMING: np.hamming,
+               DSP_WINDOW_BLACKMAN: np.blackman, DSP_WINDOW_BARTLETT: np.bartlett}
+    if windowType == DSP_WINDOW_BLACKMAN_HARRIS:
+        n = np.arange(windowLength_samples) / max(windowLength_samples - 1, 1)
+        w = (0.35875 - 0.48829 * np.cos(2 * np.pi * n) + 0.14128 * np.cos(4 * np.pi * n)
+             - 0.01168 * np.cos(6 * np.pi * n))
+    else:
+        w = windows[windowType](windowLength_samples)
+    return np.concatenate([w, np.zeros(paddingLength_samples)]).astype(np.float32)
+
+
+_FFT_OUTPUT_DTYPES = {FFT_OUTPUT_FORMAT_U32: np.uint32, FFT_OUTPUT_FORMAT_U16_LOG: np.uint16,
+                      FFT_OUTPUT_FORMAT_U16_AMP2: np.uint16, FFT_OUTPUT_FORMAT_U8_LOG: np.uint8,
+                      FFT_OUTPUT_FORMAT_U8_AMP2: np.uint8, FFT_OUTPUT_FORMAT_FLOAT_AMP2: np.float32,
+                      FFT_OUTPUT_FORMAT_FLOAT_LOG: np.float32}
+
+
+class DspModule:
+    '''板载 FFT 模块 (只实现 AlazarNPTSystem 用到的函数), 配置保存在所属 Board 上'''
+
+    def __init__(self, board):
+        self.board = board
+        self.handle = board.handle
+        self.window = None
+        self.background = None
+        self.background_enabled = False
+
+    def dspGetInfo(self):
+        return (DSP_MODULE_FFT, 1, 0, 4096)
+
+    def fftSetWindowFunction(self, samplesPerRecord, realWindowArray, imagWindowArray):
+        self.window = np.ctypeslib.as_array(realWindowArray, (samplesPerRecord,)).copy()
+
+    def fftBackgroundSubtractionSetRecordS16(self, record, size_samples):
+        self.background = np.ctypeslib.as_array(record, (size_samples,)).astype(np.float64)
+
+    def fftBackgroundSubtractionSetEnabled(self, enabled):
+        self.background_enabled = bool(enabled)
+
+    def fftSetup(self, inputChannelMask, recordLength_samples, fftLength_samples, outputFormat, footer, reserved):
+        if outputFormat not in _FFT_OUTPUT_DTYPES:
+            raise _api_error("AlazarFFTSetup", "ApiUnsupportedFunction", self.handle, outputFormat)
+        bins_bytes = fftLength_samples // 2 * np.dtype(_FFT_OUTPUT_DTYPES[outputFormat]).itemsize
+        footer_bytes = _FOOTER_DTYPE.itemsize if footer == FFT_FOOTER_NPT else 0
+        self.board._fft = {"module": self, "record_length": recordLength_samples, "fft_length": fftLength_samples,
+                           "format": outputFormat, "footer": footer, "bytes_per_record": bins_bytes + footer_bytes}
+        return bins_bytes + footer_bytes
+
+
+class Board:
+    '''
+    模拟的 ATS9373。配置类函数只记录参数, 采集相关函数 (beforeAsyncRead / postAsyncBuffer /
+    startCapture / waitAsyncBufferComplete / abortAsyncRead) 按真实的 AutoDMA 语义工作。
+    '''
+    _next_handle = 1
+    _instances = weakref.WeakSet() # 主板卡 startCapture 时按 systemId 找到从板卡
+
+    def __init__(self, systemId=1, boardId=1):
+        self.systemId = systemId
+        self.boardId = boardId
+        self.handle = Board._next_handle
+        Board._next_handle += 1
+        Board._instances.add(self)
+
+        self.samplesPerSec = 2e9
+        self.bitsPerSample = 12
+        self.memorySize_samples = 2 * 1024**3
+        self.triggerDelay = 0
+        self.auxMode = AUX_OUT_TRIGGER
+        self._fft = None # fftSetup 的配置
+        self._dsp = None
+        self._fault = None # inject_fault 设置的一次性故障
+        self.set_simulation()
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._armed = False
+
+    # ---------------- 模拟参数 ----------------
+
+    def set_simulation(self, prf_hz=80000., fifo_bytes=512 * 1024**2, pulse_delay_s=0.4e-6,
+                       pulse_width_s=10e-9, amplitude_codes=600, noise_codes=30, flicker=0.1,
+                       bank_records=64, aux_in_fn=None, fpga_average=True, rearm_samples=128, seed=0):
+        '''
+        :param prf_hz: 触发 (激光) 重复频率
+        :param fifo_bytes: 板载 FIFO 能缓存的字节数, 主机来不及提交 Buffer 时超过此值即溢出
+        :param pulse_delay_s / pulse_width_s / amplitude_codes: 合成光声脉冲的时延、宽度和幅度 (12 bit 码值)
+        :param noise_codes: 高斯噪声标准差 (12 bit 码值)
+        :param flicker: 激光能量逐脉冲抖动 (相对值)
+        :param bank_records: 预先生成的 record 条数, 采集时循环使用 (避免实时生成随机数拖慢模拟)
+        :param aux_in_fn: aux_in_fn(t_sec) -> 0/1, 模拟接在 AUX 输入上的 TTL, 写入 footer 的 aux_in_state
+        :param fpga_average: 是否模拟支持 configureRecordAverage 的固件, False 时调用会返回 ApiUnsupportedFunction
+        :param rearm_samples: NPT 每条 record 结束后重新准备触发所需的时间 (采样点, 模拟值),
+                              record + rearm 超过触发周期时会漏掉紧接着的触发 (TS / CS 模式没有这个限制)
+        '''
+        self.prf_hz = float(prf_hz)
+        self.fifo_bytes = fifo_bytes
+        self.pulse_delay_s = pulse_delay_s
+        self.pulse_width_s = pulse_width_s
+        self.amplitude_codes = amplitude_codes
+        self.noise_codes = noise_codes
+        self.flicker = flicker
+        self.bank_records = bank_records
+        self.aux_in_fn = aux_in_fn
+        self.fpga_average = fpga_average
+        self.rearm_samples = rearm_samples
+        self.recordsPerAverage = 1
+        self.seed = seed
+
+    def inject_fault(self, kind, at_buffer, duration_s=0.1):
+        '''
+        注入一次性故障, 用于测试采集程序的异常恢复 (在 beforeAsyncRead 之后计数, 触发一次后自动清除):
+        :param kind: "overflow" -> 第 at_buffer 个 Buffer 时板载 FIFO 溢出, 采集停止 (需重新 beforeAsyncRead)
+                     "gap"      -> 第 at_buffer 个 Buffer 之后 duration_s 秒内没有触发 (等待会 ApiWaitTimeout)
+        '''
+        if kind not in ("overflow", "gap"):
+            raise ValueError(f"未知的故障类型: {kind}")
+        with self._cond:
+            self._fault = {"kind": kind, "at_buffer": at_buffer, "duration_s": duration_s}
+
+    def _make_fft_bank(self):
+        '''把时域 bank 变成板载 FFT 的输出字节 (bank_records, bytes_per_record), 每条 record 末尾留出 footer 空间'''
+        cfg = self._fft
+        dsp = cfg["module"]
+        n, n_fft = cfg["record_length"], cfg["fft_length"]
+        x = (self._make_bank(n, 1) >> 4).astype(np.float64) - 2048.
+        if dsp.background_enabled and dsp.background is not None:
+            x -= dsp.background[:n]
+        spectrum = np.zeros((self.bank_records, n_fft), dtype=np.float64)
+        spectrum[:, :n] = x
+        if dsp.window is not None:
+            spectrum *= dsp.window[:n_fft]
+        amp2 = np.abs(np.fft.fft(spectrum, axis=1)[:, :n_fft // 2]) ** 2
+        fmt = cfg["format"]
+        dtype = _FFT_OUTPUT_DTYPES[fmt]
+        if fmt in (FFT_OUTPUT_FORMAT_FLOAT_LOG, FFT_OUTPUT_FORMAT_U16_LOG, FFT_OUTPUT_FORMAT_U8_LOG):
+            out = 10 * np.log10(amp2 + 1.)
+            if fmt != FFT_OUTPUT_FORMAT_FLOAT_LOG:
+                out *= np.iinfo(dtype).max / 200. # 0 ~ 200 dB 映射到整数满量程
+        else:
+            out = amp2
+        if np.issubdtype(dtype, np.integer):
+            out = np.clip(np.rint(out), 0, np.iinfo(dtype).max)
+        out = out.astype(dtype)
+        bank = np.zeros((self.bank_records, cfg["bytes_per_record"]), dtype=np.uint8)
+        bank[:, :out.nbytes // self.bank_records] = out.view(np.uint8).reshape(self.bank_records, -1)
+        return bank
+
+    def _make_stream_bank(self, channelCount):
+        '''TS / CS 的连续波形: bank_records 个触发周期首尾相接 (每个周期开头一个光声脉冲), 展平成一维 (交织)'''
+        period = int(round(self.samplesPerSec / self.prf_hz))
+        return self._make_bank(period, channelCount).reshape(-1)
+
+    def _make_bank(self, samplesPerRecord, channelCount):
+        '''生成 bank_records 条合成 A-line, 形状 (bank_records, samplesPerRecord * channelCount)'''
+        rng = np.random.default_rng(self.seed + self.boardId - 1) # 从板卡的噪声与主板卡不同
+        t = (np.arange(samplesPerRecord) + self.triggerDelay) / self.samplesPerSec
+        tau = (t - self.pulse_delay_s) / self.pulse_width_s
+        pulse = -tau * np.exp(-0.5 * tau**2) # 高斯一阶导: 光声信号典型的 N 形双极性脉冲
+        pulse /= np.abs(pulse).max()
+        gains = 1. + self.flicker * rng.standard_normal(self.bank_records)
+        codes = (2048. + self.amplitude_codes * gains[:, None] * pulse[None, :]
+                 + self.noise_codes * rng.standard_normal((self.bank_records, samplesPerRecord)))
+        codes = np.clip(np.rint(codes), 0, 4095).astype(np.uint16)
+        if channelCount > 1:
+            # 多通道时按 S0A, S0B, S1A, S1B ... 交织, 其余通道用同一信号的衰减版本
+            chans = [codes] + [(2048 + (codes.astype(np.int32) - 2048) // (2 * c)).astype(np.uint16)
+                               for c in range(1, channelCount)]
+            codes = np.stack(chans, axis=-1).reshape(self.bank_records, -1)
+        return codes << 4 # 12 bit 码值放在 16 bit 的高位
+
+    # ---------------- 配置类函数 (只记录) ----------------
+
+    def setCaptureClock(self, source, rate, edge, decimation):
+        self.samplesPerSec = SAMPLE_RATES_HZ.get(rate, self.samplesPerSec)
+
+    def inputControl(self, channel, coupling, inputRange, impedance):
+        pass
+
+    def inputControlEx(self, channel, coupling, inputRange, impedance):
+        pass
+
+    def setBWLimit(self, channel, enable):
+        pass
+
+    def setExternalTrigger(self, coupling, range):
+        pass
+
+    def setTriggerOperation(self, operation, engine1, source1, slope1, level1,
+                            engine2, source2, slope2, level2):
+        pass
+
+    def setTriggerDelay(self, delay_samples):
+        self.triggerDelay = delay_samples
+
+    def setTriggerTimeOut(self, timeout_ticks):
+        pass
+
+    def configureAuxIO(self, mode, parameter):
+        self.auxMode = mode
+
+    def setRecordSize(self, preTriggerSamples, postTriggerSamples):
+        self.preTriggerSamples = preTriggerSamples
+        self.postTriggerSamples = postTriggerSamples
+
+    def configureRecordAverage(self, mode, samplesPerRecord, recordsPerAverage, options):
+        '''FPGA 把 recordsPerAverage 条 record 累加成 1 条 (每个采样 32 bit 求和) 后再传给主机'''
+        if not self.fpga_average:
+            raise _api_error("AlazarConfigureRecordAverage", "ApiUnsupportedFunction",
+                             self.handle, mode, samplesPerRecord, recordsPerAverage, options)
+        self.recordsPerAverage = recordsPerAverage if mode == CRA_MODE_ENABLE_FPGA_AVE else 1
+
+    def getChannelInfo(self):
+        return (ctypes.c_uint32(self.memorySize_samples), ctypes.c_uint8(self.bitsPerSample))
+
+    def getBoardKind(self):
+        return ATS9373
+
+    def queryCapability(self, capability, reserved=0):
+        values = {GET_SERIAL_NUMBER: 0, GET_PCIE_LINK_SPEED: 3, GET_PCIE_LINK_WIDTH: 8}
+        return ctypes.c_uint32(values.get(capability, 0))
+
+    # ---------------- AutoDMA ----------------
+
+    def beforeAsyncRead(self, channels, transferOffset, samplesPerRecord,
+                        recordsPerBuffer, recordsPerAcquisition, flags):
+        self.abortAsyncRead()
+        self.channelMask = channels
+        self.channelCount = bin(channels).count("1")
+        self.samplesPerRecord = samplesPerRecord
+        self.recordsPerBuffer = recordsPerBuffer
+        self.recordsPerAcquisition = recordsPerAcquisition
+        self.flags = flags
+        self._streaming = bool(flags & (ADMA_CONTINUOUS_MODE | ADMA_TRIGGERED_STREAMING))
+        if self._streaming:
+            # TS / CS: samplesPerRecord 参数是每个 Buffer 的采样点数 (recordsPerBuffer 必须为 1), 数据是不间断的波形
+            self._bank = self._make_stream_bank(self.channelCount)
+            self._record_bytes = samplesPerRecord * self.channelCount * 2
+            self._buffer_period_s = samplesPerRecord / self.samplesPerSec
+            # TS 从触发开始, 波形与脉冲对齐; CS 不等触发, 从任意相位开始
+            period = self._bank.size // self.bank_records
+            self._stream_phase = 0 if flags & ADMA_TRIGGERED_STREAMING else \
+                int(np.random.default_rng(self.seed).integers(period // self.channelCount)) * self.channelCount
+        elif flags & ADMA_DSP:
+            # DSP 模式下 samplesPerRecord 参数传的是 fftSetup 返回的输出 record 字节数
+            if self._fft is None:
+                raise _api_error("AlazarBeforeAsyncRead", "ApiDspNotConfigured", self.handle, flags)
+            self._bank = self._make_fft_bank()
+            self._record_bytes = samplesPerRecord
+        else:
+            self._bank = self._make_bank(samplesPerRecord, self.channelCount)
+            self._record_bytes = samplesPerRecord * self.channelCount * (4 if self.recordsPerAverage > 1 else 2)
+        # 驱动只按字节写入, 数据类型由采集模式决定 (与主机分配 Buffer 时用的类型无关)
+        if flags & ADMA_DSP:
+            self._sample_dtype = np.uint8
+        elif self.recordsPerAverage > 1 and not self._streaming:
+            self._sample_dtype = np.uint32
+        else:
+            self._sample_dtype = np.uint16
+        if not self._streaming:
+            # NPT: record + 重新准备触发的时间超过触发周期时, 每 skip 个触发只能采到 1 个
+            record_samples = self._fft["record_length"] if flags & ADMA_DSP else samplesPerRecord
+            skip = max(int(np.ceil((record_samples + self.rearm_samples) * self.prf_hz / self.samplesPerSec)), 1)
+            self.trigger_hz = self.prf_hz / skip
+            # FPGA 平均时每条输出 record 需要 recordsPerAverage 个触发
+            self._buffer_period_s = recordsPerBuffer * self.recordsPerAverage / self.trigger_hz
+        self._posted = collections.deque()    # 已提交、等待填充的 Buffer
+        self._completed = collections.deque() # 已填满、等待 waitAsyncBufferComplete 的 Buffer
+        self._buffers_done = 0
+        self._overflow = False
+        self._armed = True
+        # 统计量 (benchmark 用)
+        self.stats = {"buffers_completed": 0, "max_backlog_buffers": 0, "overflow": False}
+
+    def postAsyncBuffer(self, buffer, bufferLength):
+        dma = _dma_buffers.get(buffer)
+        if dma is None or not self._armed:
+            raise _api_error("AlazarPostAsyncBuffer", "ApiInvalidBuffer", buffer, bufferLength)
+        with self._cond:
+            self._posted.append((dma, bufferLength)) # Buffer 可能比本次提交的长度大 (DMA Buffer 池), 只写前 bufferLength 字节
+            self._cond.notify_all()
+
+    def startCapture(self):
+        if not self._armed:
+            raise _api_error("AlazarStartCapture", "ApiNotInitialized", self.handle)
+        t0 = time.perf_counter()
+        if self.boardId == 1:
+            # 主板卡: 同一 System 中已装载、还没开始的从板卡一起启动 (同一时钟, 同一触发)
+            for board in list(Board._instances):
+                if board is not self and board.systemId == self.systemId and board._armed and not board._running \
+                        and not board._overflow:
+                    board._start(t0)
+        self._start(t0)
+
+    def _start(self, t0):
+        self._t0 = t0
+        if self.flags & ADMA_TRIGGERED_STREAMING:
+            self._t0 += 1. / self.prf_hz # TS 从第一个触发开始连续采集
+        self._running = True
+        self._thread = threading.Thread(target=self._dma_worker, daemon=True)
+        self._thread.start()
+
+    def _dma_worker(self):
+        rpb = self.recordsPerBuffer
+        # TS / CS 忽略 recordsPerAcquisition, 一直采到 abort
+        buffers_limit = self.recordsPerAcquisition // rpb if not self._streaming else 2**62
+        bytes_per_buffer = rpb * self._record_bytes
+        period = self._buffer_period_s
+        footers_on = bool(self.flags & ADMA_ENABLE_RECORD_FOOTERS) and not self._streaming
+        if self.flags & ADMA_DSP:
+            footers_on = self._fft["footer"] == FFT_FOOTER_NPT
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                fault = self._fault
+                if fault is not None and self._buffers_done >= fault["at_buffer"]:
+                    self._fault = None
+                    if fault["kind"] == "gap":
+                        self._t0 += fault["duration_s"] # 触发时刻整体推后, 相当于中间停了 duration_s
+                    else:
+                        self._overflow = True
+                        self.stats["overflow"] = True
+                        self._running = False
+                        self._cond.notify_all()
+                        return
+                # 到现在为止触发凑满了多少个 Buffer
+                triggered = max(int((time.perf_counter() - self._t0) / period), 0)
+                triggered = min(triggered, buffers_limit)
+                backlog = triggered - self._buffers_done
+                self.stats["max_backlog_buffers"] = max(self.stats["max_backlog_buffers"], backlog)
+                if backlog * bytes_per_buffer > self.fifo_bytes:
+                    # 板载 FIFO 溢出: 真实板卡会停止采集, 之后的等待都返回 ApiBufferOverflow
+                    self._overflow = True
+                    self.stats["overflow"] = True
+                    self._running = False
+                    self._cond.notify_all()
+                    return
+                if backlog > 0 and self._posted:
+                    dma, length = self._posted.popleft()
+                else:
+                    if backlog > 0:
+                        # 没有空闲 Buffer: 等主机提交, 最多等到 FIFO 被写满的时刻
+                        fifo_buffers = self.fifo_bytes // bytes_per_buffer
+                        next_t = self._t0 + (self._buffers_done + fifo_buffers + 1) * period
+                    else:
+                        # 等下一个 Buffer 触发完成
+                        next_t = self._t0 + (self._buffers_done + 1) * period
+                    self._cond.wait(max(next_t - time.perf_counter(), 1e-4))
+                    continue
+                k = self._buffers_done
+
+            # 填充数据放在锁外, 避免阻塞 postAsyncBuffer / waitAsyncBufferComplete
+            self._fill(dma, length, k, footers_on)
+            with self._cond:
+                self._buffers_done += 1
+                self._completed.append(dma)
+                self.stats["buffers_completed"] += 1
+                self._cond.notify_all()
+
+    def _fill(self, dma, length, k, footers_on):
+        rpb = self.recordsPerBuffer
+        data = dma.buffer.view(np.uint8)[:length].view(self._sample_dtype)
+        if self._streaming:
+            # 从循环的连续波形里取出第 k 个 Buffer 对应的一段 (跨过 bank 末尾时分段拷贝)
+            out = data
+            n, length = out.size, self._bank.size
+            start, pos = (self._stream_phase + k * n) % length, 0
+            while pos < n:
+                m = min(n - pos, length - start)
+                out[pos:pos + m] = self._bank[start:start + m]
+                pos += m
+                start = 0
+            return
+        if self.recordsPerAverage > 1:
+            n_avg = self.recordsPerAverage
+            idx = (k * rpb * n_avg + np.arange(rpb * n_avg)) % self.bank_records
+            summed = np.add.reduce(np.take(self._bank, idx.reshape(rpb, n_avg), axis=0), axis=1, dtype=np.uint32)
+            data.reshape(rpb, -1)[:] = summed
+            return
+        first = k * rpb
+        idx = (first + np.arange(rpb)) % self.bank_records
+        # 时域 bank 为 (record, 采样) 的码值, FFT bank 为 (record, 频谱 + footer 空间) 的字节, 都是整行拷贝
+        np.take(self._bank, idx, axis=0, out=data.reshape(rpb, -1))
+        if footers_on:
+            rec = first + np.arange(rpb)
+            t_rec = rec / self.trigger_hz
+            footers = np.zeros(rpb, dtype=_FOOTER_DTYPE)
+            footers["trigger_timestamp"] = np.rint(t_rec * self.samplesPerSec / 8).astype(np.uint64)
+            footers["record_number"] = rec
+            footers["frame_count"] = k
+            if self.aux_in_fn is not None:
+                footers["aux_in_state"] = [self.aux_in_fn(t) for t in t_rec]
+            dma.footers = footers
+            if not self.flags & ADMA_DSP:
+                # 与真实板卡一样, footer 覆盖每条 record 末尾的 NPT_FOOTER_BYTES 字节
+                tail = data.reshape(rpb, -1).view(np.uint8)[:, -NPT_FOOTER_BYTES:]
+                tail[:] = footers.view(np.uint8).reshape(rpb, -1)[:, :NPT_FOOTER_BYTES]
+
+    def waitAsyncBufferComplete(self, buffer, timeout_ms):
+        deadline = time.perf_counter() + timeout_ms / 1000.
+        with self._cond:
+            while True:
+                if self._completed:
+                    if self._completed[0].addr != buffer:
+                        raise _api_error("AlazarWaitAsyncBufferComplete", "ApiInvalidBuffer", buffer, timeout_ms)
+                    self._completed.popleft()
+                    return
+                if self._overflow:
+                    raise _api_error("AlazarWaitAsyncBufferComplete", "ApiBufferOverflow", buffer, timeout_ms)
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise _api_error("AlazarWaitAsyncBufferComplete", "ApiWaitTimeout", buffer, timeout_ms)
+                self._cond.wait(remaining)
+
+    def abortAsyncRead(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._posted = collections.deque()
+        self._completed = collections.deque()
+        self._armed = False
+
+    def abortCapture(self):
+        self.abortAsyncRead()
+
+    def dspGetModules(self):
+        if self._dsp is None:
+            self._dsp = DspModule(self)
+        return [self._dsp]
+
+    def dspGetBuffer(self, buffer, timeout_ms):
+        self.waitAsyncBufferComplete(buffer, timeout_ms)
+
+    def dspAbortCapture(self):
+        self.abortAsyncRead()
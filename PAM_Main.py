@@ -12,11 +12,16 @@ import traceback
 # 导入模块
 
 from Alazar_imaging.PriorUnifiedStage import PriorUnifiedStage
-from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem, AcquisitionError
+from Alazar_imaging.AlazarMultiBoardSystem import AlazarMultiBoardSystem
 from Alazar_imaging.AsyncProgress import progress_manager
-from Alazar_imaging.Alazar_imaging_tools import get_expected_trajectory
+from Alazar_imaging.FlyScanController import FlyScanController
+from Alazar_imaging.HDF5StreamWriter import HDF5StreamWriter
+from Alazar_imaging.HilbertEnvelope import HilbertEnvelope
+from Alazar_imaging.Alazar_imaging_tools import get_expected_trajectory_xy, build_pixel_lookup, lookup_pixel
 def main():
     # ============================== 1. 参数设置 =================================
+    # 位移台全程使用串口会话; SDK 只在调用没有串口等价指令的 SDK 指令时才会用到, 不需要时 DLL_PATH 可设为 None
     DLL_PATH = r"D:\LJB\PAM\PriorSDK 2.0.0\x64\PriorScientificSDK.dll"
     COM_PORT = "4"
     save_path = "./data.mat"
@@ -29,10 +34,67 @@ def main():
     # DAQ 参数
     SAMPLES_REC = 2048
     RECORDS_BUF = 16   # 每个Buffer存50个激光脉冲数据 (降低主循环压力)
-    RECORDS_PER_POINT = 256 # 每个点记录多少个record，在平均的情况下，也不能大于1048832，否则uint32会溢出
+    RECORDS_PER_POINT = 256 # 每个点记录多少个record，平均模式下超过 65537 条时累加器会自动改用 uint64
     Buffer_Count = 4   # 用多少个buffer来收集数据，太少了可能双DMA会受限制
+    # 自动规划 RECORDS_BUF / Buffer_Count (按 LASER_PRF_HZ 使 Buffer 完成频率接近 TARGET_BUFFER_RATE_HZ,
+    # 并保证 RECORDS_PER_POINT 能被整除); 关闭时使用上面两个手动值
+    AUTO_BUFFER_PLAN = True
+    TARGET_BUFFER_RATE_HZ = 1000
+    AVAILABLE_RAM_GB = 16
+    HOST_BYTES_PER_S = 2e9   # 主机持续处理吞吐量 (可用 Tool_code/buffer_geometry_sweep.py 实测), 余量不足的规划直接报错
     SETTLE_MS = int(EXPOSURE_MS/10)
+    # 到位判定的容差 (um, 按 XY 分别比较, 不看 Z), 必须小于 STEP_UM 的一半; 超过 ARRIVE_TIMEOUT_S 仍未到位则报超时
+    POS_TOLERANCE_UM = 0
+    ARRIVE_TIMEOUT_S = 10.
     AVERAGE_ENABLE = True
+    # 在板卡 FPGA 上做 record 平均 (仅 "step" + "serial" 模式), 固件不支持时自动退回主机累加。
+    # 到位时正在平均的那个点含有移动中的 record, 会被丢弃 (每点多等一个点的时间, 逐点采集和 USE_STREAM_WORKER 都一样)
+    HARDWARE_AVERAGE = True
+    # 采集通道: ats.CHANNEL_A 或 ats.CHANNEL_A | ats.CHANNEL_B (A: 光声信号, B: 光电二极管/参考信号)
+    # 双通道时 B 通道保存为 raw_data_B, 维度与 raw_data 相同
+    ACQ_CHANNELS = ats.CHANNEL_A
+    # 主从多板卡 (共用主板卡的时钟和触发): 例如 [1, 2], 每块板卡都采 ACQ_CHANNELS,
+    # 主板卡第一个通道保存为 raw_data, 其余通道为 raw_data_<板卡号><通道> (例如 raw_data_2A);
+    # None 为单板卡。多板卡只支持 "time" + "step" + "serial" 的逐点采集, 需要关闭 USE_STREAM_WORKER / 深度窗 / 稳健统计
+    BOARD_IDS = None
+    USE_STREAM_WORKER = True # 后台线程持续服务 DMA, 位移台串口查询卡住时板卡也不会溢出
+    RING_BUFFERS = 256       # 后台线程环形队列的 Buffer 数 (只需大于每点的 Buffer 数并留出余量)
+    # 像素分配方式: "serial" -> 串口查询到位后取数据; "aux" -> 位移台 TTL 接到板卡 AUX 口,
+    # 按 NPT footer 里的 AUX 电平直接把 record 分到像素 (不再轮询串口, 需要 AVERAGE_ENABLE 和 USE_STREAM_WORKER)
+    PIXEL_BINNING = "serial"
+    # 扫描方式: "step" -> AutoScan 逐点停-稳-采; "fly" -> 每行匀速扫过, 按带时间戳的位置日志插值分配 record
+    # ("fly" 需要 AVERAGE_ENABLE 和 USE_STREAM_WORKER)
+    SCAN_MODE = "step"
+    LASER_PRF_HZ = 80000     # 激光重复频率 ("fly" 模式用它推算每条 record 的时间)
+    # 后台线程全速查询位移台位置: 主循环读最新位置不再等串口往返, "fly" 模式用带时间戳的位置历史插值
+    USE_POSITION_STREAM = True
+    FLY_SPEED_PERCENT = 5    # "fly" 模式扫描速度 (SMS 百分比), 每像素 record 数 ≈ PRF * 步长 / 速度
+    records_per_pixel = None # "aux" 模式下每个像素实际累加的 record 数
+    # 边扫描边写盘 (MATLAB v7.3 分块 HDF5): 内存不再随扫描大小增长, 中途出错已采的点也在磁盘上
+    STREAM_TO_DISK = True
+    # 预分配整个扫描的结果数组, DMA 数据直接写入, 避免最后 vstack 的整块复制。
+    # 边扫描边写盘时 Arena 会重新让内存随扫描大小增长, 默认只在不写盘时使用
+    USE_ARENA = not STREAM_TO_DISK
+    # 采集内容: "time" -> 原始/平均 A-line; "fft" -> 板卡 FPGA 做 FFT, 每个点只保存平均功率谱和谱特征
+    # ("fft" 需要板载 FFT 固件, 只支持 "step" + "serial" 单通道, 结果保存为 fft_spectra / fft_features)
+    ACQ_MODE = "time"
+    # 深度窗 (相对触发的采样点 [start, stop)): 板卡只采集这段时间窗, 传输/存储量按比例减少; None 为采集整条 record
+    # CALIBRATE_DEPTH_GATE=True 时先做一次预览采集自动标定 (需要激光已开), 结果会覆盖 DEPTH_GATE
+    DEPTH_GATE = None
+    CALIBRATE_DEPTH_GATE = False
+    # 稳健统计 (仅平均模式 + "step" + "serial", 会关闭 FPGA 平均): 额外保存截尾均值 A-line (*_robust)、
+    # snr_map、outlier_counts (激光能量异常的 record 数) 和 code_min / code_max (检查饱和), 均按通道分列,
+    # 不需要保存原始 record 就能抑制激光抖动
+    ROBUST_STATS = False
+    TRIM_FRACTION = 0.125    # 每个 Buffer 两端各去掉的 record 比例, 0.5 为近似中位数
+    # 采集时逐点计算 MAP (去直流最大幅值) / 峰值时间 / 能量图, 保存为 map_image / peak_time_map / energy_map,
+    # 扫描结束即有全分辨率 MAP, 不必再用 PAM_Reconstruction.m 遍历全部 A-line
+    LIVE_MAP = True
+    # 实时 MAP 改用 Hilbert 包络 (最大包络值), ENVELOPE_BAND_HZ 为包络前的带通滤波频带 (None 为只去直流)
+    LIVE_MAP_ENVELOPE = False
+    ENVELOPE_BAND_HZ = (5e6, 100e6)
+    FFT_OUTPUT_FORMAT = ats.FFT_OUTPUT_FORMAT_FLOAT_AMP2
+    FFT_BANDS_HZ = [(1e6, 10e6), (10e6, 50e6)] # 需要积分的频带 (按换能器带宽设置)
     
     # 数据量计算与内存使用分析：
     # 1. 基础扫描范围数据量：
@@ -49,73 +111,213 @@ def main():
 
     
 
+    CHANNEL_DATASETS = ["raw_data", "raw_data_B"] # 按交织顺序, 第一个通道沿用 raw_data
+
+    def extra_arrays():
+        """采集过程中算好的结果: 稳健统计 (切出深度窗, 按通道拆开) 和实时 MAP, 没有开启时为空"""
+        arrays = {}
+        if daq.record_stats is not None:
+            robust_aline, snr_map, outlier_counts, code_min, code_max = daq.record_stats.get_result()
+            # (点数, 通道数), 通道顺序与 raw_data / raw_data_B 相同
+            arrays.update(snr_map=snr_map, outlier_counts=outlier_counts, code_min=code_min, code_max=code_max)
+            for name, data in zip(CHANNEL_DATASETS, daq.split_channels(daq.gate_records(robust_aline))):
+                arrays[name + "_robust"] = data
+        if daq.live_map is not None:
+            arrays.update(map_image=daq.live_map["map"], peak_time_map=daq.live_map["peak_time_s"],
+                          energy_map=daq.live_map["energy"])
+        if daq.acq_stats["failed_points"]:
+            # 重试后仍失败、已填 0 的点 (采集顺序的序号, 从 0 开始)
+            arrays["failed_points"] = np.array(daq.acq_stats["failed_points"], dtype=np.int64)
+        return arrays
+
+    def to_saved(point_bufs, divisor):
+        """单个点的 Buffer 列表 -> 保存格式 (切出深度窗; 平均模式下除以 record 数并转回 uint16)"""
+        point = daq.gate_records(daq.stack_point(point_bufs))
+        if AVERAGE_ENABLE:
+            return (point / divisor).astype(np.uint16)
+        return point
+
+    if BOARD_IDS is not None and (ACQ_MODE != "time" or SCAN_MODE != "step" or PIXEL_BINNING != "serial"
+                                  or USE_STREAM_WORKER or DEPTH_GATE or CALIBRATE_DEPTH_GATE or ROBUST_STATS):
+        raise ValueError('多板卡 (BOARD_IDS) 只支持 ACQ_MODE="time" + SCAN_MODE="step" + PIXEL_BINNING="serial", '
+                         '且需关闭 USE_STREAM_WORKER / DEPTH_GATE / CALIBRATE_DEPTH_GATE / ROBUST_STATS')
+
     # === 2. 初始化硬件 ===
+    writer = None
     try:
         # 初始化位移台 & 采集卡
         stage = PriorUnifiedStage(DLL_PATH, COM_PORT)
-        daq = AlazarNPTSystem(systemId=1, boardId=1)
-        daq.configure_board() 
-        daq.prepare_acquisition(num_points=SCAN_W*SCAN_H+1,
-                                acq_channel=ats.CHANNEL_A, 
-                                samples_per_record=SAMPLES_REC,
-                                records_per_buffer=RECORDS_BUF,
-                                buffer_count=Buffer_Count, 
-                                records_per_point=RECORDS_PER_POINT,
-                                preTriggerSamples=0) # 准备 DMA
+        if BOARD_IDS is not None:
+            daq = AlazarMultiBoardSystem(systemId=1, board_ids=BOARD_IDS)
+            daq.configure_boards()
+        else:
+            daq = AlazarNPTSystem(systemId=1, boardId=1)
+            daq.configure_board(aux_in=(PIXEL_BINNING == "aux"))
+        if CALIBRATE_DEPTH_GATE:
+            input("Press Enter to calibrate depth gate... (确保激光器已开)\n")
+            DEPTH_GATE = daq.calibrate_depth_gate(SAMPLES_REC, acq_channel=ACQ_CHANNELS)
+        # 实际传输的记录长度 (深度窗对齐后的长度) 与保存的采样点数
+        acq_samples = daq.plan_depth_gate(*DEPTH_GATE)["samples_per_record"] if DEPTH_GATE else SAMPLES_REC
+        saved_samples = DEPTH_GATE[1] - DEPTH_GATE[0] if DEPTH_GATE else SAMPLES_REC
+        if AUTO_BUFFER_PLAN:
+            # 不可行的组合在这里直接报错, 不会去配置 DMA
+            plan = daq.plan_buffer_geometry(LASER_PRF_HZ, acq_samples, RECORDS_PER_POINT,
+                                            channel_count=bin(ACQ_CHANNELS).count("1"),
+                                            available_ram_bytes=AVAILABLE_RAM_GB * 1024**3,
+                                            target_buffer_rate_hz=TARGET_BUFFER_RATE_HZ,
+                                            host_bytes_per_s=HOST_BYTES_PER_S)
+            RECORDS_BUF, Buffer_Count = plan["records_per_buffer"], plan["buffer_count"]
+            print(f"✅ [DAQ] Buffer 规划: {RECORDS_BUF} records/buffer x {Buffer_Count} 个, "
+                  f"{plan['buffer_rate_hz']:.0f} buffers/s, 余量 {plan['headroom']:.1f}x, "
+                  f"可承受 {plan['stall_cover_ms']:.0f} ms 卡顿")
+        if ACQ_MODE == "fft":
+            if SCAN_MODE != "step" or PIXEL_BINNING != "serial":
+                raise ValueError('ACQ_MODE="fft" 只支持 SCAN_MODE="step" + PIXEL_BINNING="serial"')
+            daq.prepare_fft_acquisition(num_points=SCAN_W*SCAN_H+1,
+                                        acq_channel=ACQ_CHANNELS,
+                                        samples_per_record=SAMPLES_REC,
+                                        records_per_buffer=RECORDS_BUF,
+                                        buffer_count=Buffer_Count,
+                                        records_per_point=RECORDS_PER_POINT,
+                                        output_format=FFT_OUTPUT_FORMAT,
+                                        bands_hz=FFT_BANDS_HZ,
+                                        prf_hz=LASER_PRF_HZ)
+        else:
+            daq.prepare_acquisition(num_points=SCAN_W*SCAN_H+1,
+                                    acq_channel=ACQ_CHANNELS,
+                                    samples_per_record=SAMPLES_REC,
+                                    records_per_buffer=RECORDS_BUF,
+                                    buffer_count=Buffer_Count, 
+                                    records_per_point=RECORDS_PER_POINT,
+                                    preTriggerSamples=0,
+                                    use_arena=USE_ARENA,
+                                    Average_Enable=AVERAGE_ENABLE,
+                                    infinite_acquisition=USE_STREAM_WORKER,
+                                    enable_footers=(PIXEL_BINNING == "aux"),
+                                    hardware_average=(HARDWARE_AVERAGE and SCAN_MODE == "step"
+                                                      and PIXEL_BINNING == "serial"),
+                                    depth_gate=DEPTH_GATE,
+                                    robust_stats=(ROBUST_STATS and AVERAGE_ENABLE and SCAN_MODE == "step"
+                                                  and PIXEL_BINNING == "serial"),
+                                    trim_fraction=TRIM_FRACTION,
+                                    prf_hz=LASER_PRF_HZ) # 准备 DMA
+            if LIVE_MAP:
+                envelope = HilbertEnvelope(daq.samplesPerSec, band_hz=ENVELOPE_BAND_HZ) if LIVE_MAP_ENVELOPE else None
+                daq.enable_live_map(SCAN_W, SCAN_H, envelope=envelope)
+        if BOARD_IDS is not None:
+            CHANNEL_DATASETS = ["raw_data"] + [f"raw_data_{info['name']}" for info in daq.channel_info[1:]]
+        if STREAM_TO_DISK and ACQ_MODE == "time":
+            writer = HDF5StreamWriter(save_path, saved_samples, 1 if AVERAGE_ENABLE else RECORDS_PER_POINT,
+                                      structs={"scan_params": {"width": SCAN_W, "height": SCAN_H, "step": STEP_UM},
+                                               "daq_params": {"samples_per_record": saved_samples,
+                                                              "records_per_point": RECORDS_PER_POINT,
+                                                              "is_averaged": int(AVERAGE_ENABLE),
+                                                              "channel_count": daq.channelCount,
+                                                              "gate_start_sample": daq.gateStart}},
+                                      dataset_names=CHANNEL_DATASETS[:daq.channelCount])
         
         # === 3. 配置扫描 ===
         # 准备位移台 (此时未动)
-        stage.prepare_scan_serial(width_px=SCAN_W, height_px=SCAN_H,
-                                step_um=STEP_UM, exposure_ms=EXPOSURE_MS,
-                                settle_ms=SETTLE_MS, ttl_pin=0)
+        if SCAN_MODE == "fly":
+            stage.connect_serial() # 飞行扫描由主循环直接下发移动指令, 不用 AutoScan
+        else:
+            stage.prepare_scan_serial(width_px=SCAN_W, height_px=SCAN_H,
+                                    step_um=STEP_UM, exposure_ms=EXPOSURE_MS,
+                                    settle_ms=SETTLE_MS, ttl_pin=0)
+        if USE_POSITION_STREAM:
+            stage.start_position_stream()
         
         # 准备数据存储 (内存 RAM)
         # 注意: 如果数据量太大(>8GB), 列表会爆内存。
         # 这里假设采集 100x100 的图像，每个位置可能有多个激光trigger
         all_data = []      # 存 DAQ 数据
-        pos_mapping = []   # 存 (X,Y, Buffer_Index)
+        pos_mapping = np.zeros((SCAN_W*SCAN_H, 3), dtype=np.int64) # 每个点到位时的 (X, Y, Z), 按采集顺序
         positio_point_count = 0
         input("Press Enter to START Experiment... (确保激光器已开)\n\n")
         print("Starting Main Loop...")
-        raw_pos = stage.get_pos_fast()
+        curr_pos = stage.get_pos()
+        if curr_pos is None:
+            raise TimeoutError("读取位移台起始位置失败")
 
-        START_X, START_Y, _= [int(v) for v in raw_pos.split(',')]
-        expected_trajectory_str = get_expected_trajectory(SCAN_W, SCAN_H, STEP_UM, START_X, START_Y)
+        START_X, START_Y, _ = curr_pos
+        # 目标坐标 (整数) 和 坐标 -> 像素序号 的哈希表: 到位判定按数值比较, 不再按字符串比较
+        expected_trajectory = get_expected_trajectory_xy(SCAN_W, SCAN_H, STEP_UM, START_X, START_Y)
+        pixel_lookup = build_pixel_lookup(expected_trajectory)
 
-        progress_manager.start(total=SCAN_W*SCAN_H, desc=f"\033[31m📍 Pos: {raw_pos}\033[31m")
+        progress_manager.start(total=SCAN_W*SCAN_H, desc=f"\033[31m📍 Pos: {curr_pos}\033[31m")
         progress_manager.set_colour("cyan") # 扫描开始，设为青色
         # === 4. 启动同步 ===
         # A. 开启 DAQ (进入等待触发状态)
         start_t = time.time()
         daq.start_capture()
+        if USE_STREAM_WORKER and ACQ_MODE == "time":
+            daq.start_stream_worker(ring_buffers=RING_BUFFERS)
 
         # B. 开启 位移台 (开始发出 TTL 触发 & 移动)
-        stage.start_scan_motion()
+        if SCAN_MODE != "fly":
+            stage.start_scan_motion()
 
         # === 5. 主循环 (Polling Loop) ===
-        for target_str in expected_trajectory_str:
-            # print(expected_trajectory_str)
+        if SCAN_MODE == "fly":
+            fly = FlyScanController(stage, daq, prf_hz=LASER_PRF_HZ, tol_um=POS_TOLERANCE_UM)
+            binned, records_per_pixel = fly.scan(SCAN_W, SCAN_H, STEP_UM, START_X, START_Y,
+                                                 speed_percent=FLY_SPEED_PERCENT, progress_cb=progress_manager.update)
+            for i, (x, y) in enumerate(expected_trajectory):
+                all_data.append([binned[i]])
+                pos_mapping[i] = (x, y, 0)
+                if writer is not None:
+                    writer.append(to_saved(all_data[-1], max(records_per_pixel[i], 1)), (x, y, 0))
+            daq.map_pixels(np.asarray(binned) / np.maximum(records_per_pixel, 1)[:, None], first_pixel=0)
+            expected_trajectory = expected_trajectory[:0] # 跳过下面的串口轮询
+        elif PIXEL_BINNING == "aux":
+            # record 按 footer 中的 TTL 电平直接归到像素, 只要等待全部像素完成
+            binned, records_per_pixel = daq.collect_footer_binned(SCAN_W*SCAN_H, timeout_ms=EXPOSURE_MS*4, bin_mode="aux",
+                                                                  progress_cb=progress_manager.update)
+            for i, (x, y) in enumerate(expected_trajectory):
+                all_data.append([binned[i]])
+                pos_mapping[i] = (x, y, 0)
+                if writer is not None:
+                    writer.append(to_saved(all_data[-1], max(records_per_pixel[i], 1)), (x, y, 0))
+            daq.map_pixels(np.asarray(binned) / np.maximum(records_per_pixel, 1)[:, None], first_pixel=0)
+            expected_trajectory = expected_trajectory[:0] # 跳过下面的串口轮询
+
+        for k in range(len(expected_trajectory)):
+            t_end = time.perf_counter() + ARRIVE_TIMEOUT_S
             while True:
-                # 1. 快速查询并去空格
-                raw_pos = stage.get_pos_fast()
-                # 2. 第一重判定：是否到达目标字符串
-                if raw_pos == target_str:
+                # 1. 快速查询 (整数坐标), 查哈希表得到所在像素
+                curr_pos = stage.get_pos()
+                # 2. 第一重判定：是否到达第 k 个像素 (容差内)
+                if curr_pos is not None and lookup_pixel(pixel_lookup, curr_pos[0], curr_pos[1], POS_TOLERANCE_UM) == k:
                     
                     # 3. 停稳等待 (settle_ms)
                     time.sleep(SETTLE_MS/1000.)
                     
-                    # 4. 第二重确认：再次读取，如果还是 target_str，说明真的稳了
-                    verify_pos = stage.get_pos_fast()
-                    if verify_pos == target_str:
+                    # 4. 第二重确认：再次读取，如果还在同一个像素，说明真的稳了
+                    verify_pos = stage.get_pos()
+                    if verify_pos is not None and stage.is_at(verify_pos, *expected_trajectory[k], POS_TOLERANCE_UM):
+                        curr_pos = verify_pos
                         break
-                    else:
-                        pass
+                if time.perf_counter() > t_end:
+                    raise TimeoutError(f"位移台 {ARRIVE_TIMEOUT_S}s 内未到达第 {k} 个像素 "
+                                       f"{tuple(expected_trajectory[k])}, 当前位置 {curr_pos}")
                 time.sleep(SETTLE_MS/2000.)
 
-            daq.get_one_acquisition(all_data, pos_mapping, raw_pos, timeout_ms=int(EXPOSURE_MS*4/5), Average_Enable=AVERAGE_ENABLE)
+            if ACQ_MODE == "fft":
+                daq.get_fft_acquisition(all_data, pos_mapping, curr_pos, timeout_ms=int(EXPOSURE_MS*4/5))
+            elif USE_STREAM_WORKER:
+                # 位移台已停稳: 从此刻之后完成的 Buffer 归为当前像素
+                daq.get_stream_acquisition(all_data, pos_mapping, curr_pos, start_buffer=daq.stream_head,
+                                           timeout_ms=int(EXPOSURE_MS*4/5), Average_Enable=AVERAGE_ENABLE)
+            else:
+                daq.get_one_acquisition(all_data, pos_mapping, curr_pos, timeout_ms=int(EXPOSURE_MS*4/5), Average_Enable=AVERAGE_ENABLE)
+
+            if writer is not None:
+                writer.append(to_saved(all_data[-1], RECORDS_PER_POINT), curr_pos)
+                if daq.result_arena is None:
+                    all_data[-1] = None # 已交给写盘线程, 不在内存里保留
                   
             progress_manager.update(1)
-            progress_manager.set_description(f"📍 Pos: {raw_pos}",color="green") # 实时显示坐标
+            progress_manager.set_description(f"📍 Pos: {curr_pos}",color="green") # 实时显示坐标
             positio_point_count += 1
         
             if positio_point_count >= SCAN_W * SCAN_H:
@@ -131,6 +333,11 @@ def main():
         progress_manager.set_colour("red") 
         print(traceback.format_exc())
         print("\n❌ 采集超时！可能是激光器没开，或者位移台触发线没接好。")
+    except AcquisitionError as e:
+        # 单个点的超时 / 溢出会自动重新装载 DMA 并重试, 只有连续多个点都失败才会到这里
+        progress_manager.set_colour("red")
+        print(traceback.format_exc())
+        print(f"\n❌ 连续 {daq.max_failed_points} 个点采集失败 ({e.kind})！可能是激光器没开，或者位移台触发线没接好。")
     except KeyboardInterrupt:
         progress_manager.set_colour("red")
         print(traceback.format_exc())
@@ -146,45 +353,81 @@ def main():
         try: progress_manager.stop()
         except: pass
         
-        # 恢复垃圾回收机制并尝试切换回 SDK 模式
+        # 恢复垃圾回收机制; 串口会话保持打开 (不再切回 SDK 模式), 只停止后台位置线程
         import gc
         gc.enable()
-        try: stage.connect_sdk() 
+        try: stage.stop_position_stream()
         except: pass
 
         duration = time.time() - start_t
         print(f"\n📊 实验耗时: {duration:.2f}s")
         print(f"📦 采集点数: {len(all_data)}")
+        if daq.acq_stats is not None:
+            stats = daq.get_acquisition_stats()
+            print(f"📊 DMA: {stats['buffers']} buffers, {stats['records']} records, 超时 {stats['timeouts']}, "
+                  f"溢出 {stats['overflows']}, 重新装载 {stats['rearms']}, 丢失 record {stats['lost_records']}, "
+                  f"重试点 {stats['retried_points']}, 失败点 {stats['failed_points']}, 落后警告 {stats['lag_warnings']}")
+            if stats["trigger_rate_hz"]:
+                print(f"📊 实测触发率: {stats['trigger_rate_hz']:.0f} Hz (设定 {LASER_PRF_HZ} Hz)")
 
-        if len(all_data) > 0:
+        if writer is not None:
+            # 边扫描边写盘: 只需等待队列写完
+            try:
+                saved = writer.close(arrays=extra_arrays())
+                print(f"✅ 成功保存 {saved} 个点至 {save_path}")
+            except Exception:
+                print(f"❌ 写盘发生意外错误:\n{traceback.format_exc()}")
+        elif ACQ_MODE == "fft" and len(all_data) > 0:
+            # 板载 FFT: 每个点只有平均功率谱 + 特征, 数据量很小, 直接 savemat
+            try:
+                spectra, features = daq.get_fft_result()
+                sio.savemat(save_path, {
+                    "fft_spectra": spectra,
+                    "fft_features": features,
+                    "feature_names": np.array(daq.feature_names, dtype=object),
+                    "fft_freqs_hz": daq.fft_freqs_hz,
+                    "pos_map": pos_mapping[:len(all_data)].astype(np.float64),
+                    "scan_params": {"width": SCAN_W, "height": SCAN_H, "step": STEP_UM},
+                    "daq_params": {"samples_per_record": SAMPLES_REC, "records_per_point": RECORDS_PER_POINT,
+                                   "fft_length": daq.fftLength, "missing_records": daq.acq_stats["lost_records"]},
+                    "failed_points": np.array(daq.acq_stats["failed_points"], dtype=np.int64),
+                }, do_compression=True)
+                print(f"✅ 成功保存！频谱维度: {spectra.shape}, 特征: {daq.feature_names}")
+            except Exception:
+                print(f"❌ 数据处理发生意外错误:\n{traceback.format_exc()}")
+        elif len(all_data) > 0:
             print(f"💾 正在解析并保存数据至 {save_path} ... ")
             
-            # --- 坐标解析 (数值化) ---
-            try:
-                # 将坐标字符串解析为 (N, 3) 的 float64 矩阵，方便 MATLAB 直接处理
-                pos_numeric = np.array([[float(v) for v in s.split(',')] for s in pos_mapping])
-            except Exception as e:
-                print(f"⚠️ 坐标解析失败: {e}")
-                pos_numeric = np.array(pos_mapping) 
+            # 坐标已是整数数组, 转成 (N, 3) 的 float64 矩阵，方便 MATLAB 直接处理
+            pos_numeric = pos_mapping[:len(all_data)].astype(np.float64)
 
             # --- 数据重塑与平均逻辑 ---
             try:
-                # 1. 展平嵌套列表
-                # 如果开启了 Average_Enable，每个子列表里现在只有 1 个 summed_data 数组
-                flattened_buffers = [buf for point_bufs in all_data for buf in point_bufs]
-                
-                # 2. 垂直堆叠为大矩阵 (Point, Samples)
-                raw_matrix = np.vstack(flattened_buffers) 
+                if daq.result_arena is not None:
+                    # Arena 模式: 数据已经按 (点数, record数 或 1, 采样点数) 排好, 直接取视图
+                    raw_matrix = daq.get_arena_result().reshape(-1, daq.recordLength)
+                else:
+                    # 1. 展平嵌套列表
+                    # 如果开启了 Average_Enable，每个子列表里现在只有 1 个 summed_data 数组
+                    flattened_buffers = [buf for point_bufs in all_data for buf in point_bufs]
+                    
+                    # 2. 垂直堆叠为大矩阵 (Point, Samples)
+                    raw_matrix = np.vstack(flattened_buffers) 
                 
                 if AVERAGE_ENABLE:
                     # 计算公式: Final_Data = sum(Records) / RECORDS_ACQ
-                    # 此时 raw_matrix 的 dtype 是 uint32，除法会自动处理精度
-                    final_data = (raw_matrix / RECORDS_PER_POINT).astype(np.uint16)
+                    # 此时 raw_matrix 的 dtype 是 uint32 (或 uint64)，除法会自动处理精度
+                    # "aux" 模式下每个像素的 record 数由 TTL 宽度决定, 按实际计数平均
+                    divisor = np.maximum(records_per_pixel, 1)[:, None] if records_per_pixel is not None else RECORDS_PER_POINT
+                    final_data = (raw_matrix / divisor).astype(np.uint16)
                     # 重新塑形为 (点数, 1, 采样点数) 以符合你的 3D 维度要求
-                    final_data = final_data.reshape(len(all_data), 1, SAMPLES_REC)
+                    final_data = final_data.reshape(len(all_data), 1, daq.recordLength)
                 else:
                     # 原始非平均模式
-                    final_data = raw_matrix.reshape(len(all_data), -1, SAMPLES_REC)
+                    final_data = raw_matrix.reshape(len(all_data), -1, daq.recordLength)
+                # 切出深度窗, 多通道时按通道拆开 (单通道时就是 final_data 本身)
+                channel_data = daq.split_channels(daq.gate_records(final_data))
+                final_data = channel_data[0]
                 
                 # 4. 封装字典
                 mat_dict = {
@@ -196,11 +439,16 @@ def main():
                         "step": STEP_UM
                     },
                     "daq_params": {
-                        "samples_per_record": SAMPLES_REC,
+                        "samples_per_record": saved_samples,
                         "records_per_point": RECORDS_PER_POINT,
-                        "is_averaged": int(AVERAGE_ENABLE)
+                        "is_averaged": int(AVERAGE_ENABLE),
+                        "channel_count": daq.channelCount,
+                        "gate_start_sample": daq.gateStart
                     }
                 }
+                for name, data in zip(CHANNEL_DATASETS[1:], channel_data[1:]):
+                    mat_dict[name] = data
+                mat_dict.update(extra_arrays())
                 
                 # 5. 保存文件 (如果不追求文件大小，do_compression=False 可以让保存瞬间完成)
                 sio.savemat(save_path, mat_dict, do_compression=True)
@@ -209,7 +457,6 @@ def main():
             except MemoryError:
                 print("❌ 内存爆炸！可能是由于 raw_matrix 展平时申请了过大的连续空间。")
             except Exception as e:
-                import traceback
                 print(f"❌ 数据处理发生意外错误:\n{traceback.format_exc()}")
         else:
             print("⚠️ 未采集到任何有效数据，跳过保存。")
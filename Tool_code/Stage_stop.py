@@ -1,4 +1,5 @@
 import serial
+import sys
 import time
 
 def force_stop_and_reset(port="COM4"):
@@ -63,4 +64,5 @@ def force_stop_and_reset(port="COM4"):
 
 # --- 直接运行测试 ---
 if __name__ == "__main__":
-    force_stop_and_reset("COM4")
\ No newline at end of file
+    # 也可以传入端口, 例如虚拟控制器 (python -m Alazar_imaging.PriorVirtualController): python Stage_stop.py /dev/pts/5
+    force_stop_and_reset(sys.argv[1] if len(sys.argv) > 1 else "COM4")
\ No newline at end of file
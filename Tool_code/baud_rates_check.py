@@ -1,12 +1,17 @@
 import serial
 import serial.tools.list_ports
+from serial.tools.list_ports_common import ListPortInfo
+import sys
 import time
 
 def scan_prior_controller():
     print("🔍 开始寻找 Prior 控制器...")
     
-    # 1. 列出所有可用端口
-    ports = list(serial.tools.list_ports.comports())
+    # 1. 列出所有可用端口 (命令行传入的端口优先, 例如虚拟控制器的 /dev/pts/5 不会出现在 comports 里)
+    if len(sys.argv) > 1:
+        ports = [ListPortInfo(device) for device in sys.argv[1:]]
+    else:
+        ports = list(serial.tools.list_ports.comports())
     if not ports:
         print("❌ 未发现任何 COM 端口！请检查 USB 线连接。")
         return
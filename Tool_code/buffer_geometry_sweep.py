@@ -0,0 +1,82 @@
+"""
+扫描不同的 (PRF, 采样点数, 每点 record 数, 通道数) 组合, 用 plan_buffer_geometry 规划 DMA Buffer,
+在模拟板卡上测量主机的实际处理能力, 报告余量 (headroom):
+    headroom = 主机能处理的 Buffer 频率 / 实际需要的 Buffer 频率
+同时与原来写死的 RECORDS_BUF=16 / Buffer_Count=4 对比。headroom < 1 表示必然溢出。
+"plan" 列是 plan_buffer_geometry 按 HOST_BYTES_PER_S 估算的余量, 低于 MIN_HEADROOM 的组合被拒绝 (REJECT);
+实测余量明显低于估算时应调小 HOST_BYTES_PER_S。
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging import SimulatedATS9373 as sim
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem
+
+# ================= 配置参数 =================
+PRF_LIST = [20e3, 80e3, 200e3]
+SAMPLES_LIST = [1024, 2048, 4096]
+RECORDS_PER_POINT_LIST = [256, 1000, 1024]
+CHANNEL_LIST = [sim.CHANNEL_A, sim.CHANNEL_A | sim.CHANNEL_B]
+AVAILABLE_RAM_GB = 16
+TARGET_BUFFER_RATE_HZ = 1000
+HOST_BYTES_PER_S = AlazarNPTSystem.MAX_HOST_BYTES_PER_S
+FIXED_GEOMETRY = (16, 4)             # 原 PAM_Main 的 RECORDS_BUF, Buffer_Count
+MEASURE_BUFFERS = 400                # 每个组合测量多少个 Buffer
+# ===========================================
+
+
+def host_capacity(samples, channels, records_per_buffer, buffer_count, records_per_point):
+    """
+    让模拟板卡以远高于主机处理能力的 PRF 产生数据 (FIFO 足够大, 不会溢出),
+    主机按平均模式处理, 测得的 Buffer/s 就是主机的处理上限。
+    """
+    daq = AlazarNPTSystem(backend=sim)
+    daq.configure_board()
+    buffers_per_point = records_per_point // records_per_buffer
+    num_points = max(1, MEASURE_BUFFERS // buffers_per_point)
+    daq.board.set_simulation(prf_hz=1e9, fifo_bytes=2**40)
+    daq.prepare_acquisition(num_points=num_points, acq_channel=channels, samples_per_record=samples,
+                            records_per_buffer=records_per_buffer, buffer_count=buffer_count,
+                            records_per_point=records_per_point, Average_Enable=True)
+    all_data, pos_mapping = [], []
+    daq.start_capture()
+    t_start = time.perf_counter()
+    for _ in range(num_points):
+        daq.get_one_acquisition(all_data, pos_mapping, "0,0,0", timeout_ms=5000, Average_Enable=True)
+    elapsed = time.perf_counter() - t_start
+    daq.stop_capture()
+    return num_points * buffers_per_point / elapsed
+
+
+if __name__ == "__main__":
+    planner = AlazarNPTSystem(backend=sim)
+    print(f"{'PRF':>6s} {'samp':>5s} {'rec/pt':>6s} {'ch':>3s} | {'plan rpb x cnt':>15s} {'buf/s':>7s} "
+          f"{'stall ms':>8s} {'plan':>6s} {'headroom':>8s} | {'fixed 16x4':>10s}")
+    for prf in PRF_LIST:
+        for samples in SAMPLES_LIST:
+            for rpp in RECORDS_PER_POINT_LIST:
+                for channels in CHANNEL_LIST:
+                    n_ch = bin(channels).count("1")
+                    row = f"{prf / 1e3:5.0f}k {samples:5d} {rpp:6d} {n_ch:3d} | "
+                    try:
+                        plan = planner.plan_buffer_geometry(prf, samples, rpp, channel_count=n_ch,
+                                                            available_ram_bytes=AVAILABLE_RAM_GB * 1024**3,
+                                                            target_buffer_rate_hz=TARGET_BUFFER_RATE_HZ,
+                                                            host_bytes_per_s=HOST_BYTES_PER_S)
+                        cap = host_capacity(samples, channels, plan["records_per_buffer"], plan["buffer_count"], rpp)
+                        row += (f"{plan['records_per_buffer']:>8d} x {plan['buffer_count']:<4d} "
+                                f"{plan['buffer_rate_hz']:7.0f} {plan['stall_cover_ms']:8.0f} "
+                                f"{plan['headroom']:5.1f}x {cap / plan['buffer_rate_hz']:7.1f}x | ")
+                    except ValueError as e:
+                        row += f"{'REJECT':>15s} {'':>7s} {'':>8s} {'':>6s} {'':>8s} | "
+                        print(f"   ({e})")
+
+                    rpb, count = FIXED_GEOMETRY
+                    if rpp % rpb:
+                        row += f"{'drops rec':>10s}"
+                    else:
+                        cap = host_capacity(samples, channels, rpb, count, rpp)
+                        row += f"{cap / (prf / rpb):9.1f}x"
+                    print(row)
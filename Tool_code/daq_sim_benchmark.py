@@ -0,0 +1,373 @@
+"""
+在模拟板卡 (SimulatedATS9373) 上测量 AlazarNPTSystem 采集路径的性能, 不需要采集卡。
+报告: 持续 Buffer/s、每个 Buffer 的拷贝/归约耗时、峰值内存, NPT / TS / CS 三种 DMA 引擎的吞吐量对比,
+主从多板卡的总通道数和总带宽, 连续扫描时 DMA Buffer 池的启动耗时和页锁定内存, 以及提高 PRF 后什么时候开始溢出 (丢数据)。
+注意模拟板卡自己的填充线程也占用 CPU/GIL, 所以压力测试得到的上限偏保守。
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging import SimulatedATS9373 as sim
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem
+from Alazar_imaging.AlazarMultiBoardSystem import AlazarMultiBoardSystem
+
+# ================= 配置参数 =================
+SAMPLES_REC = 2048
+RECORDS_BUF = 16
+RECORDS_PER_POINT = 256
+BUFFER_COUNT = 4
+NUM_POINTS = 40
+PRF_HZ = 80000                                  # 实际激光重复频率
+STRESS_PRF_HZ = [80e3, 160e3, 320e3, 640e3, 1280e3, 2560e3]
+STRESS_POINTS = 400                             # 压力测试的点数, 总数据量必须远大于 FIFO 才能测出溢出
+FIFO_BYTES = 16 * 1024**2                       # 压力测试时的板载 FIFO 大小 (越小越容易暴露丢数据)
+SAMPLE_RATE_HZ = 2e9
+POINT_MS = 2.                                   # NPT / TS / CS 对比时每个点的采集时间
+ADMA_POINTS = 200
+BOARD_COUNTS = [1, 2, 4]                        # 主从系统的板卡数 (每块 A+B 两个通道)
+POOL_SCANS = 6                                  # 连续扫描的次数 (Buffer 池对比)
+POOL_RECORDS_BUF = 256                          # 连续扫描用 1 MB 的 Buffer, 分配 / 缺页的开销才明显
+POOL_BUFFER_COUNT = 32
+# ===========================================
+
+MODES = {
+    # 名称: (use_arena, Average_Enable, stream_worker, 通道, FPGA 平均)
+    "list/raw":     (False, False, False, sim.CHANNEL_A, False),
+    "arena/raw":    (True,  False, False, sim.CHANNEL_A, False),
+    "list/avg":     (False, True,  False, sim.CHANNEL_A, False),
+    "arena/avg":    (True,  True,  False, sim.CHANNEL_A, False),
+    "stream/avg":   (True,  True,  True,  sim.CHANNEL_A, False),
+    "arena/avg/AB": (True,  True,  False, sim.CHANNEL_A | sim.CHANNEL_B, False),
+    "stream/avg/AB":(True,  True,  True,  sim.CHANNEL_A | sim.CHANNEL_B, False),
+    "arena/fpga":   (True,  True,  False, sim.CHANNEL_A, True),
+    "stream/fpga":  (True,  True,  True,  sim.CHANNEL_A, True),
+}
+
+# NPT / TS / CS 对比: 短 record (只要脉冲附近) 与 record = 触发周期 (线扫描 / M-mode 需要的不间断波形)
+PERIOD_SAMPLES = int(SAMPLE_RATE_HZ / PRF_HZ)
+NPT_MAX_SAMPLES = PERIOD_SAMPLES // 128 * 128   # NPT 记录长度须为 128 的整数倍
+STREAM_SAMPLES = -(-PERIOD_SAMPLES // 128) * 128 # TS / CS 按 >= 一个周期的长度切 Buffer, 同样 128 对齐
+ADMA_CASES = {
+    # 名称: (adma_mode, samples_per_record)
+    "npt/short":    ("npt", SAMPLES_REC),
+    "ts/short":     ("ts",  SAMPLES_REC),
+    "npt/period":   ("npt", NPT_MAX_SAMPLES),
+    "ts/period":    ("ts",  STREAM_SAMPLES),
+    "cs/period":    ("cs",  STREAM_SAMPLES),
+}
+
+FFT_MODES = {
+    "fft/float":    sim.FFT_OUTPUT_FORMAT_FLOAT_AMP2,
+    "fft/u16log":   sim.FFT_OUTPUT_FORMAT_U16_LOG,
+}
+
+
+def run_mode(use_arena, average, stream, channels, hw_average, prf_hz, fifo_bytes, num_points=NUM_POINTS):
+    daq = AlazarNPTSystem(backend=sim)
+    daq.configure_board()
+    daq.board.set_simulation(prf_hz=prf_hz, fifo_bytes=fifo_bytes)
+
+    tracemalloc.start()
+    daq.prepare_acquisition(num_points=num_points, acq_channel=channels, samples_per_record=SAMPLES_REC,
+                            records_per_buffer=RECORDS_BUF, buffer_count=BUFFER_COUNT,
+                            records_per_point=RECORDS_PER_POINT, use_arena=use_arena,
+                            Average_Enable=average, infinite_acquisition=stream, hardware_average=hw_average,
+                            prf_hz=prf_hz)
+    all_data, pos_mapping = [], []
+    timeout_ms = int(4 * 1000 * RECORDS_PER_POINT / prf_hz) + 50
+    error = None
+    t_start = time.perf_counter()
+    daq.start_capture()
+    if stream:
+        daq.start_stream_worker(ring_buffers=64)
+    try:
+        for i in range(num_points):
+            if stream:
+                daq.get_stream_acquisition(all_data, pos_mapping, "0,0,0", daq.stream_head, timeout_ms, average)
+            else:
+                daq.get_one_acquisition(all_data, pos_mapping, "0,0,0", timeout_ms, average)
+            if daq.acq_stats["overflows"]:
+                # 溢出后 AlazarNPTSystem 会重新装载 DMA 继续采集, 这里只关心第一次溢出
+                error = "ApiBufferOverflow"
+                break
+    except Exception as e:
+        error = type(e).__name__
+    elapsed = time.perf_counter() - t_start
+    daq.stop_capture()
+
+    # 模拟 PAM_Main 保存前的整理 (list 模式要 vstack, arena 模式直接取视图)
+    if daq.result_arena is not None:
+        final = daq.get_arena_result()
+    elif all_data:
+        final = np.vstack([buf for point_bufs in all_data for buf in point_bufs])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = daq.get_acquisition_stats()
+    return {
+        "buffers_per_s": stats["buffers"] / elapsed,
+        "MB_per_point": stats["buffers"] * daq.bytesPerBuffer / max(len(all_data), 1) / 1024**2,
+        "points": len(all_data),
+        "trigger_fraction": daq.board.trigger_hz / prf_hz, # NPT 重新准备触发来不及时 < 1
+        "peak_MB": peak / 1024**2,
+        "max_backlog": daq.board.stats["max_backlog_buffers"],
+        "error": error or ("ApiBufferOverflow" if stats["overflows"] else ""),
+    }
+
+
+def run_fft_mode(output_format, prf_hz, fifo_bytes, num_points=NUM_POINTS):
+    """板载 FFT 模式: 每个 Buffer 只传回功率谱, 主机累加平均谱并计算特征"""
+    daq = AlazarNPTSystem(backend=sim)
+    daq.configure_board()
+    daq.board.set_simulation(prf_hz=prf_hz, fifo_bytes=fifo_bytes)
+    with contextlib.redirect_stdout(io.StringIO()):
+        daq.prepare_fft_acquisition(num_points=num_points, samples_per_record=SAMPLES_REC,
+                                    records_per_buffer=RECORDS_BUF, buffer_count=BUFFER_COUNT,
+                                    records_per_point=RECORDS_PER_POINT, output_format=output_format,
+                                    bands_hz=[(1e6, 10e6), (10e6, 50e6)], prf_hz=prf_hz)
+    all_data, pos_mapping = [], []
+    timeout_ms = int(4 * 1000 * RECORDS_PER_POINT / prf_hz) + 50
+    t_start = time.perf_counter()
+    daq.start_capture()
+    for _ in range(num_points):
+        daq.get_fft_acquisition(all_data, pos_mapping, "0,0,0", timeout_ms)
+        if daq.acq_stats["overflows"]:
+            break
+    elapsed = time.perf_counter() - t_start
+    daq.stop_capture()
+    stats = daq.get_acquisition_stats()
+    return {
+        "buffers_per_s": stats["buffers"] / elapsed,
+        "MB_per_point": stats["buffers"] * daq.bytesPerBuffer / max(len(all_data), 1) / 1024**2,
+        "points": len(all_data),
+        "trigger_fraction": daq.board.trigger_hz / prf_hz,
+        "error": "ApiBufferOverflow" if stats["overflows"] else "",
+    }
+
+
+def run_adma_mode(adma_mode, samples_per_record, num_points=ADMA_POINTS):
+    """
+    同一个 prepare / start / get_one_acquisition 流程分别用 NPT / TS / CS 引擎 (逐 record 原样拷贝, TS / CS 不能平均)。
+    只测吞吐, 每个点的数据拷贝出来后立即丢弃 (200 个点原样保存要几 GB)。
+    TS / CS 的 "record" 是连续波形按 samples_per_record 切出的段, record 率 = 采样率 / samples_per_record;
+    NPT 的 record 率 = 板卡实际接受的触发率。Buffer 几何按 record 率用 plan_buffer_geometry 规划。
+    """
+    daq = AlazarNPTSystem(backend=sim)
+    daq.configure_board()
+    daq.board.set_simulation(prf_hz=PRF_HZ)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if adma_mode == "npt":
+            # 与板卡相同的规则: record + 重新准备触发超过触发周期时每 skip 个触发只采 1 个
+            skip = int(np.ceil((samples_per_record + daq.board.rearm_samples) * PRF_HZ / SAMPLE_RATE_HZ))
+            record_rate = PRF_HZ / skip
+        else:
+            record_rate = SAMPLE_RATE_HZ / samples_per_record
+        records_per_point = 2 ** int(round(np.log2(record_rate * POINT_MS / 1000.)))
+        # 这里比较的是 DMA 引擎本身, 主机余量按 PCIe 上限估算 (TS / CS 连续采集的数据率超过默认的主机吞吐量)
+        plan = daq.plan_buffer_geometry(record_rate, samples_per_record, records_per_point,
+                                        host_bytes_per_s=daq.MAX_DMA_BYTES_PER_S)
+        daq.prepare_acquisition(num_points=num_points, samples_per_record=samples_per_record,
+                                records_per_buffer=plan["records_per_buffer"], buffer_count=plan["buffer_count"],
+                                records_per_point=records_per_point, use_arena=False, Average_Enable=False,
+                                prf_hz=PRF_HZ, adma_mode=adma_mode)
+    all_data, pos_mapping = [], []
+    timeout_ms = int(4 * POINT_MS) + 50
+    error = ""
+    t_start = time.perf_counter()
+    daq.start_capture()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(num_points):
+            daq.get_one_acquisition(all_data, pos_mapping, "0,0,0", timeout_ms, False)
+            all_data[-1] = None # 保留占位, 点的序号不变
+            if daq.acq_stats["overflows"]:
+                error = "ApiBufferOverflow"
+                break
+    elapsed = time.perf_counter() - t_start
+    daq.stop_capture()
+    stats = daq.get_acquisition_stats()
+    records_per_s = stats["records"] / elapsed
+    return {
+        "records_per_buffer": plan["records_per_buffer"],
+        "buffers_per_s": stats["buffers"] / elapsed,
+        "records_per_s": records_per_s,
+        "MB_per_s": stats["buffers"] * daq.bytesPerBuffer / elapsed / 1024**2,
+        # 有数据覆盖的时间比例 (NPT 的 record 之间有间隙, TS / CS 不间断)
+        "duty": min(records_per_s * samples_per_record / SAMPLE_RATE_HZ, 1.),
+        "points": len(all_data),
+        "error": error,
+    }
+
+
+def run_multiboard(board_count, prf_hz, num_points=NUM_POINTS):
+    """主从系统: 每块板卡采 A+B, 各板卡的 DMA 由线程池并行服务, 结果合并进同一个 Arena"""
+    system_id = 100 + board_count # 每种板卡数用单独的 System, 不会启动到别的测试留下的模拟板卡
+    sim.set_system_boards(system_id, board_count)
+    with contextlib.redirect_stdout(io.StringIO()):
+        daq = AlazarMultiBoardSystem(systemId=system_id, backend=sim)
+        daq.configure_boards()
+        for system in daq.systems:
+            system.board.set_simulation(prf_hz=prf_hz)
+        daq.prepare_acquisition(num_points=num_points, acq_channel=sim.CHANNEL_A | sim.CHANNEL_B,
+                                samples_per_record=SAMPLES_REC, records_per_buffer=RECORDS_BUF,
+                                buffer_count=BUFFER_COUNT, records_per_point=RECORDS_PER_POINT,
+                                use_arena=True, Average_Enable=True, prf_hz=prf_hz)
+    all_data, pos_mapping = [], []
+    error = ""
+    t_start = time.perf_counter()
+    daq.start_capture()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            for _ in range(num_points):
+                daq.get_one_acquisition(all_data, pos_mapping, "0,0,0", 1000, True)
+        except Exception as e:
+            error = str(e)[-40:]
+    elapsed = time.perf_counter() - t_start
+    daq.stop_capture()
+    daq.close()
+    stats = daq.get_acquisition_stats()
+    if stats["overflows"]:
+        error = "ApiBufferOverflow"
+    return {
+        "channels": daq.channelCount,
+        "buffers_per_s": stats["buffers"] / elapsed,
+        "MB_per_s": stats["buffers"] * daq.master.bytesPerBuffer / elapsed / 1024**2,
+        "points": len(all_data),
+        "rearms": stats["rearms"],
+        "error": error,
+    }
+
+
+def run_back_to_back(reuse, scans=POOL_SCANS):
+    """
+    同一块板卡连续扫描 scans 次, 测每次 prepare_acquisition -> 第一个点完成的启动时间。
+    reuse=False 时每次扫描后清空 Buffer 池 (相当于原来每次 prepare 重新分配 DMABuffer)。
+    """
+    daq = AlazarNPTSystem(backend=sim)
+    with contextlib.redirect_stdout(io.StringIO()):
+        daq.configure_board()
+        daq.board.set_simulation(prf_hz=PRF_HZ)
+    startup_ms, peak_bytes = [], 0
+    for _ in range(scans):
+        all_data, pos_mapping = [], []
+        t_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            daq.prepare_acquisition(num_points=NUM_POINTS, samples_per_record=SAMPLES_REC,
+                                    records_per_buffer=POOL_RECORDS_BUF, buffer_count=POOL_BUFFER_COUNT,
+                                    records_per_point=POOL_RECORDS_BUF, use_arena=True, Average_Enable=True,
+                                    prf_hz=PRF_HZ)
+            daq.start_capture()
+            daq.get_one_acquisition(all_data, pos_mapping, "0,0,0", 1000, True)
+            startup_ms.append((time.perf_counter() - t_start) * 1000)
+            for _ in range(NUM_POINTS - 1):
+                daq.get_one_acquisition(all_data, pos_mapping, "0,0,0", 1000, True)
+        peak_bytes = max(peak_bytes, daq.buffer_pool.allocated_bytes)
+        daq.stop_capture()
+        if not reuse:
+            daq.buffer_pool.trim()
+    stats = dict(daq.buffer_pool.stats)
+    daq.close()
+    return {
+        "first_ms": startup_ms[0],
+        "later_ms": float(np.mean(startup_ms[1:])),
+        "peak_MB": peak_bytes / 1024**2,
+        "allocations": stats["allocations"],
+    }
+
+
+def copy_cost_us(repeat=2000):
+    """单个 DMA Buffer 的各种处理方式耗时 (微秒)"""
+    buf = np.random.randint(0, 65535, RECORDS_BUF * SAMPLES_REC, dtype=np.uint16)
+    out = np.empty_like(buf)
+    acc = np.zeros(SAMPLES_REC, dtype=np.uint32)
+    partial = np.zeros(SAMPLES_REC, dtype=np.uint32)
+    cases = {
+        "np.copy (list)":        lambda: np.copy(buf),
+        "np.copyto (arena)":     lambda: np.copyto(out, buf),
+        "add.reduce (avg)":      lambda: (np.add.reduce(buf.reshape(RECORDS_BUF, -1), axis=0, dtype=np.uint32, out=partial),
+                                          np.add(acc, partial, out=acc)),
+    }
+    result = {}
+    for name, fn in cases.items():
+        t = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        result[name] = (time.perf_counter() - t) / repeat * 1e6
+    return result
+
+
+def stress_cell(r):
+    if r["error"]:
+        return "DROP"
+    if r["trigger_fraction"] < 1:
+        return f"ok 1/{round(1 / r['trigger_fraction'])}"
+    return "ok"
+
+
+if __name__ == "__main__":
+    bytes_per_buffer = RECORDS_BUF * SAMPLES_REC * 2
+    print(f"Buffer: {RECORDS_BUF} records x {SAMPLES_REC} samples = {bytes_per_buffer / 1024:.0f} KB, "
+          f"{RECORDS_PER_POINT // RECORDS_BUF} buffers/point\n")
+
+    print("--- 单 Buffer 处理耗时 ---")
+    for name, us in copy_cost_us().items():
+        print(f"{name:22s} {us:8.1f} us  ({bytes_per_buffer / us / 1e3:.2f} GB/s)")
+
+    print(f"\n--- 持续采集 @ {PRF_HZ / 1e3:.0f} kHz (理论 {PRF_HZ / RECORDS_BUF:.0f} buffers/s, FPGA 平均时每点 1 个) ---")
+    print(f"{'mode':14s} {'buffers/s':>10s} {'points':>7s} {'MB/point':>9s} {'peak MB':>8s} {'backlog':>8s}  error")
+    for name, (use_arena, average, stream, channels, hw_average) in MODES.items():
+        r = run_mode(use_arena, average, stream, channels, hw_average, PRF_HZ, 512 * 1024**2)
+        print(f"{name:14s} {r['buffers_per_s']:10.0f} {r['points']:7d} {r['MB_per_point']:9.3f} {r['peak_MB']:8.1f} "
+              f"{r['max_backlog']:8d}  {r['error']}")
+
+    print(f"\n--- 板载 FFT @ {PRF_HZ / 1e3:.0f} kHz (只传回 {SAMPLES_REC} 点 FFT 的一半频点 + footer) ---")
+    for name, fmt in FFT_MODES.items():
+        r = run_fft_mode(fmt, PRF_HZ, 512 * 1024**2)
+        print(f"{name:14s} {r['buffers_per_s']:10.0f} {r['points']:7d} {r['MB_per_point']:9.3f} {'':>8s} {'':>8s}  {r['error']}")
+
+    print(f"\n--- NPT / TS / CS @ {PRF_HZ / 1e3:.0f} kHz, 触发周期 {PERIOD_SAMPLES} 个采样点, 每点 {POINT_MS:.0f} ms (raw) ---")
+    print("(NPT 的 records/s 是采到的脉冲数, TS / CS 是连续波形的切片数, 两者不能直接比较; 比较 MB/s 和 duty)")
+    print(f"{'mode':14s} {'samples':>8s} {'rec/buf':>8s} {'buffers/s':>10s} {'records/s':>10s} {'unit':>6s} {'MB/s':>8s} "
+          f"{'duty':>6s} {'points':>7s}  error")
+    for name, (adma_mode, samples) in ADMA_CASES.items():
+        r = run_adma_mode(adma_mode, samples)
+        unit = "pulse" if adma_mode == "npt" else "slice"
+        print(f"{name:14s} {samples:8d} {r['records_per_buffer']:8d} {r['buffers_per_s']:10.0f} {r['records_per_s']:10.0f} "
+              f"{unit:>6s} {r['MB_per_s']:8.0f} {r['duty'] * 100:5.1f}% {r['points']:7d}  {r['error']}")
+
+    print(f"\n--- 主从多板卡 @ {PRF_HZ / 1e3:.0f} kHz (arena/avg, 每块板卡 A+B) ---")
+    print(f"{'boards':14s} {'channels':>8s} {'buffers/s':>10s} {'MB/s':>8s} {'points':>7s} {'rearms':>7s}  error")
+    for board_count in BOARD_COUNTS:
+        r = run_multiboard(board_count, PRF_HZ)
+        print(f"{board_count:<14d} {r['channels']:8d} {r['buffers_per_s']:10.0f} {r['MB_per_s']:8.0f} {r['points']:7d} "
+              f"{r['rearms']:7d}  {r['error']}")
+
+    print(f"\n--- 连续 {POOL_SCANS} 次扫描: prepare -> 第一个点 ({POOL_BUFFER_COUNT} x "
+          f"{POOL_RECORDS_BUF * SAMPLES_REC * 2 / 1024**2:.0f} MB Buffer) ---")
+    print(f"{'buffers':14s} {'first ms':>9s} {'later ms':>9s} {'pinned MB':>10s} {'allocs':>7s}")
+    for name, reuse in (("pool", True), ("fresh", False)):
+        r = run_back_to_back(reuse)
+        print(f"{name:14s} {r['first_ms']:9.2f} {r['later_ms']:9.2f} {r['peak_MB']:10.0f} {r['allocations']:7d}")
+
+    print(f"\n--- 压力测试: 提高 PRF 直到溢出 (FIFO {FIFO_BYTES / 1024**2:.0f} MB) ---")
+    print("(ok 1/N: record + 重新准备触发超过触发周期, NPT 每 N 个触发只采到 1 个)")
+    print(f"{'mode':14s} " + " ".join(f"{p / 1e3:>8.0f}k" for p in STRESS_PRF_HZ))
+    for name, (use_arena, average, stream, channels, hw_average) in MODES.items():
+        cells = []
+        for prf in STRESS_PRF_HZ:
+            with contextlib.redirect_stdout(io.StringIO()): # 溢出时 DMA 线程打印的错误堆栈不显示
+                r = run_mode(use_arena, average, stream, channels, hw_average, prf, FIFO_BYTES, STRESS_POINTS)
+            cells.append(f"{stress_cell(r):>9s}")
+        print(f"{name:14s} " + " ".join(cells))
+    for name, fmt in FFT_MODES.items():
+        cells = []
+        for prf in STRESS_PRF_HZ:
+            with contextlib.redirect_stdout(io.StringIO()):
+                r = run_fft_mode(fmt, prf, FIFO_BYTES, STRESS_POINTS)
+            cells.append(f"{stress_cell(r):>9s}")
+        print(f"{name:14s} " + " ".join(cells))
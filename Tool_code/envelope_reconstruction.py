@@ -0,0 +1,70 @@
+"""
+离线重建: 读取 PAM_Main 保存的 data.mat (v7.3 分块 HDF5 或 savemat 旧格式),
+用 HilbertEnvelope 按块计算每个像素的最大包络值, 按 pos_map 排成图像 (与 PAM_Reconstruction.m 的网格规则相同)。
+原始 (未平均) 数据按像素块读入并先对 record 求平均, 内存只占一个块。
+"""
+import os
+import sys
+import time
+import numpy as np
+import h5py
+import scipy.io as sio
+import matplotlib.pyplot as plt
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging.HilbertEnvelope import HilbertEnvelope
+
+# ================= 配置参数 =================
+DATA_PATH = "./data.mat"
+SAMPLE_RATE_HZ = 2e9
+BAND_HZ = (5e6, 100e6)       # 包络前的带通滤波, None 为只去直流
+PIXELS_PER_BLOCK = 256       # 每次读入的像素数
+OUTPUT_PNG = "result_envelope.png"
+OUTPUT_MAT = "result_envelope.mat"
+# ===========================================
+
+
+def load_scan(path):
+    """
+    :return: (读取像素块的函数 read(n0, n1) -> (n, records, samples), 像素数, pos_map (N, 3), step_um, 关闭函数)
+    """
+    if h5py.is_hdf5(path):
+        f = h5py.File(path, "r")
+        raw = f["raw_data"] # HDF5 (Samples, Records, N), 即 MATLAB 的 [N, Records, Samples]
+        read = lambda n0, n1: raw[:, :, n0:n1].transpose(2, 1, 0)
+        return read, raw.shape[2], f["pos_map"][()].T, float(f["scan_params"]["step"][()].squeeze()), f.close
+    data = sio.loadmat(path, squeeze_me=False)
+    raw = data["raw_data"]
+    step = float(data["scan_params"]["step"][0, 0].squeeze())
+    return (lambda n0, n1: raw[n0:n1]), raw.shape[0], data["pos_map"], step, (lambda: None)
+
+
+if __name__ == "__main__":
+    read, n_points, pos_map, step_um, close = load_scan(DATA_PATH)
+    engine = HilbertEnvelope(SAMPLE_RATE_HZ, band_hz=BAND_HZ)
+    values = np.empty(n_points, dtype=np.float32)
+    t_start = time.perf_counter()
+    for n0 in range(0, n_points, PIXELS_PER_BLOCK):
+        n1 = min(n0 + PIXELS_PER_BLOCK, n_points)
+        block = read(n0, n1)
+        alines = block.mean(axis=1) if block.shape[1] > 1 else block[:, 0, :]
+        values[n0:n1], _ = engine.peak(alines)
+    elapsed = time.perf_counter() - t_start
+    close()
+    print(f"✅ {n_points} 个像素, 包络计算 {elapsed:.2f}s ({n_points / elapsed:.0f} A-lines/s)")
+
+    # 坐标 -> 网格 (round 消除位移台的微小抖动)
+    x_idx = np.rint((pos_map[:, 0] - pos_map[:, 0].min()) / step_um).astype(int)
+    y_idx = np.rint((pos_map[:, 1] - pos_map[:, 1].min()) / step_um).astype(int)
+    image = np.zeros((y_idx.max() + 1, x_idx.max() + 1), dtype=np.float32)
+    image[y_idx, x_idx] = values
+
+    sio.savemat(OUTPUT_MAT, {"envelope_map": image})
+    extent = [pos_map[:, 0].min(), pos_map[:, 0].max(), pos_map[:, 1].max(), pos_map[:, 1].min()]
+    plt.imshow(image, cmap="hot", extent=extent)
+    plt.colorbar()
+    plt.xlabel("X Position (um)")
+    plt.ylabel("Y Position (um)")
+    plt.title("PAM Maximum Envelope Projection")
+    plt.savefig(OUTPUT_PNG, dpi=150)
+    print(f"✅ 图像已保存至 {OUTPUT_PNG} / {OUTPUT_MAT}")
@@ -0,0 +1,91 @@
+"""
+在 pty 虚拟控制器 (PriorVirtualController) 上比较 Prior 串口指令的两种发送方式:
+  sequential  一问一答, 每条指令等到回复再发下一条 (原来的 _serial_send_wait)
+  pipelined   PriorSerialTransport.query_many, 多条指令一次写出, 回复按顺序对应
+  asyncio     PriorSerialTransport.aquery_many (与 pipelined 相同, 供 asyncio 程序使用)
+场景: 扫描配置 (N / X / AS 三条) 和状态 + 位置查询 (AS + P)。
+最后比较 PriorUnifiedStage 串口会话从打开端口到第一次移动 + 读位置的时间 (原来 COMP,0 要先单独等一个往返)。
+只能在 Linux / macOS 上运行 (需要 pty)。
+"""
+import asyncio
+import os
+import sys
+import time
+import numpy as np
+import serial
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging.PriorSerialTransport import PriorSerialTransport
+from Alazar_imaging.PriorUnifiedStage import PriorUnifiedStage
+from Alazar_imaging.PriorVirtualController import PriorVirtualController
+
+# ================= 配置参数 =================
+BAUDRATE = 115200
+LATENCY_S = 1e-3        # 单程链路延迟 (USB 串口的延迟计时器默认 1 ms 量级)
+PROCESS_S = 0.2e-3      # 控制器处理一条指令的时间
+REPEAT = 50
+SESSION_REPEAT = 10
+SCENARIOS = {
+    "setup N/X/AS": ["N,99,99", "X,1,1", "AS,50,5,0,H,S"],
+    "status + pos": ["AS", "P"],
+    "pos only": ["P"],
+}
+# ===========================================
+
+
+def time_ms(fn, repeat=REPEAT):
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t) * 1000)
+    return float(np.median(samples))
+
+
+if __name__ == "__main__":
+    with PriorVirtualController(BAUDRATE, latency_s=LATENCY_S, process_s=PROCESS_S) as controller:
+        ser = serial.Serial(controller.port, BAUDRATE, timeout=0.05)
+        transport = PriorSerialTransport(ser)
+        print(f"虚拟控制器 {controller.port}: 单程延迟 {LATENCY_S * 1e3:.1f} ms, 处理 {PROCESS_S * 1e3:.1f} ms/条, {BAUDRATE} baud")
+        print(f"{'scenario':14s} {'cmds':>5s} {'sequential':>11s} {'pipelined':>10s} {'asyncio':>8s} {'speedup':>8s}  (ms, 中位数)")
+        loop = asyncio.new_event_loop()
+        for name, cmds in SCENARIOS.items():
+            sequential = time_ms(lambda: [transport.query(c) for c in cmds])
+            pipelined = time_ms(lambda: transport.query_many(cmds))
+            asyncio_ms = time_ms(lambda: loop.run_until_complete(transport.aquery_many(cmds)))
+            print(f"{name:14s} {len(cmds):5d} {sequential:11.2f} {pipelined:10.2f} {asyncio_ms:8.2f} "
+                  f"{sequential / pipelined:7.1f}x")
+        loop.close()
+        # 回复内容必须与逐条发送时相同 (顺序对应)
+        assert transport.query_many(["N,9,9", "X,2,2", "P"]) == [transport.query("N,9,9"), transport.query("X,2,2"),
+                                                                   transport.query("P")]
+        print(f"✅ {controller.commands} 条指令, 回复顺序一致")
+        transport.close()
+        ser.close()
+
+        # 打开端口 -> 第一次移动 -> 读到位置 (不含关闭端口):
+        # 逐条等待 (COMP 等一个往返, G 立即返回, P 再一个往返) vs 串口会话 (COMP 不等, 与 P 一起一个往返)
+        def legacy_session():
+            t = time.perf_counter()
+            ser = serial.Serial(controller.port, BAUDRATE, timeout=0.05)
+            transport = PriorSerialTransport(ser)
+            transport.query("COMP,0")
+            transport.submit_move("G,0,0")
+            transport.query("P")
+            elapsed = (time.perf_counter() - t) * 1000
+            transport.close()
+            ser.close()
+            return elapsed
+
+        def unified_session():
+            t = time.perf_counter()
+            stage = PriorUnifiedStage(None, controller.port, BAUDRATE)
+            stage.set_position([0, 0])
+            stage.get_position()
+            elapsed = (time.perf_counter() - t) * 1000
+            stage.disconnect_serial()
+            return elapsed
+
+        legacy = np.median([legacy_session() for _ in range(SESSION_REPEAT)])
+        unified = np.median([unified_session() for _ in range(SESSION_REPEAT)])
+        print(f"📊 打开端口到第一次移动 + 读到位置: 逐条等待 {legacy:.2f} ms, 串口会话 {unified:.2f} ms")
@@ -0,0 +1,98 @@
+"""
+用 pty 虚拟控制器 (PriorVirtualController) 端到端运行 PriorUnifiedStage 的串口模式, 不需要位移台:
+  1. 纯串口模式 (dll_path=None) 连接虚拟控制器的端口
+  2. prepare_scan_serial + start_scan_motion 跑一次蛇形 AutoScan, 主线程用 get_status_and_pos 轮询
+  3. 比较实测的扫描时间、TTL 脉冲数 / 间隔与运动模型的预期
+  4. 扫描中途 emergency_stop, 确认 TTL 停止且位置不再变化
+  5. BAUD 切换: 旧波特率收不到有效回复, 新波特率重新连接后正常
+只能在 Linux / macOS 上运行 (需要 pty)。
+"""
+import os
+import sys
+import time
+import numpy as np
+import serial
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging.PriorUnifiedStage import PriorUnifiedStage
+from Alazar_imaging.PriorVirtualController import PriorVirtualController
+
+# ================= 配置参数 =================
+WIDTH_PX = 10
+HEIGHT_PX = 8
+STEP_UM = 10
+EXPOSURE_MS = 1         # AS 的 TTL 脉冲宽度
+SETTLE_MS = 2           # AS 的每点等待时间
+POLL_S = 0.01
+CONTROLLER = dict(latency_s=1e-3, process_s=0.2e-3, speed_um_s=5000., accel_um_s2=1e5,
+                  settle_s=1e-3, ttl_delay_s=50e-6)
+# ===========================================
+
+
+def run_scan(stage, controller):
+    stage.prepare_scan_serial(WIDTH_PX, HEIGHT_PX, STEP_UM, EXPOSURE_MS, SETTLE_MS)
+    t_start = time.perf_counter()
+    stage.start_scan_motion()
+    polls = 0
+    while True:
+        running, pos = stage.get_status_and_pos()
+        polls += 1
+        if not running:
+            break
+        time.sleep(POLL_S)
+    elapsed = time.perf_counter() - t_start
+    edges = np.array(controller.ttl_edges(since=t_start))
+    expected = controller.scan_duration(WIDTH_PX, HEIGHT_PX, EXPOSURE_MS, SETTLE_MS, STEP_UM)
+    period_ms = np.diff(edges[:, 0]) * 1000 if len(edges) > 1 else np.zeros(1)
+    width_ms = (edges[:, 1] - edges[:, 0]) * 1000
+    print(f"📊 扫描 {WIDTH_PX}x{HEIGHT_PX}: 实测 {elapsed * 1000:.1f} ms (模型 {expected * 1000:.1f} ms, "
+          f"差值为启动往返 + 轮询间隔), 轮询 {polls} 次, 终点 {pos}")
+    print(f"📊 TTL: {len(edges)} 个脉冲, 宽度 {width_ms.mean():.2f} ms, "
+          f"间隔 {period_ms.min():.2f}–{period_ms.max():.2f} ms (每点 {1000 * expected / len(edges):.2f} ms)")
+    assert len(edges) == WIDTH_PX * HEIGHT_PX, "TTL 脉冲数与网格点数不一致"
+    end_x = 0 if HEIGHT_PX % 2 == 0 else (WIDTH_PX - 1) * STEP_UM
+    assert pos == (end_x, (HEIGHT_PX - 1) * STEP_UM, 0), f"终点位置不对: {pos}"
+
+
+def run_emergency_stop(stage, controller):
+    stage.prepare_scan_serial(WIDTH_PX, HEIGHT_PX, STEP_UM, EXPOSURE_MS, SETTLE_MS)
+    stage.start_scan_motion()
+    time.sleep(0.05)
+    stage.emergency_stop()
+    time.sleep(0.05)
+    t_stop = time.perf_counter()
+    pos = stage.get_pos()
+    time.sleep(0.05)
+    assert not stage.is_scan_running(), "急停后 AutoScan 仍在运行"
+    assert stage.get_pos() == pos, "急停后位置仍在变化"
+    assert not controller.ttl_edges(since=t_stop), "急停后仍有 TTL"
+    print(f"✅ 急停: 停在 {pos}, 之后没有 TTL")
+
+
+def run_baud_switch(controller):
+    ser = serial.Serial(controller.port, 115200, timeout=0.1)
+    ser.write(b"BAUD,38\r")
+    ack = ser.read_until(b'\r').decode('ascii', errors='ignore').strip()
+    ser.write(b"?\r")
+    stale = ser.read_until(b'\r').decode('ascii', errors='ignore').strip()
+    ser.baudrate = 38400
+    ser.reset_input_buffer()
+    ser.write(b"?\r")
+    fresh = ser.read_until(b'\r').decode('ascii', errors='ignore').strip()
+    ser.write(b"BAUD,115\r")
+    ser.read_until(b'\r')
+    ser.close()
+    assert ack == "0" and not stale and fresh, (ack, stale, fresh)
+    print(f"✅ BAUD: 115200 下无有效回复, 38400 下回复 '{fresh}'")
+
+
+if __name__ == "__main__":
+    with PriorVirtualController(**CONTROLLER) as controller:
+        print(f"虚拟控制器 {controller.port}")
+        stage = PriorUnifiedStage(None, controller.port)
+        assert stage.mode == 'SERIAL', "纯串口模式连接失败"
+        run_scan(stage, controller)
+        run_emergency_stop(stage, controller)
+        stage.disconnect_serial()
+        run_baud_switch(controller)
+        print(f"✅ 共 {controller.commands} 条指令")
@@ -133,8 +133,8 @@ class PriorPAMScannerSafe:
 
 # --- 主程序 ---
 if __name__ == "__main__":
-    # 请确保 COM 口和波特率正确
-    scanner = PriorPAMScannerSafe(port="COM4", baudrate=115200)
+    # 请确保 COM 口和波特率正确; 也可以传入端口, 例如虚拟控制器: python serial_test.py /dev/pts/5
+    scanner = PriorPAMScannerSafe(port=sys.argv[1] if len(sys.argv) > 1 else "COM4", baudrate=115200)
     
     # 🧪 测试参数
     scanner.configure_scan(width_px=20, height_px=20, step_um=1)
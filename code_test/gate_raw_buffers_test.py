@@ -0,0 +1,64 @@
+"""
+在模拟板卡上检查 list 模式 (不用 Arena) 的原始数据能切深度窗 / 去掉 footer:
+all_data 中每个 Buffer 是展平的一维数组, stack_point 按 record 排好后 gate_records 切出窗口。
+覆盖逐点采集 (get_one_acquisition) 和后台线程 (get_stream_acquisition), 单通道和 A+B 两通道。
+"""
+import contextlib
+import io
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging import SimulatedATS9373 as sim
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem
+
+# ================= 配置参数 =================
+NUM_POINTS = 4
+PRF_HZ = 80000
+RECORDS_PER_BUFFER = 16
+RECORDS_PER_POINT = 64
+DEPTH_GATE = (100, 300)
+# ===========================================
+
+
+def run(channels, stream, depth_gate=DEPTH_GATE, footers=False):
+    daq = AlazarNPTSystem(backend=sim)
+    with contextlib.redirect_stdout(io.StringIO()):
+        daq.configure_board()
+        daq.board.set_simulation(prf_hz=PRF_HZ)
+        daq.prepare_acquisition(NUM_POINTS, acq_channel=channels, samples_per_record=512,
+                                records_per_buffer=RECORDS_PER_BUFFER, records_per_point=RECORDS_PER_POINT,
+                                depth_gate=depth_gate, enable_footers=footers, infinite_acquisition=stream,
+                                prf_hz=PRF_HZ)
+    all_data, pos_mapping = [], []
+    daq.start_capture()
+    if stream:
+        daq.start_stream_worker(64)
+    for i in range(NUM_POINTS):
+        if stream:
+            daq.get_stream_acquisition(all_data, pos_mapping, f"{i},0,0", daq.stream_head, 200)
+        else:
+            daq.get_one_acquisition(all_data, pos_mapping, f"{i},0,0", 200)
+    daq.stop_capture()
+
+    n_ch = bin(channels).count("1")
+    length = daq.gate.stop - daq.gate.start
+    for point_bufs in all_data:
+        records = daq.stack_point(point_bufs)
+        assert records.shape == (RECORDS_PER_POINT, daq.recordLength)
+        gated = daq.gate_records(records)
+        assert gated.shape == (RECORDS_PER_POINT, length * n_ch), gated.shape
+        expected = records.reshape(RECORDS_PER_POINT, -1, n_ch)[:, daq.gate, :].reshape(RECORDS_PER_POINT, -1)
+        assert np.array_equal(gated, expected)
+        for channel in daq.split_channels(gated):
+            assert channel.shape == (RECORDS_PER_POINT, length)
+    mode = "stream" if stream else "per-point"
+    print(f"✅ {mode}, {n_ch} 通道, gate={depth_gate}, footer={footers}: 每点 {gated.shape} 切窗正确")
+
+
+if __name__ == "__main__":
+    for stream in (False, True):
+        run(sim.CHANNEL_A, stream)
+        run(sim.CHANNEL_A | sim.CHANNEL_B, stream)
+        run(sim.CHANNEL_A, stream, depth_gate=None, footers=True)
@@ -0,0 +1,56 @@
+"""
+在模拟板卡上检查 FPGA 平均的逐点采集 (get_one_acquisition, 不开后台线程):
+位移台 "移动" 期间完成的 Buffer 和到位时正在平均的 Buffer 都被丢弃, 每个点的数据只来自到位之后的触发。
+丢弃的 record 计入 discarded_records, records - discarded_records == records_expected 仍然成立。
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging import SimulatedATS9373 as sim
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem
+
+# ================= 配置参数 =================
+NUM_POINTS = 6
+PRF_HZ = 80000
+RECORDS_PER_POINT = 256  # 每个点 3.2 ms
+MOVE_S = 0.012           # 两个点之间的 "移动" 时间, 约 3.75 个点
+TIMEOUT_MS = 50
+# ===========================================
+
+
+def run(use_arena):
+    daq = AlazarNPTSystem(backend=sim)
+    with contextlib.redirect_stdout(io.StringIO()):
+        daq.configure_board()
+        daq.board.set_simulation(prf_hz=PRF_HZ)
+        daq.prepare_acquisition(NUM_POINTS, samples_per_record=512, records_per_buffer=16,
+                                records_per_point=RECORDS_PER_POINT, buffer_count=8, use_arena=use_arena,
+                                Average_Enable=True, hardware_average=True, prf_hz=PRF_HZ)
+    assert daq.hw_average, "模拟板卡应支持 FPGA 平均"
+    point_s = RECORDS_PER_POINT / PRF_HZ
+    daq.start_capture()
+    all_data, pos = [], []
+    for i in range(NUM_POINTS):
+        if i:
+            time.sleep(MOVE_S)
+        arrive = time.perf_counter()
+        daq.get_one_acquisition(all_data, pos, f"{i},0,0", TIMEOUT_MS, True)
+        # 先等完到位时正在平均的 Buffer, 再采满一个点
+        assert time.perf_counter() - arrive > 1.5 * point_s, f"第 {i} 个点用了移动中的 Buffer"
+    daq.stop_capture()
+    stats = daq.get_acquisition_stats()
+    assert stats["points"] == NUM_POINTS and not stats["failed_points"], stats
+    assert stats["records"] - stats["discarded_records"] == stats["records_expected"], stats
+    moved = int(MOVE_S / point_s) * (NUM_POINTS - 1) + NUM_POINTS # 移动中完成的 + 每点到位时正在平均的
+    assert stats["discarded_records"] >= moved * RECORDS_PER_POINT, stats
+    print(f"✅ use_arena={use_arena}: 丢弃 {stats['discarded_records'] // RECORDS_PER_POINT} 个移动中的 Buffer, "
+          f"records 与 records_expected 对齐")
+
+
+if __name__ == "__main__":
+    run(use_arena=False)
+    run(use_arena=True)
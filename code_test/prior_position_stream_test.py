@@ -0,0 +1,52 @@
+"""
+在 pty 虚拟控制器上检查 PriorUnifiedStage 的后台位置线程在串口断开时的行为:
+  - 传输层被关闭 (close) 或串口读取出错后, 位置线程自行退出, 不会空转占满一个核
+  - 退出后 position_streaming 为 False, get_pos 回到直接查询串口 (读取失败返回 None)
+只能在 Linux / macOS 上运行 (需要 pty)。
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging.PriorUnifiedStage import PriorUnifiedStage
+from Alazar_imaging.PriorVirtualController import PriorVirtualController
+
+# ================= 配置参数 =================
+EXIT_TIMEOUT_S = 2.     # 断开后位置线程必须在这段时间内退出
+# ===========================================
+
+
+def wait_worker_exit(stage):
+    thread = stage._pos_thread
+    thread.join(EXIT_TIMEOUT_S)
+    assert not thread.is_alive(), "传输层关闭后位置线程没有退出"
+    assert not stage.position_streaming
+
+
+if __name__ == "__main__":
+    with PriorVirtualController() as controller:
+        stage = PriorUnifiedStage(None, controller.port)
+
+        # 1. 传输层被关闭
+        stage.start_position_stream()
+        time.sleep(0.1)
+        assert stage.latest_position() is not None and stage.pos_head > 0
+        cpu0 = time.process_time()
+        stage.transport.close()
+        wait_worker_exit(stage)
+        print(f"✅ 传输层关闭: 位置线程退出 (CPU {1000 * (time.process_time() - cpu0):.1f} ms)")
+        stage.stop_position_stream()
+        stage.disconnect_serial()
+
+        # 2. 串口在底下被关掉, 读线程出错
+        stage.connect_serial()
+        stage.start_position_stream()
+        time.sleep(0.1)
+        stage.ser.close()
+        wait_worker_exit(stage)
+        assert stage.transport.closed
+        assert stage.get_pos() is None
+        print("✅ 串口读取出错: 传输层标记为关闭, 位置线程退出")
+        stage.stop_position_stream()
+        stage.disconnect_serial()
@@ -0,0 +1,60 @@
+"""
+在 pty 虚拟控制器 (PriorVirtualController) 上检查 PriorSerialTransport 的回复对应:
+  - 停止指令 (I) 的 "R" 交给它自己, 被取消的移动先完成, 停止之后提交的移动要等运动结束才完成
+  - 回复丢失时 query 超时并 resync, 之后的回复重新对齐
+  - 多余的 "R" 不会交给普通指令
+只能在 Linux / macOS 上运行 (需要 pty)。
+"""
+import os
+import sys
+import time
+from concurrent.futures import Future
+import serial
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging.PriorSerialTransport import PriorSerialTransport
+from Alazar_imaging.PriorVirtualController import PriorVirtualController
+
+# ================= 配置参数 =================
+BAUDRATE = 115200
+FAR_UM = 100000          # 停止前正在进行的长距离移动
+# ===========================================
+
+
+if __name__ == "__main__":
+    with PriorVirtualController(BAUDRATE) as controller:
+        ser = serial.Serial(controller.port, BAUDRATE, timeout=0.05)
+        transport = PriorSerialTransport(ser)
+        assert transport.query("COMP,0") == "0"
+
+        # 1. 停止指令与移动的 "R"
+        cancelled = transport.submit_move(f"G,{FAR_UM},0")
+        time.sleep(0.05)
+        stop = transport.submit("I")
+        after = transport.submit_move("G,0,0")
+        pos = transport.submit("P")
+        assert stop.result(1) == "R" and cancelled.result(1) == "R"
+        x, y, _ = map(int, pos.result(1).split(","))
+        assert 0 < x < FAR_UM and y == 0, (x, y)
+        assert not after.done(), "停止之后提交的移动不应被停止指令的回复完成"
+        assert after.result(30) == "R" and transport.query("P") == "0,0,0"
+        print(f"✅ 停止指令: 停在 x={x}, 之后的移动到位才完成")
+
+        # 2. 回复丢失: 登记一条没有写出的指令, 下一条 query 拿不到回复, 超时后 resync
+        with transport._write_lock:
+            transport._pending.append(("LOST", Future(), None))
+        try:
+            transport.query("P", timeout=0.2)
+            raise AssertionError("回复错位时应当超时")
+        except TimeoutError:
+            pass
+        assert transport.query("P") == "0,0,0" and transport.query("SMS").isdigit()
+        print("✅ 回复丢失: 超时后重新对齐")
+
+        # 3. 绕过传输层写出的停止指令, 它的 "R" 没有人在等
+        ser.write(b"I\r")
+        time.sleep(0.05)
+        assert transport.query("PZ") == "0"
+        print("✅ 多余的 R 已丢弃")
+        transport.close()
+        ser.close()
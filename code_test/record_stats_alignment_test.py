@@ -0,0 +1,67 @@
+"""
+在模拟板卡上强制一个点采集失败 (触发中断, 不重试), 检查 RecordStatistics 的输出与 all_data 仍一一对应:
+失败点的 snr_map 为 NaN、robust_aline 为 0, 其余点正常。
+逐点采集和后台线程 (get_stream_acquisition) 各在平均模式和 Arena 模式下跑一次。
+"""
+import contextlib
+import io
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from Alazar_imaging import SimulatedATS9373 as sim
+from Alazar_imaging.AlazarNPTSystem import AlazarNPTSystem
+
+# ================= 配置参数 =================
+NUM_POINTS = 8
+FAIL_POINT = 3
+PRF_HZ = 80000
+TIMEOUT_MS = 30
+GAP_S = 0.04             # 触发中断时间, 大于 TIMEOUT_MS 但小于两个点的时间
+# ===========================================
+
+
+def run(use_arena, stream=False):
+    daq = AlazarNPTSystem(backend=sim)
+    with contextlib.redirect_stdout(io.StringIO()):
+        daq.configure_board()
+        daq.board.set_simulation(prf_hz=PRF_HZ)
+        daq.prepare_acquisition(NUM_POINTS, samples_per_record=512, records_per_buffer=16, records_per_point=64,
+                                use_arena=use_arena, Average_Enable=True, robust_stats=True,
+                                infinite_acquisition=stream)
+    daq.max_point_retries = 0
+    all_data, pos_mapping = [], []
+    daq.start_capture()
+    if stream:
+        daq.start_stream_worker(64)
+    for i in range(NUM_POINTS):
+        if i == FAIL_POINT:
+            daq.board.inject_fault("gap", 0, GAP_S)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if stream:
+                daq.get_stream_acquisition(all_data, pos_mapping, f"{i},0,0", daq.stream_head, TIMEOUT_MS, True)
+            else:
+                daq.get_one_acquisition(all_data, pos_mapping, f"{i},0,0", TIMEOUT_MS, True)
+    daq.stop_capture()
+
+    stats = daq.get_acquisition_stats()
+    # 中断前已经完成的 Buffer 可能刚好凑满第 FAIL_POINT 个点, 这时失败的是下一个点
+    assert len(stats["failed_points"]) == 1 and stats["failed_points"][0] in (FAIL_POINT, FAIL_POINT + 1), \
+        stats["failed_points"]
+    failed = stats["failed_points"][0]
+    robust_aline, snr_map, outlier_counts, code_min, code_max = daq.record_stats.get_result()
+    assert daq.record_stats.point_idx == len(all_data) == NUM_POINTS
+    for arr in (robust_aline, snr_map, outlier_counts, code_min, code_max):
+        assert arr.shape[0] == NUM_POINTS
+    assert np.isnan(snr_map[failed]).all() and not robust_aline[failed].any()
+    ok = np.arange(NUM_POINTS) != failed
+    assert np.isfinite(snr_map[ok]).all() and (snr_map[ok] > 0).all()
+    assert (code_max[ok] > code_min[ok]).all()
+    print(f"✅ use_arena={use_arena}, stream={stream}: 失败点 {failed} 已跳过, {NUM_POINTS} 个点的统计保持对齐")
+
+
+if __name__ == "__main__":
+    for stream in (False, True):
+        run(use_arena=False, stream=stream)
+        run(use_arena=True, stream=stream)